@@ -0,0 +1,345 @@
+"""
+Offline benchmark for main.py.
+
+Builds throwaway git repositories with a configurable shape, starts a local
+OpenAI-compatible stub server, runs main() against each repository in a fresh
+process and reports wall time, commits/second and the number of git
+subprocesses started per phase. Nothing is sent over the network.
+
+    python benchmark.py --files 2000 --depth 4 --modes no-ai ai fast-import
+"""
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import argparse
+import tempfile
+import threading
+import subprocess
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+MAIN_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "main.py")
+
+BENCH_AUTHOR = "Benchmark"
+BENCH_EMAIL = "benchmark@example.com"
+
+# Scenario name -> extra main.py arguments and whether the stub server is used
+MODES = {
+    "no-ai": (["--no-ai"], False),
+    "ai": (["--no-cache"], True),
+    "ai-batch": (["--no-cache"], True),
+    "fast-import": (["--no-ai", "--fast-import"], False),
+    "heuristic": (["--message-engine", "heuristic", "--fast-import"], False),
+    "grouped": (["--no-ai", "--group-window", "3600"], False),
+    "rerun": (["--no-ai"], False),
+}
+
+
+def generate_repo(path, file_count, depth, fanout=4, mtime_spread_days=365, burst_fraction=0.0,
+                  ignored_fraction=0.1, file_size=512, seed=0):
+    """
+    Creates a git repository at path with file_count files spread over a directory
+    tree depth levels deep. An ignored_fraction of the files match .gitignore.
+    The other files are committed as a baseline and then modified, since the tool
+    takes the modification time of changed files (new files get their creation
+    time, which cannot be set). Modification times are spread uniformly over the
+    last mtime_spread_days days, except for a burst_fraction of files that are
+    clustered within a few minutes of each other. Returns the number of ignored files.
+    """
+    rng = random.Random(seed)
+    os.makedirs(path)
+    git_env = dict(os.environ, GIT_AUTHOR_NAME=BENCH_AUTHOR, GIT_AUTHOR_EMAIL=BENCH_EMAIL,
+                   GIT_COMMITTER_NAME=BENCH_AUTHOR, GIT_COMMITTER_EMAIL=BENCH_EMAIL)
+    subprocess.run(["git", "init", "-q"], cwd=path, check=True)
+    with open(os.path.join(path, ".gitignore"), "w") as f:
+        f.write("*.log\nbuild/\n")
+    subprocess.run(["git", "add", ".gitignore"], cwd=path, check=True)
+    subprocess.run(["git", "commit", "-q", "-m", "Initial commit"], cwd=path, env=git_env, check=True)
+
+    directories = [""]
+    level_directories = [""]
+    for level in range(depth):
+        level_directories = [os.path.join(parent, f"dir{level}_{i}") for parent in level_directories for i in range(fanout)]
+        directories += level_directories
+
+    now = time.time()
+    burst_start = now - rng.uniform(0, mtime_spread_days * 86400)
+    ignored_count = 0
+    file_paths = []
+    for n in range(file_count):
+        directory = rng.choice(directories)
+        if rng.random() < ignored_fraction:
+            ignored_count += 1
+            if rng.random() < 0.5:
+                directory = os.path.join(directory, "build")
+                name = f"artifact{n}.o"
+            else:
+                name = f"file{n}.log"
+        else:
+            name = f"file{n}.txt"
+        os.makedirs(os.path.join(path, directory), exist_ok=True)
+        file_path = os.path.join(path, directory, name)
+        with open(file_path, "w") as f:
+            line = f"line of file {n}\n"
+            f.write(line * max(1, file_size // len(line)))
+        file_paths.append(file_path)
+
+    subprocess.run(["git", "add", "-A"], cwd=path, check=True)
+    subprocess.run(["git", "commit", "-q", "-m", "Baseline"], cwd=path, env=git_env, check=True)
+
+    for n, file_path in enumerate(file_paths):
+        with open(file_path, "a") as f:
+            f.write(f"change to file {n}\n")
+        if rng.random() < burst_fraction:
+            mtime = burst_start + rng.uniform(0, 300)
+        else:
+            mtime = now - rng.uniform(0, mtime_spread_days * 86400)
+        os.utime(file_path, (mtime, mtime))
+    return ignored_count
+
+
+class StubCompletionServer:
+    """
+    OpenAI-compatible chat completion server on localhost that answers every
+    request after a fixed latency. Batched prompts get a JSON array reply.
+    Requests with "stream": true get the reply as server-sent events, a few
+    characters per event.
+    """
+
+    # Characters of the reply sent per event of a streamed reply
+    STREAM_CHUNK_CHARS = 8
+
+    def __init__(self, latency=0.2):
+        self.latency = latency
+        self.requests = 0
+        self._lock = threading.Lock()
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, format, *args):
+                pass
+
+            def do_POST(self):
+                body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+                with server._lock:
+                    server.requests += 1
+                time.sleep(server.latency)
+                prompt = body["messages"][-1]["content"]
+                if "JSON array" in prompt:
+                    count = prompt.count("### Commit ")
+                    message = json.dumps([f"chore: update files ({i})" for i in range(1, count + 1)])
+                else:
+                    message = "chore: update files"
+                if body.get("stream"):
+                    self._send_events(message)
+                    return
+                reply = json.dumps({"choices": [{"message": {"role": "assistant", "content": message}}]}).encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(reply)))
+                self.end_headers()
+                self.wfile.write(reply)
+
+            def _send_events(self, message):
+                # Sent with chunked transfer encoding, one chunk per event, as providers do
+                self.send_response(200)
+                self.send_header("Content-Type", "text/event-stream")
+                self.send_header("Transfer-Encoding", "chunked")
+                self.end_headers()
+                events = [
+                    {"choices": [{"delta": {"content": message[start:start + server.STREAM_CHUNK_CHARS]}}]}
+                    for start in range(0, len(message), server.STREAM_CHUNK_CHARS)
+                ]
+                payloads = [f"data: {json.dumps(event)}\n\n".encode() for event in events] + [b"data: [DONE]\n\n"]
+                try:
+                    for payload in payloads:
+                        self.wfile.write(f"{len(payload):x}\r\n".encode() + payload + b"\r\n")
+                        self.wfile.flush()
+                    self.wfile.write(b"0\r\n\r\n")
+                except (BrokenPipeError, ConnectionResetError):
+                    self.close_connection = True # The client stopped reading after the first line
+
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+
+    @property
+    def endpoint(self):
+        return f"http://127.0.0.1:{self._server.server_address[1]}/v1/chat/completions"
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+
+def _git_subcommand(args):
+    """Returns the git subcommand of an argument list, or None for other programs."""
+    if isinstance(args, (str, bytes)) or not args or os.path.basename(str(args[0])) != "git":
+        return None
+    for arg in args[1:]:
+        if not str(arg).startswith("-"):
+            return str(arg)
+    return "git"
+
+
+def run_worker(repo, main_args, result_path):
+    """
+    Runs main.main() in this process with subprocess counting hooked in, then
+    writes the counts and wall time to result_path. Called in a fresh process for
+    every scenario, so each run starts with main.py's import-time setup.
+    """
+    counts = {}
+    phase = ["setup"]
+    original_popen = subprocess.Popen
+
+    class CountingPopen(original_popen):
+        def __init__(self, args, *rest, **kwargs):
+            subcommand = _git_subcommand(args) or "other"
+            phase_counts = counts.setdefault(phase[0], Counter())
+            phase_counts[subcommand] += 1
+            super().__init__(args, *rest, **kwargs)
+
+    subprocess.Popen = CountingPopen
+    sys.path.insert(0, os.path.dirname(MAIN_SCRIPT))
+    import main
+
+    def in_phase(name, function):
+        def wrapper(*args, **kwargs):
+            previous = phase[0]
+            phase[0] = name
+            try:
+                return function(*args, **kwargs)
+            finally:
+                phase[0] = previous
+        return wrapper
+
+    main.plan_directory_commits = in_phase("discover", main.plan_directory_commits)
+    main.execute_commits = in_phase("commit", main.execute_commits)
+
+    sys.argv = [MAIN_SCRIPT, repo] + main_args
+    start = time.perf_counter()
+    with open(os.devnull, "w") as devnull:
+        real_stdout = sys.stdout
+        sys.stdout = devnull
+        try:
+            main.main()
+        finally:
+            sys.stdout = real_stdout
+    elapsed = time.perf_counter() - start
+    subprocess.Popen = original_popen
+
+    with open(result_path, "w") as f:
+        json.dump({"seconds": elapsed, "subprocesses": {name: dict(c) for name, c in counts.items()}}, f)
+
+
+def count_commits(repo):
+    # Callers take the difference of two counts, so the baseline commits cancel out
+    output = subprocess.run(["git", "rev-list", "--count", "HEAD"], cwd=repo, capture_output=True, text=True, check=True)
+    return int(output.stdout)
+
+
+def run_scenario(mode, repo, stub_server, ai_batch_size, stream=False):
+    """Runs main.py on repo in a worker process and returns the scenario's result dict."""
+    main_args, uses_ai = MODES[mode]
+    env = dict(os.environ, GIT_AUTHOR_NAME=BENCH_AUTHOR, GIT_AUTHOR_EMAIL=BENCH_EMAIL)
+    if uses_ai:
+        env.update(API_ENDPOINT=stub_server.endpoint, API_KEY="benchmark", MODEL="benchmark")
+        env["AI_BATCH_SIZE"] = str(ai_batch_size if mode == "ai-batch" else 1)
+        env["AI_STREAM"] = "true" if stream else "false"
+    if mode == "rerun":
+        # Measure the incremental path: a second run over a tree that is already committed
+        subprocess.run([sys.executable, MAIN_SCRIPT, repo] + main_args, env=env, stdout=subprocess.DEVNULL, check=True)
+
+    requests_before = stub_server.requests
+    commits_before = count_commits(repo)
+    with tempfile.NamedTemporaryFile(suffix=".json", delete=False) as f:
+        result_path = f.name
+    try:
+        subprocess.run(
+            [sys.executable, os.path.abspath(__file__), "--worker", repo, result_path, "--"] + main_args,
+            env=env, check=True,
+        )
+        with open(result_path) as f:
+            result = json.load(f)
+    finally:
+        os.remove(result_path)
+
+    result["mode"] = mode
+    result["commits"] = count_commits(repo) - commits_before
+    result["commits_per_second"] = result["commits"] / result["seconds"] if result["seconds"] else 0.0
+    result["api_requests"] = stub_server.requests - requests_before
+    return result
+
+
+def print_report(results):
+    print(f"\n{'mode':<12} {'commits':>8} {'seconds':>9} {'commits/s':>10} {'requests':>9} {'git procs':>10}")
+    for result in results:
+        total = sum(sum(c.values()) for c in result["subprocesses"].values())
+        print(f"{result['mode']:<12} {result['commits']:>8} {result['seconds']:>9.2f} "
+              f"{result['commits_per_second']:>10.1f} {result['api_requests']:>9} {total:>10}")
+    for result in results:
+        print(f"\n{result['mode']} subprocesses per phase:")
+        for phase_name, phase_counts in result["subprocesses"].items():
+            details = ", ".join(f"{name}={count}" for name, count in sorted(phase_counts.items(), key=lambda x: -x[1]))
+            print(f"  {phase_name:<9} {sum(phase_counts.values()):>6}  {details}")
+
+
+def main():
+    if len(sys.argv) > 1 and sys.argv[1] == "--worker":
+        repo, result_path = sys.argv[2], sys.argv[3]
+        run_worker(repo, sys.argv[5:], result_path)
+        return
+
+    parser = argparse.ArgumentParser(description="Benchmark main.py on synthetic repositories, fully offline.")
+    parser.add_argument("--files", type=int, default=500, help="Number of files in each generated repository.")
+    parser.add_argument("--depth", type=int, default=3, help="Depth of the generated directory tree.")
+    parser.add_argument("--fanout", type=int, default=4, help="Subdirectories per directory.")
+    parser.add_argument("--file-size", type=int, default=512, help="Approximate size of each file in bytes.")
+    parser.add_argument("--spread-days", type=float, default=365, help="Spread file modification times over this many days.")
+    parser.add_argument("--burst-fraction", type=float, default=0.0, help="Fraction of files modified within the same few minutes.")
+    parser.add_argument("--ignored-fraction", type=float, default=0.1, help="Fraction of files matched by .gitignore.")
+    parser.add_argument("--seed", type=int, default=0, help="Random seed of the generator.")
+    parser.add_argument("--latency", type=float, default=0.2, help="Stub server latency per request, in seconds.")
+    parser.add_argument("--ai-batch-size", type=int, default=8, help="AI_BATCH_SIZE used by the ai-batch mode.")
+    parser.add_argument("--stream", action="store_true", help="Set AI_STREAM, so the AI modes get streamed replies from the stub server.")
+    parser.add_argument("--modes", nargs="+", choices=sorted(MODES), default=["no-ai", "ai", "fast-import"], help="Scenarios to run.")
+    parser.add_argument("--json", metavar="FILE", help="Also write the results to FILE as JSON.")
+    parser.add_argument("--keep", action="store_true", help="Keep the generated repositories.")
+    args = parser.parse_args()
+
+    work_dir = tempfile.mkdtemp(prefix="filestamp-bench-")
+    stub_server = StubCompletionServer(args.latency).start()
+    results = []
+    try:
+        for mode in args.modes:
+            repo = os.path.join(work_dir, mode)
+            ignored = generate_repo(
+                repo, args.files, args.depth, fanout=args.fanout, mtime_spread_days=args.spread_days,
+                burst_fraction=args.burst_fraction, ignored_fraction=args.ignored_fraction,
+                file_size=args.file_size, seed=args.seed,
+            )
+            print(f"Running {mode} on {args.files} files ({ignored} ignored) in {repo}")
+            results.append(run_scenario(mode, repo, stub_server, args.ai_batch_size, args.stream))
+    finally:
+        stub_server.stop()
+        if args.keep:
+            print(f"Repositories kept in {work_dir}")
+        else:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    print_report(results)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,50 +1,705 @@
 import os
+import posixpath
 import sys
 import argparse
 from datetime import datetime
 import subprocess
-import requests
+import threading
+import tempfile
+import time
+import hashlib
+import sqlite3
+import json
+import codecs
+import collections
+from concurrent.futures import ThreadPoolExecutor
+import multiprocessing
+import contextlib
+import io
+import atexit
 import re
 import platform
-from dotenv import load_dotenv
+import random
+import email.utils
+import ctypes
+import errno
+import select
+import stat
+import struct
+import array
+import bisect
+import heapq
 
-# Load environment variables from .env file
-load_dotenv()
+# requests is only imported once an API request is made (see import_requests()),
+# so runs without AI start quickly
+requests = None
+
+# Settings, filled in from the environment and .env by load_config().
+# The values here are the defaults used when a variable is not set.
 
 # OpenAI-compatible API configuration
-API_ENDPOINT = os.getenv("API_ENDPOINT")
-API_KEY = os.getenv("API_KEY")
-MODEL = os.getenv("MODEL")
-DIFF_CHAR_LIMIT = int(os.getenv("DIFF_CHAR_LIMIT", "4000")) # Default to 4000 if not set
+API_ENDPOINT = None
+API_KEY = None
+MODEL = None
+DIFF_CHAR_LIMIT = 4000
+DIFF_TOKEN_LIMIT = 1000 # Prompt budget for the changes, DIFF_CHAR_LIMIT / 4 unless set
+AI_CONCURRENCY = 4 # Number of commit messages generated in parallel
+AI_BATCH_SIZE = 1 # Commits described per API request
+AI_MAX_TOKENS = 600 # Reply token cap of a single-message request
+AI_STREAM = False # Stream replies and stop after the subject line
+
+# Directory walks stat this many files in parallel, which hides the latency of network filesystems
+STAT_WORKERS = 8
+
+# Provider rate limits (0 means unlimited) and how often a throttled or failed request is retried
+AI_REQUESTS_PER_MINUTE = 0.0
+AI_TOKENS_PER_MINUTE = 0.0
+AI_MAX_RETRIES = 5
+
+# Cached AI commit messages are evicted beyond this many entries or after this many days unused
+MESSAGE_CACHE_MAX_ENTRIES = 50000
+MESSAGE_CACHE_MAX_AGE_DAYS = 180.0
 
 # Git author configuration
-GIT_AUTHOR_NAME = os.getenv("GIT_AUTHOR_NAME")
-GIT_AUTHOR_EMAIL = os.getenv("GIT_AUTHOR_EMAIL")
+GIT_AUTHOR_NAME = None
+GIT_AUTHOR_EMAIL = None
+
+
+def find_env_file():
+    """
+    Returns the path of the .env file to load, or None. Like python-dotenv, looks
+    in the directory of this script and then in each of its parents.
+    """
+    directory = os.path.dirname(os.path.abspath(__file__))
+    while True:
+        candidate = os.path.join(directory, ".env")
+        if os.path.isfile(candidate):
+            return candidate
+        parent = os.path.dirname(directory)
+        if parent == directory:
+            return None
+        directory = parent
+
+
+def load_config(env_file=None):
+    """
+    Reads the settings from the environment, falling back to the values of
+    env_file (by default the .env found by find_env_file()). The environment
+    itself is left alone, so a later call with another file does not see the
+    values of this one. python-dotenv is only imported when there is a file.
+    """
+    global API_ENDPOINT, API_KEY, MODEL, DIFF_CHAR_LIMIT, DIFF_TOKEN_LIMIT, AI_CONCURRENCY, AI_BATCH_SIZE, AI_MAX_TOKENS, AI_STREAM
+    global AI_REQUESTS_PER_MINUTE, AI_TOKENS_PER_MINUTE, AI_MAX_RETRIES
+    global MESSAGE_CACHE_MAX_ENTRIES, MESSAGE_CACHE_MAX_AGE_DAYS, STAT_WORKERS, GIT_AUTHOR_NAME, GIT_AUTHOR_EMAIL
+
+    env_file = env_file or find_env_file()
+    file_values = {}
+    if env_file:
+        # Variables already set in the environment take precedence over the file
+        from dotenv import dotenv_values
+        file_values = dotenv_values(env_file)
+
+    def getenv(name, default=None):
+        value = os.environ.get(name, file_values.get(name))
+        return default if value is None else value
+
+    API_ENDPOINT = getenv("API_ENDPOINT")
+    API_KEY = getenv("API_KEY")
+    MODEL = getenv("MODEL")
+    DIFF_CHAR_LIMIT = int(getenv("DIFF_CHAR_LIMIT", "4000")) # Default to 4000 if not set
+    DIFF_TOKEN_LIMIT = max(1, int(getenv("DIFF_TOKEN_LIMIT", "0")) or DIFF_CHAR_LIMIT // 4)
+    AI_CONCURRENCY = max(1, int(getenv("AI_CONCURRENCY", "4")))
+    AI_BATCH_SIZE = max(1, int(getenv("AI_BATCH_SIZE", "1")))
+    AI_MAX_TOKENS = max(1, int(getenv("AI_MAX_TOKENS", "600")))
+    AI_STREAM = getenv("AI_STREAM", "false").strip().lower() in ("1", "true", "yes", "on")
+
+    AI_REQUESTS_PER_MINUTE = float(getenv("AI_REQUESTS_PER_MINUTE", "0"))
+    AI_TOKENS_PER_MINUTE = float(getenv("AI_TOKENS_PER_MINUTE", "0"))
+    AI_MAX_RETRIES = max(0, int(getenv("AI_MAX_RETRIES", "5")))
+
+    MESSAGE_CACHE_MAX_ENTRIES = int(getenv("MESSAGE_CACHE_MAX_ENTRIES", "50000"))
+    MESSAGE_CACHE_MAX_AGE_DAYS = float(getenv("MESSAGE_CACHE_MAX_AGE_DAYS", "180"))
+
+    STAT_WORKERS = max(1, int(getenv("STAT_WORKERS", "8")))
+
+    GIT_AUTHOR_NAME = getenv("GIT_AUTHOR_NAME")
+    GIT_AUTHOR_EMAIL = getenv("GIT_AUTHOR_EMAIL")
+
+
+def import_requests():
+    """Imports requests on first use and returns it."""
+    global requests
+    if requests is None:
+        import requests
+        import requests.adapters
+    return requests
+
+
+class Profiler:
+    """
+    Collects timings for --profile: the time spent in each phase of a run, and
+    the count and duration of every git subprocess and API request, by git
+    subcommand and by the phase it ran in. A phase entered inside another one
+    pauses the outer phase's timer. Phase times are summed over all threads, so
+    the message phase can exceed the wall time when messages are generated in
+    parallel.
+    """
+
+    def __init__(self, report_path=None, repo_root=None):
+        self.report_path = report_path
+        self.repo_root = repo_root # The report goes to its .git directory by default
+        self.started = time.perf_counter()
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._phase_seconds = collections.defaultdict(float)
+        self._git_calls = collections.defaultdict(list) # (phase, subcommand) -> durations
+        self._api_calls = collections.defaultdict(list) # phase -> durations
+
+    def _phase_stack(self):
+        if not hasattr(self._local, "phases"):
+            self._local.phases = [] # [name, started] pairs, innermost last
+        return self._local.phases
+
+    def current_phase(self):
+        stack = self._phase_stack()
+        return stack[-1][0] if stack else "setup"
+
+    def _add_phase_time(self, name, seconds):
+        with self._lock:
+            self._phase_seconds[name] += seconds
+
+    def enter_phase(self, name):
+        stack = self._phase_stack()
+        now = time.perf_counter()
+        if stack:
+            self._add_phase_time(stack[-1][0], now - stack[-1][1])
+        stack.append([name, now])
+
+    def exit_phase(self):
+        stack = self._phase_stack()
+        now = time.perf_counter()
+        name, started = stack.pop()
+        self._add_phase_time(name, now - started)
+        if stack:
+            stack[-1][1] = now
+
+    def record_git(self, args, seconds):
+        subcommand = next((arg for arg in args[1:] if not arg.startswith("-")), "git")
+        with self._lock:
+            self._git_calls[(self.current_phase(), subcommand)].append(seconds)
+
+    def record_api(self, seconds):
+        with self._lock:
+            self._api_calls[self.current_phase()].append(seconds)
+
+    @staticmethod
+    def _stats(durations):
+        durations = sorted(durations)
+
+        def percentile(p):
+            return durations[min(len(durations) - 1, int(p / 100 * len(durations)))]
+
+        return {
+            "count": len(durations),
+            "total_seconds": round(sum(durations), 6),
+            "p50": round(percentile(50), 6),
+            "p90": round(percentile(90), 6),
+            "p99": round(percentile(99), 6),
+            "max": round(durations[-1], 6),
+        }
+
+    def report(self):
+        with self._lock:
+            by_subcommand = collections.defaultdict(list)
+            by_phase = collections.defaultdict(dict)
+            for (phase, subcommand), durations in self._git_calls.items():
+                by_subcommand[subcommand].extend(durations)
+                by_phase[phase][subcommand] = self._stats(durations)
+            api_durations = [d for durations in self._api_calls.values() for d in durations]
+            return {
+                "wall_seconds": round(time.perf_counter() - self.started, 6),
+                "phases": {phase: round(seconds, 6) for phase, seconds in self._phase_seconds.items()},
+                "git": {subcommand: self._stats(durations) for subcommand, durations in by_subcommand.items()},
+                "git_by_phase": dict(by_phase),
+                "api": self._stats(api_durations) if api_durations else None,
+                "api_by_phase": {phase: self._stats(durations) for phase, durations in self._api_calls.items()},
+            }
+
+    def write_report(self):
+        report = self.report()
+        report_path = self.report_path
+        if report_path is None:
+            try:
+                report_path = os.path.join(get_git_common_dir(self.repo_root), PROFILE_FILE_NAME)
+            except (subprocess.CalledProcessError, OSError, TypeError):
+                report_path = os.path.abspath(PROFILE_FILE_NAME)
+        with open(report_path, "w") as f:
+            json.dump(report, f, indent=2)
+
+        print("\n--- Profile ---")
+        print(f"Wall time: {report['wall_seconds']:.2f}s")
+        for phase, seconds in sorted(report["phases"].items(), key=lambda x: -x[1]):
+            print(f"  phase {phase:<10} {seconds:9.2f}s")
+        for subcommand, stats in sorted(report["git"].items(), key=lambda x: -x[1]["total_seconds"]):
+            print(f"  git {subcommand:<12} {stats['count']:6d} calls {stats['total_seconds']:9.2f}s  p50 {stats['p50'] * 1000:.1f}ms  p99 {stats['p99'] * 1000:.1f}ms")
+        if report["api"]:
+            stats = report["api"]
+            print(f"  api requests     {stats['count']:6d} calls {stats['total_seconds']:9.2f}s  p50 {stats['p50'] * 1000:.1f}ms  p99 {stats['p99'] * 1000:.1f}ms")
+        print(f"Profile report written to {report_path}")
+
+
+PROFILE_FILE_NAME = "filestamp-profile.json"
+
+_profiler = None
+
+
+def enable_profiling(report_path=None, cprofile_path=None, repo_root=None):
+    """
+    Starts collecting timings for the rest of the run. The JSON report is written
+    at exit to report_path (default .git/filestamp-profile.json of repo_root), and
+    with cprofile_path a cProfile dump of the main thread is written there as well.
+    """
+    global _profiler
+    _profiler = Profiler(report_path, repo_root)
+    atexit.register(_profiler.write_report)
+    if cprofile_path:
+        import cProfile
+        profile = cProfile.Profile()
+        profile.enable()
+
+        def dump_cprofile():
+            profile.disable()
+            profile.dump_stats(cprofile_path)
+            print(f"cProfile stats written to {cprofile_path}")
+
+        atexit.register(dump_cprofile)
+
+
+class profile_phase:
+    """Context manager that attributes the enclosed work to a phase when profiling is enabled."""
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self._profiler = _profiler
+        if self._profiler is not None:
+            self._profiler.enter_phase(self.name)
+        return self
+
+    def __exit__(self, *exc_info):
+        if self._profiler is not None:
+            self._profiler.exit_phase()
+        return False
+
+
+class EventLog:
+    """
+    Writes structured events as JSON lines: one per commit or failed commit, and
+    a final summary. Lines are buffered and written whole, at most BUFFER_BYTES
+    at a time, so that the log costs few writes and the lines of processes
+    appending to the same pipe or file never interleave.
+    """
+
+    # Writes of up to PIPE_BUF bytes to a pipe are atomic
+    BUFFER_BYTES = 4096
+
+    def __init__(self, stream, owns_stream=False):
+        self.stream = stream
+        self.owns_stream = owns_stream
+        self._lines = []
+        self._size = 0
+        self._lock = threading.Lock()
+
+    def emit(self, event_type, **fields):
+        record = {"type": event_type}
+        record.update(fields)
+        self.write(json.dumps(record, default=str) + "\n")
+
+    def write(self, lines):
+        """Adds already encoded JSON lines to the log."""
+        if not lines:
+            return
+        with self._lock:
+            if self._size + len(lines) > self.BUFFER_BYTES:
+                self._flush()
+            self._lines.append(lines)
+            self._size += len(lines)
+
+    def _flush(self):
+        if self._lines:
+            self.stream.write("".join(self._lines))
+            self.stream.flush()
+            self._lines = []
+            self._size = 0
+
+    def flush(self):
+        with self._lock:
+            self._flush()
+
+    def close(self):
+        self.flush()
+        if self.owns_stream:
+            self.stream.close()
+
+
+class ProgressReporter:
+    """
+    Prints a line with the number of files done, their throughput and the
+    estimated time left to standard error, at most every INTERVAL seconds.
+    Stands in for the per-file output when that is turned off.
+    """
+
+    INTERVAL = 5.0
+
+    def __init__(self, total_files):
+        self.total_files = total_files
+        self.done_files = 0
+        self.failed_files = 0
+        self.started = time.monotonic()
+        self._last_report = self.started
+
+    def update(self, done_files=0, failed_files=0):
+        self.done_files += done_files
+        self.failed_files += failed_files
+        now = time.monotonic()
+        if now - self._last_report >= self.INTERVAL:
+            self._last_report = now
+            self._report(now)
+
+    def finish(self):
+        self._report(time.monotonic())
+
+    @staticmethod
+    def _format_duration(seconds):
+        seconds = int(seconds)
+        return f"{seconds // 3600}:{seconds % 3600 // 60:02d}:{seconds % 60:02d}"
+
+    def _report(self, now):
+        elapsed = now - self.started
+        processed = self.done_files + self.failed_files
+        rate = processed / elapsed if elapsed > 0 else 0.0
+        remaining = self.total_files - processed
+        eta = self._format_duration(remaining / rate) if rate > 0 else "unknown"
+        print(
+            f"Progress: {processed}/{self.total_files} files ({self.failed_files} failed), "
+            f"{rate:.1f} files/s, elapsed {self._format_duration(elapsed)}, ETA {eta}",
+            file=sys.stderr, flush=True,
+        )
+
+
+LOG_FORMATS = ("text", "jsonl")
+
+# Per-file output; turned off by --quiet and --log-format jsonl
+_verbose = True
+_event_log = None
+_run_started = time.monotonic()
+
+
+def log_detail(message):
+    """Prints a line of per-file output, unless that is turned off."""
+    if _verbose:
+        print(message)
+
+
+def emit_event(event_type, **fields):
+    """Adds an event to the JSONL log, if there is one."""
+    if _event_log is not None:
+        _event_log.emit(event_type, **fields)
+
+
+def relative_paths(file_paths, repo_root):
+    return [repo_relative_path(file_path, repo_root) for file_path in file_paths]
+
+
+def add_output_arguments(parser):
+    parser.add_argument("-q", "--quiet", action="store_true", help="Do not print lines for every file; print a progress line with throughput and ETA to stderr instead.")
+    parser.add_argument("--log-format", choices=LOG_FORMATS, help="'jsonl' writes one JSON event per commit or failed commit, and a final summary, instead of per-file output (default: text).")
+    parser.add_argument("--log-file", metavar="FILE", help="Append the JSON events to FILE instead of writing them to stdout. Implies --log-format jsonl.")
+
+
+def start_output(args, event_stream=None):
+    """
+    Applies --quiet, --log-format and --log-file. JSON events go to event_stream
+    if given, to the log file, or to stdout, in which case the other output
+    moves to stderr.
+    """
+    global _verbose, _event_log
+    log_format = args.log_format or ("jsonl" if args.log_file else "text")
+    if args.quiet or log_format == "jsonl":
+        _verbose = False
+    if log_format != "jsonl":
+        return
+    if event_stream is not None:
+        _event_log = EventLog(event_stream)
+    elif args.log_file:
+        _event_log = EventLog(open(os.path.abspath(args.log_file), "a", buffering=EventLog.BUFFER_BYTES * 2), owns_stream=True)
+    else:
+        # Keep stdout for the events alone
+        _event_log = EventLog(sys.stdout)
+        sys.stdout = sys.stderr
+    atexit.register(_event_log.close)
+
+
+def get_run_counters():
+    """Returns the message cache and API counters of this process, for the JSON summary."""
+    counters = {}
+    with _shared_helpers_lock:
+        caches = list(_message_caches.values())
+    if caches:
+        counters["cache"] = {"hits": sum(cache.hits for cache in caches), "misses": sum(cache.misses for cache in caches)}
+    if _completion_client is not None:
+        counters["api"] = _completion_client.counters()
+    return counters
+
+
+def emit_run_summary(summaries, counters=None):
+    """Adds the final summary record of a run over one or more repositories to the JSONL log."""
+    if _event_log is None:
+        return
+    repositories = [
+        {key: summary.get(key) for key in ("repo", "successful", "failed", "error", "counters") if key in summary}
+        for summary in summaries
+    ]
+    emit_event(
+        "summary",
+        successful=sum(summary["successful"] for summary in summaries),
+        failed=sum(summary["failed"] for summary in summaries),
+        errors=sum(1 for summary in summaries if summary.get("error")),
+        elapsed_seconds=round(time.monotonic() - _run_started, 3),
+        repositories=repositories,
+        **(counters or {})
+    )
+    _event_log.flush()
+
+
+def run_git(args, **kwargs):
+    """
+    Runs a git command with subprocess.run. Every short-lived git command goes
+    through here so --profile can account for it.
+    """
+    if _profiler is None:
+        return subprocess.run(args, **kwargs)
+    started = time.perf_counter()
+    try:
+        return subprocess.run(args, **kwargs)
+    finally:
+        _profiler.record_git(args, time.perf_counter() - started)
+
+
+def popen_git(args, **kwargs):
+    """
+    Starts a git command with subprocess.Popen, for commands whose input or output
+    is streamed. Call finish_git() once the process has exited, so --profile can
+    account for its lifetime.
+    """
+    started = time.perf_counter()
+    process = subprocess.Popen(args, **kwargs)
+    process.profile_started = started
+    return process
+
+
+def finish_git(process):
+    if _profiler is not None:
+        _profiler.record_git(process.args, time.perf_counter() - process.profile_started)
+
+
+def record_git_time(args, seconds):
+    """Accounts for time spent waiting on a long-running git process started with popen_git()."""
+    if _profiler is not None:
+        _profiler.record_git(args, seconds)
+
+
+# Decided once; get_creation_timestamp() runs for every file of a walk
+PLATFORM_SYSTEM = platform.system()
+
+
+# Stat data of a file as read by StatCollector: what the walks and watchers use of
+# an os.stat_result, with the birth time in st_birthtime where the system knows it
+FileStat = collections.namedtuple("FileStat", ["st_mode", "st_ino", "st_size", "st_mtime", "st_mtime_ns", "st_ctime", "st_birthtime"])
 
 
+class StatxReader:
+    """
+    Reads file metadata with the Linux statx() system call through ctypes,
+    which unlike os.stat() reports the birth time of files on filesystems
+    that record one. available is False where the C library or the kernel
+    do not provide statx(), and then callers use os.stat() instead. Support
+    is probed once when the reader is created, before threads share it.
+    """
+
+    AT_FDCWD = -100
+    STATX_BASIC_STATS = 0x7ff
+    STATX_BTIME = 0x800
+
+    # struct statx: stx_mask, then stx_mode, stx_ino and stx_size, then the
+    # {tv_sec, tv_nsec} timestamps stx_btime, stx_ctime and stx_mtime
+    LAYOUT = struct.Struct("=I24xH2xQQ32xqI4xqI4xqI4x")
+    BUFFER_SIZE = 256 # The size of struct statx, including its spare fields
+
+    def __init__(self):
+        self._statx = None
+        self._local = threading.local() # One result buffer per thread
+        if PLATFORM_SYSTEM != "Linux":
+            return
+        libc = ctypes.CDLL(None, use_errno=True)
+        if not hasattr(libc, "statx"):
+            return # glibc before 2.28
+        statx = libc.statx
+        statx.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_int, ctypes.c_uint, ctypes.c_void_p]
+        statx.restype = ctypes.c_int
+        # Kernels before 4.11, or a seccomp filter (e.g. in older containers),
+        # reject every statx() call, so one call on the root directory is enough to tell
+        probe = ctypes.create_string_buffer(self.BUFFER_SIZE)
+        if statx(self.AT_FDCWD, os.fsencode(os.path.abspath(os.sep)), 0, self.STATX_BASIC_STATS, probe) != 0:
+            if ctypes.get_errno() in (errno.ENOSYS, errno.EPERM):
+                return
+        self._statx = statx
+
+    @property
+    def available(self):
+        return self._statx is not None
+
+    def stat(self, path):
+        """
+        Returns the FileStat of path, following symbolic links, or None if
+        statx() turned out not to be supported. Raises OSError like os.stat().
+        """
+        # Read once: another thread may turn statx() off while this call runs
+        statx = self._statx
+        if statx is None:
+            return None
+        buffer = getattr(self._local, "buffer", None)
+        if buffer is None:
+            buffer = self._local.buffer = ctypes.create_string_buffer(self.BUFFER_SIZE)
+        if statx(self.AT_FDCWD, os.fsencode(path), 0, self.STATX_BASIC_STATS | self.STATX_BTIME, buffer) != 0:
+            error = ctypes.get_errno()
+            if error in (errno.ENOSYS, errno.EPERM):
+                # Rejected despite the probe; os.stat() is used from here on
+                self._statx = None
+                return None
+            raise OSError(error, os.strerror(error), os.fspath(path))
+        mask, mode, inode, size, birth_sec, birth_nsec, change_sec, change_nsec, modify_sec, modify_nsec = self.LAYOUT.unpack_from(buffer)
+        change_time = change_sec + change_nsec * 1e-9
+        # Filesystems without birth times (e.g. most NFS servers, ext3) leave STATX_BTIME unset
+        birth_time = birth_sec + birth_nsec * 1e-9 if mask & self.STATX_BTIME else change_time
+        return FileStat(mode, inode, size, modify_sec + modify_nsec * 1e-9, modify_sec * 1000000000 + modify_nsec, change_time, birth_time)
+
+
+class StatCollector:
+    """
+    Stats the files of directory walks on a bounded pool of threads, so the
+    round trips of network filesystems like NFS overlap instead of adding up.
+    On Linux the birth time comes from statx() where the kernel and filesystem
+    provide it, rather than falling back to the inode change time.
+    """
+
+    # Files are handed to the threads in batches, so that on a fast local
+    # filesystem the hand-off does not cost more than the stat itself
+    BATCH_SIZE = 64
+
+    def __init__(self, workers=None):
+        self.workers = STAT_WORKERS if workers is None else workers
+        self._statx = StatxReader()
+        self._executor = None
+
+    def stat(self, path):
+        """
+        Returns the stat data of path, a path or an os.DirEntry, following symbolic
+        links: a FileStat from statx(), or an os.stat_result. Raises OSError.
+        """
+        if PLATFORM_SYSTEM == "Windows" and isinstance(path, os.DirEntry):
+            return path.stat() # Comes with the directory listing on Windows
+        stat_info = self._statx.stat(path)
+        if stat_info is not None:
+            return stat_info
+        return os.stat(path)
+
+    def _stat_batch(self, paths):
+        results = []
+        for path in paths:
+            try:
+                results.append((path, self.stat(path)))
+            except OSError as e:
+                results.append((path, e))
+        return results
+
+    @staticmethod
+    def _iter_batches(paths, size):
+        batch = []
+        for path in paths:
+            batch.append(path)
+            if len(batch) >= size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+    def stat_all(self, paths):
+        """
+        Lazily stats paths (paths or os.DirEntry objects), running at most a few
+        batches per thread ahead of the caller, and yields (path, stat_data) in
+        order. stat_data is the OSError raised for files that could not be stat'ed.
+        """
+        batches = self._iter_batches(paths, self.BATCH_SIZE)
+        if self.workers <= 1 or PLATFORM_SYSTEM == "Windows":
+            for batch in batches:
+                yield from self._stat_batch(batch)
+            return
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="filestamp-stat")
+        for results in _bounded_map(self._executor, self._stat_batch, batches, self.workers * 2):
+            yield from results
+
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+            self._executor = None
+
+
+_stat_collector = None
+
+# Guards the creation of the helpers shared by threads, like those kept per repository
+_shared_helpers_lock = threading.Lock()
+
+
+def get_stat_collector():
+    """Returns the StatCollector shared by all repositories, creating it on first use."""
+    global _stat_collector
+    with _shared_helpers_lock:
+        if _stat_collector is None:
+            _stat_collector = StatCollector()
+            atexit.register(_stat_collector.close)
+        return _stat_collector
+
+
+def get_creation_timestamp(stat_info):
+    """Returns the creation time of a stat result as a POSIX timestamp."""
+    if PLATFORM_SYSTEM == 'Windows':
+        # On Windows, st_ctime is creation time
+        return stat_info.st_ctime
+    # On Unix/Mac, st_birthtime is creation time if available (on Linux, from statx)
+    # Fall back to st_ctime (inode change time) if st_birthtime is not available
+    if hasattr(stat_info, 'st_birthtime'):
+        return stat_info.st_birthtime
+    return stat_info.st_ctime
 
-def get_file_timestamps(file_path):
+
+def get_file_timestamps(file_path, stat_info=None):
     """
     Get creation and modification timestamps for a file.
+    Stat data the caller already has can be passed as stat_info.
     Returns a tuple of (creation_time, modification_time) as datetime objects.
     """
     try:
-        stat_info = os.stat(file_path)
+        if stat_info is None:
+            stat_info = get_stat_collector().stat(file_path)
         
         # Get modification time (available on all platforms)
         mod_time = datetime.fromtimestamp(stat_info.st_mtime)
         
         # Get creation time (platform-specific)
-        if platform.system() == 'Windows':
-            # On Windows, st_ctime is creation time
-            creation_time = datetime.fromtimestamp(stat_info.st_ctime)
-        else:
-            # On Unix/Mac, st_birthtime is creation time if available
-            # Fall back to st_ctime (inode change time) if st_birthtime is not available
-            if hasattr(stat_info, 'st_birthtime'):
-                creation_time = datetime.fromtimestamp(stat_info.st_birthtime)
-            else:
-                creation_time = datetime.fromtimestamp(stat_info.st_ctime)
+        creation_time = datetime.fromtimestamp(get_creation_timestamp(stat_info))
         
         return creation_time, mod_time
     except Exception as e:
@@ -53,74 +708,475 @@ def get_file_timestamps(file_path):
         current_time = datetime.now()
         return current_time, current_time
 
-def is_file_ignored(file_path):
+class GitStdinProcess:
+    """
+    A long-lived git process that answers queries written to its stdin, so that
+    many queries do not start one git process each. Subclasses set COMMAND and
+    read the answers to a chunk of paths in _query().
+    """
+
+    # Paths are written to git in chunks of this size so that the pending
+    # output never grows without bound.
+    CHUNK_SIZE = 1024
+
+    COMMAND = None
+
+    def __init__(self, cwd=None):
+        self.cwd = cwd
+        self._proc = None
+        self._buffer = b""
+
+    def _start(self):
+        env = os.environ.copy()
+        # Make git flush each answer immediately instead of when its buffer fills
+        env["GIT_FLUSH"] = "1"
+        self._proc = popen_git(
+            self.COMMAND,
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            cwd=self.cwd,
+            env=env,
+        )
+        self._buffer = b""
+
+    def close(self):
+        """Stops the git process if it is running."""
+        if self._proc is None:
+            return
+        try:
+            self._proc.stdin.close()
+        except OSError:
+            pass
+        try:
+            self._proc.wait(timeout=5)
+        except subprocess.TimeoutExpired:
+            self._proc.kill()
+            self._proc.wait()
+        self._proc.stdout.close()
+        self._proc.stderr.close()
+        self._proc = None
+
+    def _read_until(self, separator):
+        # Returns the next answer field, which ends with separator
+        while separator not in self._buffer:
+            chunk = os.read(self._proc.stdout.fileno(), 65536)
+            if not chunk:
+                raise EOFError(f"{' '.join(self.COMMAND[:2])} exited unexpectedly")
+            self._buffer += chunk
+        field, self._buffer = self._buffer.split(separator, 1)
+        return field
+
+    def _exchange(self, payload, read_answers):
+        # Sends payload and returns read_answers(), starting git first if needed
+        if self._proc is None or self._proc.poll() is not None:
+            self._start()
+
+        def write_payload():
+            try:
+                self._proc.stdin.write(payload)
+                self._proc.stdin.flush()
+            except (BrokenPipeError, OSError):
+                pass # Reported through the reader hitting EOF
+
+        # Write from a separate thread so a full output pipe can never deadlock us
+        writer = threading.Thread(target=write_payload, daemon=True)
+        writer.start()
+        try:
+            return read_answers()
+        finally:
+            writer.join()
+
+    def _query_in_chunks(self, paths, default, action):
+        # Answers paths chunk by chunk; paths git fails on get default
+        paths = list(paths)
+        results = []
+        started = time.perf_counter()
+        for start in range(0, len(paths), self.CHUNK_SIZE):
+            chunk = paths[start:start + self.CHUNK_SIZE]
+            try:
+                results.extend(self._query(chunk))
+            except (EOFError, OSError):
+                # git aborts on paths it cannot handle (e.g. outside the repository).
+                # Retry one path at a time so a single bad path does not affect
+                # the rest of the chunk.
+                self._restart_after_error()
+                for path in chunk:
+                    try:
+                        results.extend(self._query([path]))
+                    except (EOFError, OSError):
+                        error = self._restart_after_error()
+                        print(f"Warning: Error {action} {path}: {error}")
+                        results.append(default)
+        record_git_time(self.COMMAND, time.perf_counter() - started)
+        return results
+
+    def _restart_after_error(self):
+        # Collect git's error message and drop the dead process; the next
+        # query starts a fresh one.
+        error = ""
+        if self._proc is not None:
+            self._proc.kill()
+            error = self._proc.stderr.read().decode(errors="replace").strip()
+            self.close()
+        return error
+
+
+class GitIgnoreChecker(GitStdinProcess):
+    """
+    Answers .gitignore queries through one long-lived
+    `git check-ignore --stdin -z --non-matching --verbose` process,
+    so checking many files does not start one git process per file.
+    """
+
+    COMMAND = ["git", "check-ignore", "--stdin", "-z", "--non-matching", "--verbose"]
+
+    def _query(self, paths):
+        payload = b"".join(os.fsencode(path) + b"\0" for path in paths)
+
+        def read_answers():
+            results = []
+            for _ in paths:
+                # <source> <linenum> <pattern> <pathname>; source is empty for non-matching paths
+                source = self._read_until(b"\0")
+                self._read_until(b"\0")
+                pattern = self._read_until(b"\0")
+                self._read_until(b"\0")
+                # A matching negated pattern ("!foo") means the path is explicitly not ignored
+                results.append(bool(source) and not pattern.startswith(b"!"))
+            return results
+
+        return self._exchange(payload, read_answers)
+
+    def check_paths(self, paths):
+        """
+        Check which of the given paths are ignored by .gitignore.
+        Returns a list of booleans in the same order as paths.
+        """
+        # Assume a path git cannot check is not ignored, to be safe
+        return self._query_in_chunks(paths, False, "checking git ignore status for")
+
+    def is_ignored(self, path):
+        """Returns True if a single path is ignored by .gitignore."""
+        return self.check_paths([path])[0]
+
+
+_ignore_checkers = {} # repository root -> GitIgnoreChecker
+
+
+def get_ignore_checker(repo_root):
+    """Returns the shared GitIgnoreChecker of repo_root, starting it on first use."""
+    with _shared_helpers_lock:
+        if repo_root not in _ignore_checkers:
+            _ignore_checkers[repo_root] = GitIgnoreChecker(repo_root)
+            atexit.register(_ignore_checkers[repo_root].close)
+        return _ignore_checkers[repo_root]
+
+def is_file_ignored(repo_root, file_path):
     """
     Check if a file is ignored by .gitignore.
     Returns True if the file is ignored, False otherwise.
     """
     try:
-        # Use git check-ignore to determine if file is ignored
-        result = subprocess.run(
-            ["git", "check-ignore", file_path],
-            capture_output=True,
-            text=True,
-            check=False  # Don't raise exception for ignored files
-        )
-        
-        # If git check-ignore returns 0, the file is ignored
-        # If it returns 1, the file is not ignored
-        # If it returns 128+, there was an error
-        if result.returncode == 0:
-            return True  # File is ignored
-        elif result.returncode == 1:
-            return False  # File is not ignored
-        else:
-            # Error occurred, assume not ignored to be safe
-            print(f"Warning: Error checking git ignore status for {file_path}: {result.stderr}")
-            return False
-            
+        return get_ignore_checker(repo_root).is_ignored(file_path)
     except Exception as e:
         print(f"Unexpected error checking git ignore status for {file_path}: {e}")
         return False
 
-def is_file_new(file_path):
+class BlobHasher(GitStdinProcess):
+    """
+    Computes the blob object names of files through one long-lived
+    `git hash-object --stdin-paths` process, so hashing many files does not
+    start one git process per file. Like `git add`, git applies the clean
+    filters and end-of-line conversion of .gitattributes. With write, the
+    blobs are also written to the object database; otherwise nothing is.
+    Safe to use from several threads.
+    """
+
+    COMMAND = ["git", "hash-object", "--stdin-paths"]
+
+    def __init__(self, cwd=None, write=False):
+        super().__init__(cwd)
+        if write:
+            self.COMMAND = ["git", "hash-object", "-w", "--stdin-paths"]
+        self._lock = threading.Lock()
+
+    def _query(self, paths):
+        # git reads one path per line, and unquotes C-style quoted paths like fast-import does
+        payload = b"".join(_quote_git_path(path) + b"\n" for path in paths)
+        return self._exchange(payload, lambda: [self._read_until(b"\n").decode() for _ in paths])
+
+    def hash_paths(self, paths):
+        """
+        Returns the blob object names of the files at paths, in the same order;
+        None for files that could not be read.
+        """
+        with self._lock:
+            return self._query_in_chunks(paths, None, "hashing")
+
+
+_blob_hashers = {} # repository root -> BlobHasher
+
+
+def get_blob_hasher(repo_root):
+    """Returns the shared BlobHasher of repo_root, starting it on first use."""
+    with _shared_helpers_lock:
+        if repo_root not in _blob_hashers:
+            _blob_hashers[repo_root] = BlobHasher(repo_root)
+            atexit.register(_blob_hashers[repo_root].close)
+        return _blob_hashers[repo_root]
+
+def repo_relative_path(file_path, repo_root):
+    """
+    Returns file_path relative to repo_root, with forward slashes like git.
+    repo_root must be a resolved path, as `git rev-parse --show-toplevel`
+    reports it. file_path may reach it through symbolic links (e.g. /tmp on
+    macOS); its parent directory is only resolved then, as that is costly.
+    """
+    relative_path = os.path.relpath(os.path.abspath(file_path), repo_root)
+    if relative_path == os.pardir or relative_path.startswith(os.pardir + os.sep):
+        directory, name = os.path.split(os.path.abspath(file_path))
+        relative_path = os.path.relpath(os.path.join(os.path.realpath(directory), name), repo_root)
+    return relative_path.replace(os.sep, "/")
+
+
+class GitStatusIndex:
+    """
+    In-memory path -> (status, HEAD blob, index mode) index built from a single
+    `git status --porcelain=v2 -z` snapshot of the repository, or of just the
+    paths a run works on. Paths that are not in the index are committed and
+    unchanged.
+    """
+
+    def __init__(self, repo_root):
+        self.repo_root = os.path.realpath(repo_root)
+        self._entries = None
+        self._loaded = False
+        self._scope = None # Paths the snapshot is limited to, or None for all
+
+    def _key(self, file_path):
+        return repo_relative_path(file_path, self.repo_root)
+
+    def _run_status(self, keys=None):
+        # Literal pathspecs, as file names may contain glob characters
+        command = ["git", "--literal-pathspecs", "status", "--porcelain=v2", "-z", "--untracked-files=all"]
+        if keys is not None:
+            command += ["--"] + keys
+        return run_git(command, capture_output=True, check=True, cwd=self.repo_root).stdout
+
+    def load(self, file_paths=None):
+        """
+        Takes the status snapshot, limited to file_paths (files or directories)
+        if given and none of them is the repository root. Called automatically
+        on first use. Paths looked up outside a limited snapshot are added to it.
+        """
+        self._loaded = True
+        keys = None if file_paths is None else sorted({self._key(file_path) for file_path in file_paths})
+        if keys is not None and "." in keys:
+            keys = None
+        try:
+            if keys is None:
+                entries = self._parse(self._run_status())
+            else:
+                entries = {}
+                for chunk in _chunks(keys):
+                    entries.update(self._parse(self._run_status(chunk)))
+        except subprocess.CalledProcessError as e:
+            print(f"Error getting git status snapshot: {e.stderr.decode(errors='replace').strip()}")
+            self._entries = None
+            return
+        except FileNotFoundError:
+            print("Error: git command not found. Is Git installed and in your PATH?")
+            self._entries = None
+            return
+        self._entries = entries
+        self._scope = None if keys is None else set(keys)
+
+    def cover(self, file_paths):
+        """
+        Makes sure the snapshot includes file_paths (files or directories): takes
+        it limited to them on first use, or adds those a limited snapshot lacks.
+        """
+        if not self._loaded:
+            self.load(file_paths)
+        elif self._entries is not None and self._scope is not None:
+            missing_keys = [key for key in map(self._key, file_paths) if not self._covers(key)]
+            if "." in missing_keys:
+                self.load()
+            elif missing_keys:
+                self.refresh([os.path.join(self.repo_root, *key.split("/")) for key in missing_keys])
+
+    def _covers(self, key):
+        if self._scope is None:
+            return True
+        while key:
+            if key in self._scope:
+                return True
+            key = posixpath.dirname(key)
+        return False
+
+    def _entry(self, key):
+        # Called with a snapshot taken; a limited one first learns about paths outside it
+        if not self._covers(key):
+            self.refresh([os.path.join(self.repo_root, *key.split("/"))])
+        return self._entries.get(key)
+
+    @staticmethod
+    def _parse(output):
+        entries = {}
+        records = output.split(b"\0")
+        i = 0
+        while i < len(records):
+            record = os.fsdecode(records[i])
+            i += 1
+            if not record:
+                continue
+            kind = record[0]
+            if kind == "1":
+                # 1 <XY> <sub> <mH> <mI> <mW> <hH> <hI> <path>
+                fields = record.split(" ", 8)
+                entries[fields[8]] = (fields[1], fields[6], fields[4])
+            elif kind == "2":
+                # 2 <XY> <sub> <mH> <mI> <mW> <hH> <hI> <X><score> <path>, then <origPath>
+                fields = record.split(" ", 9)
+                entries[fields[9]] = (fields[1], fields[6], fields[4])
+                i += 1 # Skip the original path of the rename/copy
+            elif kind == "u":
+                # u <XY> <sub> <m1> <m2> <m3> <mW> <h1> <h2> <h3> <path>
+                fields = record.split(" ", 10)
+                entries[fields[10]] = (fields[1], None, None)
+            elif kind == "?":
+                entries[record[2:]] = ("??", None, None)
+            # Ignored entries ("!") are never requested, and headers ("#") are not used
+        return entries
+
+    def status(self, file_path):
+        """
+        Returns the two-letter status code of a file (e.g. '??', 'A.', '.M'),
+        or None if the file is committed and unchanged.
+        """
+        if not self._loaded:
+            self.load()
+        if self._entries is None:
+            return None
+        entry = self._entry(self._key(file_path))
+        return entry[0] if entry else None
+
+    def head_blob(self, file_path):
+        """
+        Returns the object name of the file's blob in HEAD, or None if the file
+        is not in HEAD or is committed and unchanged.
+        """
+        if not self._loaded:
+            self.load()
+        if self._entries is None:
+            return None
+        entry = self._entry(self._key(file_path))
+        # Porcelain v2 reports all zeros for files missing from HEAD
+        if not entry or not entry[1] or not entry[1].strip("0"):
+            return None
+        return entry[1]
+
+    def deleted_files(self):
+        """
+        Returns a list of (file_path, head_blob) tuples for the files of HEAD
+        that were deleted from the index or the working tree; for a limited
+        snapshot, only those within it.
+        """
+        if not self._loaded:
+            self.load()
+        if self._entries is None:
+            return []
+        deleted = []
+        for key, (status_code, head_blob, _) in self._entries.items():
+            # Staged renames are already paired up by git and left alone
+            if "D" in status_code and "R" not in status_code and head_blob and head_blob.strip("0"):
+                deleted.append((os.path.join(self.repo_root, *key.split("/")), head_blob))
+        return deleted
+
+    def index_mode(self, file_path):
+        """
+        Returns the git file mode of the file in the index (e.g. '100755'), or
+        None if it is not in the index or is committed and unchanged.
+        """
+        if not self._loaded:
+            self.load()
+        if self._entries is None:
+            return None
+        entry = self._entry(self._key(file_path))
+        # Porcelain v2 reports 000000 for files missing from the index
+        if not entry or not entry[2] or not entry[2].strip("0"):
+            return None
+        return entry[2]
+
+    def has_changes(self, file_path):
+        """Returns True if the file has uncommitted changes."""
+        if not self._loaded:
+            self.load()
+        if self._entries is None:
+            return True # Status unknown, assume it needs a commit
+        return self._entry(self._key(file_path)) is not None
+
+    def is_new(self, file_path):
+        """Returns True if the file is untracked or added but not yet committed."""
+        status_code = self.status(file_path)
+        return status_code is not None and (status_code == "??" or status_code[0] == "A")
+
+    def refresh(self, file_paths):
+        """
+        Re-reads the status of just file_paths and keeps the rest of the snapshot,
+        so a long-running caller pays for the paths that changed, not the whole tree.
+        """
+        if not self._loaded or self._entries is None:
+            self.load()
+            return
+        keys = [self._key(file_path) for file_path in file_paths]
+        for chunk in _chunks(keys):
+            try:
+                output = self._run_status(chunk)
+            except subprocess.CalledProcessError as e:
+                print(f"Warning: Could not refresh git status, taking a new snapshot: {e.stderr.decode(errors='replace').strip()}")
+                self.load()
+                return
+            for key in chunk:
+                self._entries.pop(key, None)
+            self._entries.update(self._parse(output))
+            if self._scope is not None:
+                self._scope.update(chunk)
+
+    def mark_committed(self, file_paths):
+        """Records that the given files were committed, without re-running git status."""
+        if self._entries is None:
+            return
+        for file_path in file_paths:
+            self._entries.pop(self._key(file_path), None)
+
+
+_status_indexes = {} # repository root -> GitStatusIndex
+
+
+def get_status_index(repo_root, file_paths=None):
+    """
+    Returns the shared GitStatusIndex of repo_root, taking the status snapshot
+    on first use. Given file_paths (the files or directories a run works on),
+    the snapshot covers at least those, and only those if it was not taken yet.
+    """
+    with _shared_helpers_lock:
+        if repo_root not in _status_indexes:
+            _status_indexes[repo_root] = GitStatusIndex(repo_root)
+        status_index = _status_indexes[repo_root]
+    if file_paths is not None:
+        status_index.cover(file_paths)
+    return status_index
+
+def is_file_new(repo_root, file_path):
     """
     Check if a file is new (untracked or added but not committed).
     Returns True if the file is new, False if it's modified.
     """
-    try:
-        # Get git status for the file
-        result = subprocess.run(
-            ["git", "status", "--porcelain", file_path],
-            capture_output=True,
-            text=True,
-            check=True
-        )
-        
-        status_line = result.stdout.strip()
-        if not status_line:
-            # If no status output, file might be committed and unchanged
-            return False
-        
-        # Check the status code
-        status_code = status_line[:2]
-        
-        # Files with status '??' are untracked (new)
-        # Files with status 'A ' are added to staging area (new)
-        # Files with status 'M ' are modified
-        # Files with status ' M' are modified but not staged
-        
-        return status_code in ['??', 'A ']
-        
-    except subprocess.CalledProcessError as e:
-        print(f"Error checking git status for {file_path}: {e}")
-        # If we can't determine status, assume it's modified to be safe
-        return False
-    except Exception as e:
-        print(f"Unexpected error checking file status for {file_path}: {e}")
-        return False
+    return get_status_index(repo_root).is_new(file_path)
 
-def has_staged_changes(file_paths):
+def has_staged_changes(repo_root, file_paths):
     """
     Check if there are any staged changes for the given file paths.
     Returns True if there are staged changes, False otherwise.
@@ -131,11 +1187,12 @@ def has_staged_changes(file_paths):
         # --exit-code: makes the program exit with 1 if there are differences, 0 otherwise
         # --cached: checks staged changes
         # We add '--' to separate file paths from options, though not strictly necessary here.
-        result = subprocess.run(
+        result = run_git(
             ["git", "diff", "--cached", "--quiet", "--exit-code", "--"] + file_paths,
             capture_output=True, # We still capture stderr to check for errors
             text=True,
-            check=False # We check returncode manually
+            check=False, # We check returncode manually
+            cwd=repo_root,
         )
         
         # returncode 0 means no differences (no staged changes)
@@ -161,91 +1218,162 @@ def has_staged_changes(file_paths):
         print(f"Unexpected error checking for staged changes for {file_paths}: {e}")
         return True # Assume there are changes if the check fails unexpectedly
 
-def get_appropriate_timestamp(file_path):
+def get_appropriate_timestamp(repo_root, file_path, stat_info=None):
     """
     Get the appropriate timestamp for a file based on its status.
     Returns creation time for new files, modification time for modified files.
     """
-    creation_time, mod_time = get_file_timestamps(file_path)
+    creation_time, mod_time = get_file_timestamps(file_path, stat_info)
     
-    if is_file_new(file_path):
-        print(f"File {file_path} is new, using creation time: {creation_time}")
+    if is_file_new(repo_root, file_path):
+        log_detail(f"File {file_path} is new, using creation time: {creation_time}")
         return creation_time
     else:
-        print(f"File {file_path} is modified, using modification time: {mod_time}")
+        log_detail(f"File {file_path} is modified, using modification time: {mod_time}")
         return mod_time
 
-def generate_commit_message_with_ai(file_paths):
+# Files smaller than this are left out of move and copy matching: empty
+# __init__.py files and one-line stubs share blobs without being related
+MOVE_MIN_BYTES = 32
+
+class ContentIndex:
     """
-    Generates a commit message using an OpenAI-compatible API based on git diff.
-    Returns None if AI generation fails.
+    Finds the files of a run that only move or copy content already in HEAD,
+    so they can be committed and described as such. A new file with the blob of
+    a HEAD file deleted from the working tree was moved there, and a new file
+    with the blob of a file still in HEAD is a copy of it.
     """
-    if not API_ENDPOINT or not API_KEY or not MODEL:
-        print("Error: API_ENDPOINT, API_KEY, or MODEL not set in .env file.")
-        return None # Return None to indicate failure and trigger fallback
 
-    try:
-        # Get the staged changes (diff) for the specified files
-        # Using --cached to get staged changes, and -- to separate paths from revision
-        result = subprocess.run(
-            ["git", "diff", "--cached", "--"] + file_paths,
-            capture_output=True,
-            text=True,
-            check=True
-        )
-        diff_output = result.stdout
-    except subprocess.CalledProcessError as e:
-        print(f"Error getting git diff: {e.stderr}")
-        return None # Return None to indicate failure and trigger fallback
-    except FileNotFoundError:
-        print("Error: git command not found. Is Git installed and in your PATH?")
-        return None # Return None to indicate failure and trigger fallback
+    def __init__(self, repo_root):
+        self.repo_root = repo_root
+        self.renames = {} # new path -> old path
+        self.copies = {} # new path -> path of the copied file in HEAD
+        self._blobs = {} # path -> blob, for the new files looked at so far
 
-    truncated_notice = ""
-    if len(diff_output) > DIFF_CHAR_LIMIT:
-        diff_output = diff_output[:DIFF_CHAR_LIMIT]
-        truncated_notice = "Note: The git diff was too long and has been truncated.\n"
+    def detect(self, new_paths, directory):
+        """
+        Hashes new_paths, files that are not in HEAD and at least MOVE_MIN_BYTES
+        long, in bulk, and records which of them were moved from a deleted file
+        under directory and which copy a file of HEAD. Returns the renames found,
+        as a new path -> old path dict.
+        """
+        if not new_paths or get_head_commit(self.repo_root) is None:
+            return {}
+        new_by_blob = collections.defaultdict(list)
+        for file_path, blob in zip(new_paths, get_blob_hasher(self.repo_root).hash_paths(new_paths)):
+            if blob is not None:
+                new_by_blob[blob].append(file_path)
 
-    if not diff_output.strip():
-        # If there are no staged changes, it might be a new file.
-        # We can try to get the diff of the working directory against /dev/null for new files.
-        # However, a simpler approach is to inform the user or handle it as a special case.
-        # For now, let's check if the files are new and untracked.
+        renames = {}
+        prefix = os.path.join(os.path.realpath(directory), "")
+        for old_path, head_blob in sorted(get_status_index(self.repo_root).deleted_files()):
+            candidates = new_by_blob.get(head_blob)
+            if not candidates or not old_path.startswith(prefix):
+                continue
+            # Prefer a file that kept its name, then the first one walked
+            same_name = [file_path for file_path in candidates if os.path.basename(file_path) == os.path.basename(old_path)]
+            new_path = (same_name or candidates)[0]
+            candidates.remove(new_path)
+            renames[new_path] = old_path
+            self._blobs[new_path] = head_blob
+
+        remaining = {blob: paths for blob, paths in new_by_blob.items() if paths}
+        if remaining:
+            for head_path, blob in self._iter_head_blobs():
+                for file_path in remaining.pop(blob, ()):
+                    self.copies[file_path] = head_path
+                    self._blobs[file_path] = blob
+                if not remaining:
+                    break
+        self.renames.update(renames)
+        return renames
+
+    def _iter_head_blobs(self):
+        # Streams (file_path, blob) for the regular files of HEAD, without holding the tree in memory
+        repo_root = self.repo_root
+        process = popen_git(["git", "ls-tree", "-r", "-z", "--full-tree", "HEAD"], stdout=subprocess.PIPE, cwd=repo_root)
+        remainder = b""
         try:
-            status_result = subprocess.run(
-                ["git", "status", "--porcelain"] + file_paths,
-                capture_output=True,
-                text=True,
-                check=True
-            )
-            # Check for 'A' (added) or '??' (untracked) files
-            if any(line.startswith('A') or line.startswith('??') for line in status_result.stdout.splitlines()):
-                # For new files, we'll read their content as a fallback
-                file_contents = ""
-                for file_path in file_paths:
-                    try:
-                        with open(file_path, 'r', encoding='utf-8') as f:
-                            content = f.read()
-                            # Also truncate new file content if it's too long
-                            if len(content) > DIFF_CHAR_LIMIT:
-                                content = content[:DIFF_CHAR_LIMIT]
-                                truncated_notice = "Note: The new file content was too long and has been truncated.\n"
-                            file_contents += f"--- New File: {os.path.basename(file_path)} ---\n{content[:500]}...\n\n"
-                    except UnicodeDecodeError:
-                        # File is binary, note this and skip content reading
-                        file_contents += f"--- New File: {os.path.basename(file_path)} ---\n(Binary file - content not displayed)\n\n"
-                    except Exception as e:
-                        print(f"Warning: Could not read new file {file_path}: {e}")
-                        file_contents += f"--- New File: {os.path.basename(file_path)} ---\n(Could not read file content)\n\n"
-                diff_output = file_contents if file_contents else "No changes detected and files are not new or readable."
+            while True:
+                chunk = process.stdout.read(65536)
+                if not chunk:
+                    return
+                records = (remainder + chunk).split(b"\0")
+                remainder = records.pop()
+                for record in records:
+                    # <mode> SP <type> SP <object> TAB <path>
+                    info, path = record.split(b"\t", 1)
+                    mode, _, blob = info.split(b" ")
+                    if mode in (b"100644", b"100755"):
+                        yield os.path.join(repo_root, *os.fsdecode(path).split("/")), blob.decode()
+        finally:
+            if process.poll() is None:
+                process.kill() # Stopped early, every copy was found
+            process.stdout.close()
+            process.wait()
+            finish_git(process)
+
+    def find_moves(self, file_paths):
+        """
+        Returns a list of (source, target, kind) tuples, kind being "rename" or
+        "copy", if a commit of file_paths only moves or copies files, else None.
+        Deleted files and files with their content are paired up by hashing, so
+        commits that detect() did not see, like those of a plan file, work too.
+        """
+        status_index = get_status_index(self.repo_root)
+        deleted = collections.defaultdict(list) # head blob -> deleted paths
+        present_paths = []
+        for file_path in file_paths:
+            status_code = status_index.status(file_path)
+            if status_code is None or "D" not in status_code:
+                present_paths.append(file_path)
+                continue
+            head_blob = status_index.head_blob(file_path)
+            if head_blob is None:
+                return None
+            deleted[head_blob].append(file_path)
+        if not present_paths or not (deleted or all(file_path in self.copies for file_path in present_paths)):
+            return None
+        try:
+            if any(os.lstat(file_path).st_size < MOVE_MIN_BYTES for file_path in present_paths):
+                return None
+        except OSError:
+            return None
+
+        unhashed_paths = [file_path for file_path in present_paths if file_path not in self._blobs]
+        self._blobs.update(zip(unhashed_paths, get_blob_hasher(self.repo_root).hash_paths(unhashed_paths)))
+        moves = []
+        for file_path in present_paths:
+            old_paths = deleted.get(self._blobs[file_path], [])
+            old_path = self.renames.get(file_path)
+            if old_path not in old_paths:
+                old_path = old_paths[0] if old_paths else None
+            if old_path is not None:
+                old_paths.remove(old_path)
+                moves.append((old_path, file_path, "rename"))
+            elif file_path in self.copies:
+                moves.append((self.copies[file_path], file_path, "copy"))
             else:
-                diff_output = "No staged changes detected for the specified files."
-        except Exception as e:
-            print(f"Error checking git status for new files: {e}")
-            diff_output = "No staged changes and could not determine if files are new."
+                return None
+        if any(deleted.values()):
+            return None
+        return moves
+
+
+_content_indexes = {} # repository root -> ContentIndex
+
+
+def get_content_index(repo_root):
+    """Returns the shared ContentIndex of repo_root."""
+    with _shared_helpers_lock:
+        if repo_root not in _content_indexes:
+            _content_indexes[repo_root] = ContentIndex(repo_root)
+        return _content_indexes[repo_root]
 
 
-    prompt = f"""
+SYSTEM_PROMPT = "You are an expert assistant that generates concise and descriptive Git commit messages following conventional commit formats. Be brief in your reasoning and prioritize generating the commit message itself."
+
+PROMPT_TEMPLATE = """
     Analyze the following git diff output to generate a descriptive Git commit message.
     The message should follow the conventional commit format (e.g., 'feat: add new feature', 'fix: resolve bug in login', 'docs: update README', 'style: format code', 'refactor: simplify function', 'test: add unit tests', 'chore: update dependencies').
     If the changes seem incomplete or are a work in progress, use 'wip: ...'.
@@ -254,9 +1382,857 @@ def generate_commit_message_with_ai(file_paths):
     Git Diff:
     {diff_output}
 
-    Commit Message:
+    Commit Message:
+    """
+
+BATCH_PROMPT_TEMPLATE = """
+    Analyze the git diff output of each of the following {count} commits to generate a descriptive Git commit message for each one.
+    Every message should follow the conventional commit format (e.g., 'feat: add new feature', 'fix: resolve bug in login', 'docs: update README', 'style: format code', 'refactor: simplify function', 'test: add unit tests', 'chore: update dependencies').
+    If the changes seem incomplete or are a work in progress, use 'wip: ...'.
+    Keep every message concise and under 72 characters.
+    Reply with only a JSON array of {count} strings, one commit message per commit, in the same order as the commits.
+
+{commits}
+    Commit Messages (JSON array):
+    """
+
+# Changing the prompts invalidates previously cached messages
+PROMPT_HASH = hashlib.sha256((SYSTEM_PROMPT + PROMPT_TEMPLATE + BATCH_PROMPT_TEMPLATE).encode()).hexdigest()[:16]
+
+
+class CommitMessageCache:
+    """
+    Persistent cache of AI-generated commit messages, stored in SQLite under .git/.
+    Entries are keyed by the content being committed, so re-running the tool on the
+    same files (after a reset, or in a fresh clone) does not call the API again.
+    """
+
+    def __init__(self, path, max_entries=None, max_age_days=None):
+        self.path = path
+        self.max_entries = MESSAGE_CACHE_MAX_ENTRIES if max_entries is None else max_entries
+        self.max_age_days = MESSAGE_CACHE_MAX_AGE_DAYS if max_age_days is None else max_age_days
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        # Shared by the message prefetching threads; access is serialised by self._lock
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS messages ("
+            "key TEXT PRIMARY KEY, message TEXT NOT NULL, created REAL NOT NULL, last_used REAL NOT NULL)"
+        )
+        self._connection.commit()
+
+    @staticmethod
+    def make_key(blob_pairs):
+        """
+        Builds a cache key from (base_blob, new_blob) object names, one pair per file,
+        together with everything else that affects the generated message.
+        """
+        parts = [MODEL or "", str(DIFF_CHAR_LIMIT), str(DIFF_TOKEN_LIMIT), PROMPT_HASH]
+        # Sorted as strings, since new files have None as their base blob
+        parts.extend(sorted(f"{base_blob or '-'}:{new_blob}" for base_blob, new_blob in blob_pairs))
+        return hashlib.sha256("\n".join(parts).encode()).hexdigest()
+
+    def get(self, key):
+        """Returns the cached message for key, or None."""
+        with self._lock:
+            row = self._connection.execute("SELECT message FROM messages WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._connection.execute("UPDATE messages SET last_used = ? WHERE key = ?", (time.time(), key))
+            self._connection.commit()
+            return row[0]
+
+    def put(self, key, message):
+        now = time.time()
+        with self._lock:
+            self._connection.execute(
+                "INSERT OR REPLACE INTO messages (key, message, created, last_used) VALUES (?, ?, ?, ?)",
+                (key, message, now, now),
+            )
+            self._connection.commit()
+
+    def evict(self):
+        """Drops entries unused for longer than max_age_days, then the least recently used beyond max_entries."""
+        with self._lock:
+            cutoff = time.time() - self.max_age_days * 86400
+            self._connection.execute("DELETE FROM messages WHERE last_used < ?", (cutoff,))
+            self._connection.execute(
+                "DELETE FROM messages WHERE key NOT IN (SELECT key FROM messages ORDER BY last_used DESC LIMIT ?)",
+                (self.max_entries,),
+            )
+            self._connection.commit()
+
+    def close(self):
+        if self._connection is None:
+            return
+        self.evict()
+        self._connection.close()
+        self._connection = None
+
+
+_message_caches = {} # repository root -> CommitMessageCache, for the repositories that enabled one
+
+
+def get_git_common_dir(repo_root):
+    """Returns the absolute path of the common .git directory of repo_root's worktrees."""
+    git_dir = run_git(
+        ["git", "rev-parse", "--git-common-dir"],
+        capture_output=True,
+        text=True,
+        check=True,
+        cwd=repo_root,
+    ).stdout.strip()
+    # Reported relative to repo_root, unless it lies elsewhere
+    return os.path.join(repo_root, git_dir)
+
+def enable_message_cache(repo_root):
+    """
+    Opens the persistent commit message cache of repo_root.
+    Returns the cache, or None if it could not be opened.
+    """
+    with _shared_helpers_lock:
+        if repo_root in _message_caches:
+            return _message_caches[repo_root]
+        try:
+            cache = CommitMessageCache(os.path.join(get_git_common_dir(repo_root), "filestamp-message-cache.sqlite"))
+        except (subprocess.CalledProcessError, sqlite3.Error) as e:
+            print(f"Warning: Could not open the commit message cache, continuing without it: {e}")
+            return None
+        _message_caches[repo_root] = cache
+    atexit.register(cache.close)
+    return cache
+
+
+def print_message_cache_summary(repo_root):
+    """Prints the hit/miss counters of the commit message cache of repo_root, if it was used."""
+    cache = _message_caches.get(repo_root)
+    if cache is not None and (cache.hits or cache.misses):
+        print(f"Commit message cache: {cache.hits} hits, {cache.misses} misses.")
+
+
+def get_message_cache_key(repo_root, file_paths):
+    """
+    Returns the cache key for committing the current contents of file_paths,
+    based on their blob object names before and after the change.
+    Deleted files have no new blob. Raises OSError if a file cannot be hashed.
+    """
+    present_paths = [file_path for file_path in file_paths if os.path.lexists(file_path)]
+    present_blobs = dict(zip(present_paths, get_blob_hasher(repo_root).hash_paths(present_paths)))
+    new_blobs = []
+    for file_path in file_paths:
+        if file_path not in present_blobs:
+            new_blobs.append("-")
+        elif present_blobs[file_path] is None:
+            raise OSError(f"could not hash {file_path}")
+        else:
+            new_blobs.append(present_blobs[file_path])
+    status_index = get_status_index(repo_root)
+    blob_pairs = [(status_index.head_blob(file_path), new_blob) for file_path, new_blob in zip(file_paths, new_blobs)]
+    return CommitMessageCache.make_key(blob_pairs)
+
+# Maximum number of paths passed to a single git command line
+GIT_PATHS_PER_COMMAND = 1000
+
+
+def _chunks(items, size=GIT_PATHS_PER_COMMAND):
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+
+def _commit_chunks(commits, size=GIT_PATHS_PER_COMMAND):
+    # Reads (files, datetime) commits lazily into lists of at least size files (but the last)
+    chunk = []
+    file_count = 0
+    for commit in commits:
+        chunk.append(commit)
+        file_count += len(commit[0])
+        if file_count >= size:
+            yield chunk
+            chunk = []
+            file_count = 0
+    if chunk:
+        yield chunk
+
+# Environment for read-only git commands that may run while another thread commits.
+# Without it, commands like `git diff` opportunistically take the index lock.
+READ_ONLY_GIT_ENV = dict(os.environ, GIT_OPTIONAL_LOCKS="0")
+
+_http_session = None
+_http_session_lock = threading.Lock()
+
+
+def get_http_session():
+    """
+    Returns the shared requests.Session used for AI API calls, so concurrent
+    requests reuse a pool of keep-alive connections.
+    """
+    global _http_session
+    import_requests()
+    with _http_session_lock:
+        if _http_session is None:
+            _http_session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=AI_CONCURRENCY)
+            _http_session.mount("http://", adapter)
+            _http_session.mount("https://", adapter)
+        return _http_session
+
+def post_api_request(headers, data):
+    """
+    Posts a request to the API through the shared session, timed for --profile.
+    Streamed requests return as soon as the response headers have arrived.
+    """
+    stream = bool(data.get("stream"))
+    if _profiler is None:
+        return get_http_session().post(API_ENDPOINT, headers=headers, json=data, timeout=30, stream=stream)
+    started = time.perf_counter()
+    try:
+        return get_http_session().post(API_ENDPOINT, headers=headers, json=data, timeout=30, stream=stream)
+    finally:
+        _profiler.record_api(time.perf_counter() - started)
+
+
+class TokenBucket:
+    """
+    Token bucket refilled continuously at rate_per_minute, holding at most one
+    minute's worth. A rate of 0 disables the limit.
+    """
+
+    def __init__(self, rate_per_minute):
+        self.rate_per_second = rate_per_minute / 60.0
+        self.capacity = float(rate_per_minute)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+
+    def reserve(self, amount):
+        """
+        Takes amount tokens and returns how many seconds the caller must wait
+        before using them. Not thread-safe; callers hold a lock. An amount larger
+        than the bucket only waits for a full bucket, so it never blocks forever.
+        """
+        if not self.rate_per_second:
+            return 0.0
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate_per_second)
+        self.updated = now
+        self.tokens -= min(amount, self.capacity)
+        if self.tokens >= 0:
+            return 0.0
+        return -self.tokens / self.rate_per_second
+
+
+class CompletionClient:
+    """
+    Sends API requests under the provider's rate limits. Requests and estimated
+    tokens per minute are limited with token buckets. Throttled (429) and
+    server-side (5xx) failures are retried with exponential backoff and jitter,
+    honouring Retry-After. The number of requests in flight shrinks by half on
+    throttling and grows back by one after a run of successes.
+    """
+
+    RETRY_STATUS_CODES = {408, 409, 429, 500, 502, 503, 504}
+    BACKOFF_BASE_SECONDS = 1.0
+    BACKOFF_MAX_SECONDS = 60.0
+    # Successes needed before one more request may be in flight
+    GROW_AFTER_SUCCESSES = 8
+
+    def __init__(self, max_concurrency=None, requests_per_minute=None, tokens_per_minute=None, max_retries=None):
+        # Settings not given are taken from the configuration
+        self.max_concurrency = AI_CONCURRENCY if max_concurrency is None else max_concurrency
+        self.concurrency = self.max_concurrency
+        self.max_retries = AI_MAX_RETRIES if max_retries is None else max_retries
+        self._request_bucket = TokenBucket(AI_REQUESTS_PER_MINUTE if requests_per_minute is None else requests_per_minute)
+        self._token_bucket = TokenBucket(AI_TOKENS_PER_MINUTE if tokens_per_minute is None else tokens_per_minute)
+        self._condition = threading.Condition()
+        self._in_flight = 0
+        self._successes = 0
+        self._paused_until = 0.0 # Set from Retry-After, holds back every thread
+        self.requests = 0
+        self.retries = 0
+        self.throttled = 0
+        self.server_errors = 0
+        self.failures = 0
+        self.wait_seconds = 0.0
+
+    def _acquire(self, estimated_tokens):
+        with self._condition:
+            while self._in_flight >= self.concurrency:
+                self._condition.wait()
+            self._in_flight += 1
+            delay = max(
+                self._paused_until - time.monotonic(),
+                self._request_bucket.reserve(1),
+                self._token_bucket.reserve(estimated_tokens),
+            )
+        if delay > 0:
+            with self._condition:
+                self.wait_seconds += delay
+            time.sleep(delay)
+
+    def _release(self, throttled, failed=False):
+        with self._condition:
+            self._in_flight -= 1
+            if throttled:
+                self._successes = 0
+                self.concurrency = max(1, self.concurrency // 2)
+            elif not failed:
+                self._successes += 1
+                if self._successes >= self.GROW_AFTER_SUCCESSES and self.concurrency < self.max_concurrency:
+                    self._successes = 0
+                    self.concurrency += 1
+            self._condition.notify_all()
+
+    @staticmethod
+    def _retry_after_seconds(response):
+        # Retry-After is either a number of seconds or an HTTP date
+        value = response.headers.get("Retry-After") if response is not None else None
+        if not value:
+            return None
+        try:
+            return max(0.0, float(value))
+        except ValueError:
+            pass
+        try:
+            retry_at = email.utils.parsedate_to_datetime(value)
+        except (TypeError, ValueError):
+            return None
+        return max(0.0, retry_at.timestamp() - time.time())
+
+    def _backoff_seconds(self, attempt):
+        # Full jitter: a random delay up to the exponential bound
+        return random.uniform(0, min(self.BACKOFF_MAX_SECONDS, self.BACKOFF_BASE_SECONDS * 2 ** attempt))
+
+    def post(self, headers, data, estimated_tokens):
+        """
+        Posts data to the API, retrying throttled, failed and timed-out requests.
+        Returns the successful response. Raises requests.exceptions.RequestException
+        once the retries are used up or for errors that retrying cannot fix.
+        """
+        import_requests()
+        attempt = 0
+        while True:
+            self._acquire(estimated_tokens)
+            response = None
+            error = None
+            try:
+                with self._condition:
+                    self.requests += 1
+                response = post_api_request(headers, data)
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+                error = e
+            finally:
+                # Any other error (e.g. an invalid URL) is raised, but must not keep the slot
+                self._release(response is not None and response.status_code == 429, failed=response is None)
+            throttled = response is not None and response.status_code == 429
+
+            retryable = error is not None or response.status_code in self.RETRY_STATUS_CODES
+            if not retryable:
+                response.raise_for_status()
+                return response
+
+            with self._condition:
+                if throttled:
+                    self.throttled += 1
+                elif response is not None:
+                    self.server_errors += 1
+            if attempt >= self.max_retries:
+                with self._condition:
+                    self.failures += 1
+                if error is not None:
+                    raise error
+                response.raise_for_status()
+
+            delay = self._retry_after_seconds(response)
+            if delay is None:
+                delay = self._backoff_seconds(attempt)
+            elif throttled:
+                # The provider asked everyone to wait, not just this request
+                with self._condition:
+                    self._paused_until = max(self._paused_until, time.monotonic() + delay)
+            with self._condition:
+                self.retries += 1
+                self.wait_seconds += delay
+            reason = f"HTTP {response.status_code}" if response is not None else type(error).__name__
+            print(f"AI request failed ({reason}), retrying in {delay:.1f}s (attempt {attempt + 2} of {self.max_retries + 1}).")
+            time.sleep(delay)
+            attempt += 1
+
+    def counters(self):
+        return {
+            "requests": self.requests,
+            "retries": self.retries,
+            "throttled": self.throttled,
+            "server_errors": self.server_errors,
+            "failures": self.failures,
+            "wait_seconds": round(self.wait_seconds, 3),
+        }
+
+    def summary(self):
+        return (
+            f"AI requests: {self.requests} sent, {self.retries} retried "
+            f"({self.throttled} throttled, {self.server_errors} server errors), "
+            f"{self.failures} gave up, {self.wait_seconds:.1f}s spent waiting, "
+            f"concurrency {self.concurrency}/{self.max_concurrency}."
+        )
+
+
+_completion_client = None
+_completion_client_lock = threading.Lock()
+
+
+def get_completion_client():
+    """Returns the shared CompletionClient, so all threads share one set of rate limits."""
+    global _completion_client
+    with _completion_client_lock:
+        if _completion_client is None:
+            _completion_client = CompletionClient()
+        return _completion_client
+
+
+def reset_completion_client():
+    """Drops the shared CompletionClient, so the next request uses the current limits."""
+    global _completion_client
+    with _completion_client_lock:
+        _completion_client = None
+
+
+def print_api_summary():
+    if _completion_client is not None and _completion_client.requests:
+        print(_completion_client.summary())
+
+
+def ai_is_configured():
+    """Returns True if the API settings needed for AI commit messages are present."""
+    return bool(API_ENDPOINT and API_KEY and MODEL)
+
+# Number of characters of a new file shown to the AI
+NEW_FILE_PREVIEW_CHARS = 500
+
+# Like git, treat files with a NUL byte in their first 8000 bytes as binary
+BINARY_SNIFF_BYTES = 8000
+
+
+def read_limited_output(args, limit, env=None, cwd=None):
+    """
+    Runs a command and reads at most limit bytes of its standard output, killing
+    the command once that much has been read instead of waiting for the rest.
+    Returns an (output, truncated) tuple. Raises subprocess.CalledProcessError
+    if the command fails before the limit is reached.
+    """
+    process = popen_git(args, stdout=subprocess.PIPE, stderr=subprocess.PIPE, env=env, cwd=cwd)
+    try:
+        output = b""
+        while len(output) < limit:
+            chunk = process.stdout.read1(min(65536, limit - len(output)))
+            if not chunk:
+                break
+            output += chunk
+        if len(output) >= limit and process.poll() is None:
+            process.kill()
+            process.wait()
+            return output, True
+        stderr = process.stderr.read()
+        if process.wait() != 0:
+            raise subprocess.CalledProcessError(process.returncode, args, output, stderr)
+        return output, False
+    finally:
+        finish_git(process)
+        process.stdout.close()
+        process.stderr.close()
+
+def read_file_preview(file_path, char_limit):
+    """
+    Reads the start of a file for display, without reading the rest of it.
+    Returns a (text, file_size) tuple; text is None if the file looks binary.
+    """
+    with open(file_path, "rb") as f:
+        file_size = os.fstat(f.fileno()).st_size
+        # UTF-8 needs at most 4 bytes per character
+        prefix = f.read(max(BINARY_SNIFF_BYTES, char_limit * 4))
+    if b"\0" in prefix[:BINARY_SNIFF_BYTES]:
+        return None, file_size
+    decoder = codecs.getincrementaldecoder("utf-8")()
+    try:
+        # final=False tolerates a character cut in half at the end of the prefix
+        text = decoder.decode(prefix, final=False)
+    except UnicodeDecodeError:
+        return None, file_size
+    return text[:char_limit], file_size
+
+# The diff is read up to this many times DIFF_CHAR_LIMIT characters, so that
+# hunks beyond the first files can still be chosen for the prompt
+DIFF_READ_FACTOR = 8
+
+# Lines of unchanged context git shows around each change in prompts
+DIFF_CONTEXT_LINES = 1
+
+# Words and punctuation characters with the space before them, groups of up to
+# three digits and other runs of whitespace: roughly the pieces BPE tokenizers
+# split code and prose into
+_TOKEN_PATTERN = re.compile(r" ?[^\W\d_]+| ?[^\s\w]|\d{1,3}|\s+|_")
+
+
+def estimate_tokens(text):
+    """
+    Approximates how many tokens text takes, without loading a tokenizer: a token
+    per six letters of a word, and one per digit group, punctuation character and
+    run of whitespace.
+    """
+    count = 0
+    for piece in _TOKEN_PATTERN.findall(text):
+        letters = len(piece.lstrip(" "))
+        count += (letters + 5) // 6 if piece[-1].isalpha() else 1
+    return count
+
+
+def read_diffstat(repo_root, file_paths, diff_base=None):
+    """
+    Reads `git diff --numstat` for file_paths, one git command per chunk of paths.
+    The staged changes are used by default; if diff_base is given, the working
+    tree is compared against it. Returns a dict mapping paths relative to the
+    repository root to (added, deleted) line counts, or to None for binary files.
+    """
+    diffstat = {}
+    diff_source = ["--cached"] if diff_base is None else [diff_base]
+    for chunk in _chunks(relative_paths(file_paths, repo_root)):
+        try:
+            result = run_git(
+                ["git", "diff", "--numstat", "-z", "--no-renames"] + diff_source + ["--"] + chunk,
+                capture_output=True,
+                check=True,
+                env=READ_ONLY_GIT_ENV,
+                cwd=repo_root,
+            )
+        except subprocess.CalledProcessError as e:
+            print(f"Warning: Could not read the diffstat: {e.stderr.decode(errors='replace').strip()}")
+            continue
+        for record in result.stdout.split(b"\0"):
+            fields = record.decode("utf-8", errors="surrogateescape").split("\t", 2)
+            if len(fields) != 3:
+                continue
+            added, deleted, path = fields
+            diffstat[path] = None if added == "-" else (int(added), int(deleted))
+    return diffstat
+
+
+# Header lines of a file's diff that are worth showing; index and ---/+++ lines
+# only repeat what the `diff --git` line says
+_DIFF_HEADER_PREFIXES = ("diff --git ", "new file mode", "deleted file mode", "old mode", "new mode", "rename from", "rename to", "Binary files")
+
+
+def parse_diff(diff_text, complete=True):
+    """
+    Splits git diff output into one dict per file, with the keys 'path', 'header'
+    (the header lines worth showing), 'hunks' (lists of lines, each starting with
+    its @@ line) and 'diffstat' ((added, deleted) line counts, None if binary).
+    If the output is not complete, its last, possibly cut, line is dropped.
+    """
+    lines = diff_text.split("\n")
+    if not complete:
+        lines = lines[:-1]
+    diff_files = []
+    diff_file = None
+    for line in lines:
+        if line.startswith("diff --git "):
+            diff_file = {"path": None, "header": [line], "hunks": [], "diffstat": (0, 0)}
+            diff_files.append(diff_file)
+        elif diff_file is None:
+            continue
+        elif line.startswith("@@"):
+            diff_file["hunks"].append([line])
+        elif diff_file["hunks"]:
+            diff_file["hunks"][-1].append(line)
+            if line.startswith("+"):
+                diff_file["diffstat"] = (diff_file["diffstat"][0] + 1, diff_file["diffstat"][1])
+            elif line.startswith("-"):
+                diff_file["diffstat"] = (diff_file["diffstat"][0], diff_file["diffstat"][1] + 1)
+        elif line.startswith("+++ ") or line.startswith("--- "):
+            # The new path, or the old one for deleted files
+            if line[4:] != "/dev/null" and (diff_file["path"] is None or line.startswith("+++ ")):
+                diff_file["path"] = line[6:] if line[4:6] in ("a/", "b/") else line[4:]
+        elif line.startswith(_DIFF_HEADER_PREFIXES):
+            diff_file["header"].append(line)
+            if line.startswith("Binary files"):
+                diff_file["diffstat"] = None
+
+    for diff_file in diff_files:
+        if diff_file["path"] is None:
+            # No ---/+++ lines for binary files or mode changes; take the path from `diff --git a/x b/x`
+            header = diff_file["header"][0][len("diff --git "):]
+            middle = header.find(" b/")
+            diff_file["path"] = header[middle + 3:] if middle != -1 else header
+    return diff_files
+
+
+# Changed lines that define something, in most languages
+_SIGNATURE_PATTERN = re.compile(
+    r"[+-]\s*(?:(?:export|public|private|protected|static|async|abstract|pub|default)\s+)*"
+    r"(?:def|class|function|func|fn|interface|struct|enum|trait|impl|module|type|#define|create\s+table)\b",
+    re.IGNORECASE,
+)
+
+
+def _hunk_salience(hunk):
+    # Hunks that change more lines, and lines that define things, say more about a change
+    changed = 0
+    signatures = 0
+    for line in hunk[1:]:
+        if line.startswith(("+", "-")):
+            changed += 1
+            if _SIGNATURE_PATTERN.match(line):
+                signatures += 1
+    return min(changed, 40) + 8 * signatures
+
+
+def _truncate_hunk(hunk, token_budget):
+    # The start of a hunk too large for the budget, marked as cut
+    kept = [hunk[0]]
+    used = estimate_tokens(hunk[0]) + 2
+    for line in hunk[1:]:
+        used += estimate_tokens(line) + 1
+        if used > token_budget:
+            break
+        kept.append(line)
+    if len(kept) < 3:
+        return None
+    return kept + [" ..."]
+
+
+def compact_diff(diff_files, token_budget):
+    """
+    Shortens the files parsed by parse_diff() to about token_budget tokens by
+    keeping the most salient hunks: those that change more lines and touch
+    definitions. Hunks are chosen from every file in turn, best first, so that
+    changes spread over many files are all represented, and are shown in their
+    original order. Returns a (diff_text, omitted_hunks) tuple.
+    """
+    remaining = token_budget
+    selected = {} # file number -> set of chosen hunk numbers
+    truncated = {} # (file number, hunk number) -> shortened hunk
+    candidates = []
+    omitted_hunks = 0
+    for file_number, diff_file in enumerate(diff_files):
+        header_tokens = estimate_tokens("\n".join(diff_file["header"])) + 1
+        hunks = [
+            (_hunk_salience(hunk), hunk_number, estimate_tokens("\n".join(hunk)) + 1)
+            for hunk_number, hunk in enumerate(diff_file["hunks"])
+        ]
+        # Best first; among equals, earlier hunks first
+        hunks.sort(key=lambda candidate: (-candidate[0], candidate[1]))
+        candidates.append(collections.deque(hunks))
+        if not hunks and header_tokens <= remaining:
+            # Binary files and mode changes only have a header
+            selected[file_number] = set()
+            remaining -= header_tokens
+
+    # Round-robin over the files: each round offers every file's next best hunk
+    while any(candidates):
+        offers = [(hunks[0][0], file_number) for file_number, hunks in enumerate(candidates) if hunks]
+        offers.sort(key=lambda offer: (-offer[0], offer[1]))
+        for _, file_number in offers:
+            _, hunk_number, hunk_tokens = candidates[file_number].popleft()
+            first_of_file = file_number not in selected
+            # The header is paid for with the file's first hunk, with room for a note of left out hunks
+            header_tokens = estimate_tokens("\n".join(diff_files[file_number]["header"])) + 12 if first_of_file else 0
+            if hunk_tokens + header_tokens <= remaining:
+                selected.setdefault(file_number, set()).add(hunk_number)
+                remaining -= hunk_tokens + header_tokens
+                continue
+            if first_of_file and remaining > header_tokens:
+                # Show at least the start of a file's best hunk rather than nothing of the file
+                hunk = _truncate_hunk(diff_files[file_number]["hunks"][hunk_number], remaining - header_tokens)
+                if hunk is not None:
+                    selected[file_number] = {hunk_number}
+                    truncated[(file_number, hunk_number)] = hunk
+                    remaining -= estimate_tokens("\n".join(hunk)) + 1 + header_tokens
+                    continue
+            omitted_hunks += 1
+
+    parts = []
+    for file_number, diff_file in enumerate(diff_files):
+        if file_number not in selected:
+            continue
+        parts.extend(diff_file["header"])
+        for hunk_number, hunk in enumerate(diff_file["hunks"]):
+            if hunk_number in selected[file_number]:
+                parts.extend(truncated.get((file_number, hunk_number), hunk))
+        left_out = len(diff_file["hunks"]) - len(selected[file_number])
+        if left_out:
+            parts.append(f"(... {left_out} more hunks of this file not shown)")
+    return "\n".join(parts) + ("\n" if parts else ""), omitted_hunks
+
+
+def format_diffstat_summary(diffstat, new_paths, token_budget):
+    """
+    Lists every changed file with its added and removed line counts, followed by
+    new_paths as new files, in at most about token_budget tokens.
+    """
+    lines = []
+    for path, counts in diffstat.items():
+        lines.append(f"{path} | binary" if counts is None else f"{path} | +{counts[0]} -{counts[1]}")
+    lines.extend(f"{path} | new file" for path in new_paths)
+
+    summary = "Changed files (lines added and removed):\n"
+    used = estimate_tokens(summary)
+    for position, line in enumerate(lines):
+        used += estimate_tokens(line) + 1
+        if used > token_budget and position:
+            summary += f"(... and {len(lines) - position} more files)\n"
+            break
+        summary += line + "\n"
+    return summary + "\n"
+
+
+def get_change_summary(repo_root, file_paths, diff_base=None):
+    """
+    Collects the changes a commit message should describe: the git diff of
+    file_paths, or the content of new files. The staged changes are used by
+    default; if diff_base is given, the working tree is compared against that
+    commit instead, so the files do not need to be staged. The result starts
+    with a summary of every changed file, and the diff is compacted to what
+    fits in DIFF_TOKEN_LIMIT tokens. Returns a (diff_output, truncated_notice)
+    tuple, or (None, None) if git failed.
+    """
+    read_limit = DIFF_CHAR_LIMIT * DIFF_READ_FACTOR
+    try:
+        # Get the staged changes (diff) for the specified files
+        # Using --cached to get staged changes, and -- to separate paths from revision
+        diff_source = ["--cached"] if diff_base is None else [diff_base]
+        diff_output = ""
+        diff_truncated = False
+        # Large groups are diffed in chunks, stopping once there is more than we can choose from.
+        # Only one character past the limit is read, so a huge diff is never held in memory.
+        for chunk in _chunks(file_paths):
+            output, diff_truncated = read_limited_output(
+                ["git", "diff", f"--unified={DIFF_CONTEXT_LINES}"] + diff_source + ["--"] + chunk,
+                read_limit + 1 - len(diff_output),
+                env=READ_ONLY_GIT_ENV,
+                cwd=repo_root,
+            )
+            diff_output += output.decode("utf-8", errors="replace")
+            if diff_truncated or len(diff_output) > read_limit:
+                diff_truncated = True
+                break
+        diff_files = parse_diff(diff_output, complete=not diff_truncated)
+        if diff_truncated:
+            # Files past the read limit are missing from the diff, so git counts their lines
+            diffstat = read_diffstat(repo_root, file_paths, diff_base)
+        else:
+            diffstat = {diff_file["path"]: diff_file["diffstat"] for diff_file in diff_files}
+    except subprocess.CalledProcessError as e:
+        print(f"Error getting git diff: {e.stderr.decode(errors='replace')}")
+        return None, None # Signal failure to trigger fallback
+    except FileNotFoundError:
+        print("Error: git command not found. Is Git installed and in your PATH?")
+        return None, None # Signal failure to trigger fallback
+
+    # Untracked files never show up in a diff against a commit, so their content is read instead
+    if diff_base is not None:
+        new_file_paths = [file_path for file_path in file_paths if get_status_index(repo_root).status(file_path) == "??"]
+    else:
+        new_file_paths = []
+
+    if not diff_files and not new_file_paths:
+        # If there are no staged changes, it might be a new file.
+        # Check for added or untracked files in the status snapshot
+        new_file_paths = [file_path for file_path in file_paths if is_file_new(repo_root, file_path)]
+        if not new_file_paths:
+            return "No staged changes detected for the specified files.", ""
+
+    # The summary names every file, so the diff can leave out the less telling hunks
+    summary = format_diffstat_summary(diffstat, relative_paths(new_file_paths, repo_root), DIFF_TOKEN_LIMIT // 4)
+    remaining_tokens = DIFF_TOKEN_LIMIT - estimate_tokens(summary)
+    compacted_diff, omitted_hunks = compact_diff(diff_files, remaining_tokens)
+    remaining_tokens -= estimate_tokens(compacted_diff)
+    diff_output = summary + compacted_diff
+
+    # Each kind of truncation adds its own note, so none hides another
+    notes = []
+    if diff_truncated or omitted_hunks:
+        notes.append("Note: The git diff was too long; only its most significant changes are shown.\n")
+
+    if new_file_paths:
+        # For new files, we'll read their content as a fallback
+        file_contents = ""
+        for position, file_path in enumerate(new_file_paths):
+            if remaining_tokens <= 0:
+                file_contents += f"(... and {len(new_file_paths) - position} more new files)\n"
+                notes.append("Note: The list of new files was too long and has been truncated.\n")
+                break
+            try:
+                content, file_size = read_file_preview(file_path, NEW_FILE_PREVIEW_CHARS)
+                if content is None:
+                    # File is binary, note this and skip content reading
+                    entry = f"--- New File: {os.path.basename(file_path)} ---\n(Binary file - content not displayed)\n\n"
+                else:
+                    # Note when the new file content is too long to be shown in full
+                    content_note = "Note: The new file content was too long and has been truncated.\n"
+                    if file_size > DIFF_CHAR_LIMIT and content_note not in notes:
+                        notes.append(content_note)
+                    entry = f"--- New File: {os.path.basename(file_path)} ---\n{content}...\n\n"
+            except Exception as e:
+                print(f"Warning: Could not read new file {file_path}: {e}")
+                entry = f"--- New File: {os.path.basename(file_path)} ---\n(Could not read file content)\n\n"
+            file_contents += entry
+            remaining_tokens -= estimate_tokens(entry)
+        diff_output += file_contents
+
+    return diff_output, "".join(notes)
+
+def _first_complete_line(text):
+    # The first finished line with more than a code fence or quotes on it, or None
+    for line in text.split("\n")[:-1]:
+        line = line.strip().strip('"').strip()
+        if line and not line.startswith("```"):
+            return line
+    return None
+
+def read_streamed_reply(response, stop_after_first_line=False):
+    """
+    Reads a streamed chat completion (server-sent events) as it arrives and
+    returns its text. With stop_after_first_line, the connection is closed as
+    soon as the first line of the reply is complete, and only that line is
+    returned, so the model's further output is neither waited for nor paid for.
     """
+    # Event streams often declare no charset; the API always sends UTF-8
+    response.encoding = "utf-8"
+    parts = []
+    try:
+        for line in response.iter_lines(chunk_size=None, decode_unicode=True):
+            if not line.startswith("data:"):
+                continue
+            payload = line[len("data:"):].strip()
+            if payload == "[DONE]":
+                break
+            try:
+                event = json.loads(payload)
+            except ValueError:
+                continue
+            choices = event.get("choices") or [{}]
+            content = (choices[0].get("delta") or {}).get("content")
+            if not content:
+                continue
+            parts.append(content)
+            if stop_after_first_line and "\n" in content:
+                first_line = _first_complete_line("".join(parts))
+                if first_line is not None:
+                    return first_line
+    finally:
+        response.close()
+    return "".join(parts)
 
+def request_completion(prompt, max_tokens=None, single_line=False):
+    """
+    Sends a prompt to the OpenAI-compatible API, within the configured rate limits
+    and retrying throttled or failed requests. max_tokens defaults to AI_MAX_TOKENS.
+    With AI_STREAM set, the reply is streamed, and with single_line the request
+    ends as soon as the first line of the reply has arrived.
+    Returns the text of the reply, or None if the request failed.
+    """
+    if max_tokens is None:
+        max_tokens = AI_MAX_TOKENS
     headers = {
         "Authorization": f"Bearer {API_KEY}",
         "Content-Type": "application/json",
@@ -264,22 +2240,25 @@ def generate_commit_message_with_ai(file_paths):
     data = {
         "model": MODEL,
         "messages": [
-            {"role": "system", "content": "You are an expert assistant that generates concise and descriptive Git commit messages following conventional commit formats. Be brief in your reasoning and prioritize generating the commit message itself."},
+            {"role": "system", "content": SYSTEM_PROMPT},
             {"role": "user", "content": prompt}
         ],
-        "max_tokens": 600, # Significantly increased max_tokens
+        "max_tokens": max_tokens,
         "temperature": 0.5,
     }
+    if AI_STREAM:
+        data["stream"] = True
 
+    # The prompt, plus the reply the model may write
+    estimated_tokens = estimate_tokens(SYSTEM_PROMPT) + estimate_tokens(prompt) + max_tokens
+
+    import_requests() # Needed by the except clauses below
     try:
-        response = requests.post(API_ENDPOINT, headers=headers, json=data, timeout=30)
-        response.raise_for_status()  # Raise an exception for HTTP errors
+        response = get_completion_client().post(headers, data, estimated_tokens) # Raises for HTTP errors
+        if AI_STREAM:
+            return read_streamed_reply(response, stop_after_first_line=single_line).strip()
         response_json = response.json()
-        message = response_json.get("choices", [{}])[0].get("message", {}).get("content", "").strip()
-        # Clean up common AI artifacts like quotes or extra newlines
-        message = re.sub(r'^"|"$', '', message) # Remove leading/trailing quotes
-        message = re.sub(r'\n+', ' ', message) # Replace multiple newlines with a space
-        return message if message else None
+        return response_json.get("choices", [{}])[0].get("message", {}).get("content", "").strip()
     except requests.exceptions.RequestException as e:
         print(f"Error calling AI API: {e}")
         if hasattr(e, 'response') and e.response is not None:
@@ -296,29 +2275,485 @@ def generate_commit_message_with_ai(file_paths):
         print(f"An unexpected error occurred during AI message generation: {e}")
         return None # Return None to indicate failure and trigger fallback
 
+def clean_commit_message(message):
+    """Cleans up common AI artifacts in a generated message. Returns None if nothing is left."""
+    message = re.sub(r'^"|"$', '', message.strip()) # Remove leading/trailing quotes
+    message = re.sub(r'\n+', ' ', message) # Replace multiple newlines with a space
+    return message if message else None
+
+def parse_batch_reply(reply, count):
+    """
+    Parses the JSON array of messages expected in reply to a batched prompt.
+    Returns a list of count messages (None for unusable entries), or None if
+    the reply is not such an array.
+    """
+    # Models sometimes wrap the JSON in a code fence or add a sentence around it
+    start, end = reply.find("["), reply.rfind("]")
+    if start == -1 or end < start:
+        return None
+    try:
+        items = json.loads(reply[start:end + 1])
+    except ValueError:
+        return None
+    if not isinstance(items, list) or len(items) != count:
+        return None
+    return [clean_commit_message(item) if isinstance(item, str) else None for item in items]
+
+def prepare_commit_prompt(repo_root, file_paths, diff_base=None):
+    """
+    Collects what is needed to generate the commit message for file_paths: the
+    message of a commit that only moves or copies files, or a cached message if
+    there is one, otherwise the diff or new-file content to send to the API.
+    Returns a dict with the keys 'repo_root', 'files', 'cache_key', 'message',
+    'diff_output' and 'truncated_notice'. 'cache_key' identifies the content
+    being committed and 'diff_output' is None if the changes could not be read.
+    """
+    prompt_input = {"repo_root": repo_root, "files": file_paths, "cache_key": None, "message": None, "diff_output": None, "truncated_notice": ""}
+
+    # A pure move has no changes worth a request
+    prompt_input["message"] = HeuristicMessageEngine(repo_root, diff_base).move_message(file_paths)
+    if prompt_input["message"] is not None:
+        return prompt_input
+
+    try:
+        prompt_input["cache_key"] = get_message_cache_key(repo_root, file_paths)
+    except (subprocess.CalledProcessError, OSError) as e:
+        print(f"Warning: Could not hash {file_paths}: {e}")
+    else:
+        cache = _message_caches.get(repo_root)
+        if cache is not None:
+            prompt_input["message"] = cache.get(prompt_input["cache_key"])
+            if prompt_input["message"] is not None:
+                return prompt_input
+
+    prompt_input["diff_output"], prompt_input["truncated_notice"] = get_change_summary(repo_root, file_paths, diff_base)
+    return prompt_input
+
+def _needs_request(prompt_input):
+    return prompt_input["message"] is None and prompt_input["diff_output"] is not None
+
+def _store_generated_message(prompt_input, message):
+    prompt_input["message"] = message
+    cache = _message_caches.get(prompt_input["repo_root"])
+    if message and prompt_input["cache_key"] is not None and cache is not None:
+        cache.put(prompt_input["cache_key"], message)
+
+def complete_commit_prompt(prompt_input):
+    """
+    Generates the message for one prepared commit with its own API request, unless it already has one.
+    Returns the message, or None if AI generation failed.
+    """
+    if _needs_request(prompt_input):
+        prompt = PROMPT_TEMPLATE.format(truncated_notice=prompt_input["truncated_notice"], diff_output=prompt_input["diff_output"])
+        # Only the subject line is used, so a streamed reply can stop after it
+        reply = request_completion(prompt, single_line=True)
+        _store_generated_message(prompt_input, clean_commit_message(reply) if reply else None)
+    return prompt_input["message"]
+
+def complete_commit_prompt_batch(prompt_inputs):
+    """
+    Generates the messages for several prepared commits with a single API request
+    that asks for a JSON array of messages. Commits whose message cannot be taken
+    from the reply fall back to a request of their own.
+    Returns the list of messages in order, None where AI generation failed.
+    """
+    to_generate = [prompt_input for prompt_input in prompt_inputs if _needs_request(prompt_input)]
+    if len(to_generate) > 1:
+        commits_text = "".join(
+            f"### Commit {number}\n{prompt_input['truncated_notice']}{prompt_input['diff_output']}\n\n"
+            for number, prompt_input in enumerate(to_generate, 1)
+        )
+        prompt = BATCH_PROMPT_TEMPLATE.format(count=len(to_generate), commits=commits_text)
+        # Leave room for every message in the reply
+        reply = request_completion(prompt, max_tokens=max(AI_MAX_TOKENS, 80 * len(to_generate)))
+        messages = parse_batch_reply(reply, len(to_generate)) if reply else None
+        if messages is None:
+            print(f"Warning: Could not use the batched AI reply, generating {len(to_generate)} messages one by one.")
+        else:
+            for prompt_input, message in zip(to_generate, messages):
+                if message:
+                    _store_generated_message(prompt_input, message)
+    return [complete_commit_prompt(prompt_input) for prompt_input in prompt_inputs]
+
+def generate_commit_message_with_ai(repo_root, file_paths, diff_base=None):
+    """
+    Generates a commit message using an OpenAI-compatible API based on git diff.
+    The staged changes are used by default; if diff_base is given, the working tree
+    is compared against that commit instead, so the files do not need to be staged.
+    Returns None if AI generation fails.
+    """
+    if not ai_is_configured():
+        print("Error: API_ENDPOINT, API_KEY, or MODEL not set in .env file.")
+        return None # Return None to indicate failure and trigger fallback
+
+    with profile_phase("message"):
+        return complete_commit_prompt(prepare_commit_prompt(repo_root, file_paths, diff_base))
+
+
+# Ways of writing commit messages: the API, local heuristics, or a plain date-based message
+MESSAGE_ENGINES = ("ai", "heuristic", "default")
+
+
+def default_commit_message(datetime_obj):
+    """Returns the simple date-based commit message of the 'default' message engine."""
+    return f"Adding files from {datetime_obj.date()}"
+
+
+# Conventional commit types recognized from paths, checked in this order
+DOC_EXTENSIONS = {".md", ".rst", ".txt", ".adoc", ".org"}
+DOC_NAMES = {"readme", "changelog", "changes", "license", "licence", "contributing", "authors", "notice"}
+DOC_DIRECTORIES = {"docs", "doc", "documentation"}
+TEST_DIRECTORIES = {"tests", "test", "__tests__", "spec", "specs"}
+CI_DIRECTORIES = {".github", ".circleci", ".gitlab"}
+CI_NAMES = {".gitlab-ci.yml", ".travis.yml", "jenkinsfile", "azure-pipelines.yml", "appveyor.yml"}
+BUILD_NAMES = {
+    "setup.py", "setup.cfg", "pyproject.toml", "requirements.txt", "package.json", "makefile",
+    "dockerfile", "cmakelists.txt", "cargo.toml", "go.mod", "pom.xml", "build.gradle", "gemfile",
+}
+LOCK_NAMES = {"package-lock.json", "yarn.lock", "pnpm-lock.yaml", "poetry.lock", "cargo.lock", "go.sum", "gemfile.lock", "pipfile.lock"}
+CONFIG_EXTENSIONS = {".ini", ".cfg", ".conf", ".toml", ".yml", ".yaml", ".json", ".env", ".example"}
+STYLE_EXTENSIONS = {".css", ".scss", ".sass", ".less"}
+ASSET_EXTENSIONS = {".png", ".jpg", ".jpeg", ".gif", ".svg", ".ico", ".webp", ".woff", ".woff2", ".ttf", ".mp3", ".mp4", ".pdf"}
+# Directories too generic to make a useful scope
+GENERIC_DIRECTORIES = {"src", "lib", "app", "pkg", "source", "include", "internal"}
+
+
+def classify_path(relative_path):
+    """
+    Returns the kind of change a path represents: 'docs', 'test', 'ci', 'build',
+    'deps', 'style', 'asset', 'config' or 'code'.
+    """
+    parts = relative_path.lower().split("/")
+    name = parts[-1]
+    directories = set(parts[:-1])
+    stem, extension = os.path.splitext(name)
+    if directories & CI_DIRECTORIES or name in CI_NAMES:
+        return "ci"
+    if directories & TEST_DIRECTORIES or stem.startswith("test_") or stem.endswith(("_test", ".test", ".spec")):
+        return "test"
+    if name in LOCK_NAMES:
+        return "deps"
+    if name in BUILD_NAMES or name.startswith("requirements") and extension == ".txt":
+        return "build"
+    if directories & DOC_DIRECTORIES or extension in DOC_EXTENSIONS or stem in DOC_NAMES:
+        return "docs"
+    if extension in STYLE_EXTENSIONS:
+        return "style"
+    if extension in ASSET_EXTENSIONS:
+        return "asset"
+    if extension in CONFIG_EXTENSIONS or name.startswith("."):
+        return "config"
+    return "code"
+
+
+class HeuristicMessageEngine:
+    """
+    Derives a conventional commit message from the paths of the files being
+    committed, whether they are new, and their diffstat, without calling the API.
+    The diffstat comes from `git diff --numstat`, run once per chunk of paths, so
+    messages for large backfills cost almost nothing. The staged changes are used
+    by default; if diff_base is given, the working tree is compared against it.
+    """
+
+    # Commit types of the path kinds that are not code
+    KIND_TYPES = {"docs": "docs", "test": "test", "ci": "ci", "build": "build", "style": "style"}
+
+    def __init__(self, repo_root, diff_base=None):
+        self.repo_root = repo_root
+        self.diff_base = diff_base
+        self._numstat = {} # relative path -> (added, deleted), None for binary or not in the diff
+
+    def load(self, file_paths):
+        """Reads the diffstat of all file_paths not loaded yet, in as few git commands as possible."""
+        unloaded_paths = [file_path for file_path in file_paths if self._relative_path(file_path) not in self._numstat]
+        for file_path in unloaded_paths:
+            self._numstat[self._relative_path(file_path)] = None
+        self._numstat.update(read_diffstat(self.repo_root, unloaded_paths, self.diff_base))
+
+    def clear(self):
+        """Forgets the diffstats loaded so far, so a long run does not keep one per file."""
+        self._numstat.clear()
 
-def commit_files(files, datetime_obj, author, author_email, use_ai_for_message=False):
-    print(f"Preparing to commit files: {files}")
-    for file in files:
-        subprocess.run(["git", "add", file], check=True)
+    def _relative_path(self, file_path):
+        return repo_relative_path(file_path, self.repo_root)
+
+    @staticmethod
+    def _module_name(relative_path):
+        directory, name = os.path.split(relative_path)
+        stem, extension = os.path.splitext(name)
+        if stem in ("__init__", "index", "mod", "main") and directory:
+            return os.path.basename(directory)
+        return name if extension not in (".py", ".js", ".ts", ".go", ".rs", ".rb", ".java", ".c", ".h", ".cpp") else stem
+
+    @staticmethod
+    def _scope(relative_paths):
+        directories = {os.path.dirname(path) for path in relative_paths}
+        if len(directories) != 1:
+            return ""
+        parts = [part for part in directories.pop().split("/") if part]
+        # The innermost directory that says more than e.g. "src"
+        for part in reversed(parts):
+            if part.lower() not in GENERIC_DIRECTORIES | TEST_DIRECTORIES | DOC_DIRECTORIES:
+                return f"({part})"
+        return ""
+
+    def _change_verb(self, relative_path, file_path, kind):
+        # How the file changed, judged from whether it is new and its add/delete ratio
+        if get_status_index(self.repo_root).is_new(file_path):
+            return "add"
+        stat = self._numstat.get(relative_path)
+        if stat is None or kind != "code":
+            return "update"
+        added, deleted = stat
+        if deleted == 0 and added > 0:
+            return "extend"
+        if deleted > 2 * added:
+            return "simplify"
+        if added + deleted <= 6:
+            return "fix"
+        return "update"
+
+    def move_message(self, file_paths):
+        """
+        Returns the commit message for a commit of file_paths that only moves or
+        copies files (see ContentIndex.find_moves()), or None if it does more.
+        """
+        moves = get_content_index(self.repo_root).find_moves(file_paths)
+        if not moves:
+            return None
+        kinds = {classify_path(self._relative_path(target)) for _, target, _ in moves}
+        kind = kinds.pop() if len(kinds) == 1 else "code"
+        commit_type = "refactor" if kind == "code" else self.KIND_TYPES.get(kind, "chore")
+        move_kinds = {move_kind for _, _, move_kind in moves}
+        verb = {"rename": "move", "copy": "copy"}[move_kinds.pop()] if len(move_kinds) == 1 else "move and copy"
+
+        if len(moves) == 1:
+            source, target = self._relative_path(moves[0][0]), self._relative_path(moves[0][1])
+            if verb == "move" and os.path.dirname(source) == os.path.dirname(target):
+                verb, source, target = "rename", os.path.basename(source), os.path.basename(target)
+            message = f"{commit_type}: {verb} {source} to {target}"
+            if len(message) > 72:
+                message = f"{commit_type}: {verb} {os.path.basename(target)}"
+            return message
+
+        target_directories = [os.path.dirname(self._relative_path(target)) for _, target, _ in moves]
+        common_directory = os.path.commonpath(target_directories) if all(target_directories) else ""
+        message = f"{commit_type}: {verb} {len(moves)} files"
+        if common_directory and len(message) + len(common_directory) + 5 <= 72:
+            message += f" to {common_directory}/"
+        return message
+
+    def message(self, file_paths):
+        """Returns the commit message for a commit of file_paths."""
+        move_message = self.move_message(file_paths)
+        if move_message is not None:
+            return move_message
+        self.load(file_paths)
+        relative_paths = [self._relative_path(file_path) for file_path in file_paths]
+        kinds = [classify_path(path) for path in relative_paths]
+        verbs = [self._change_verb(path, file_path, kind) for path, file_path, kind in zip(relative_paths, file_paths, kinds)]
+
+        kind_counts = collections.Counter(kinds)
+        if len(kind_counts) == 1:
+            kind = kinds[0]
+        elif "code" in kind_counts:
+            kind = "code"
+        else:
+            kind = kind_counts.most_common(1)[0][0]
+        verb = verbs[0] if len(set(verbs)) == 1 else "update"
+
+        if kind == "code":
+            commit_type = {"add": "feat", "extend": "feat", "simplify": "refactor", "fix": "fix"}.get(verb, "refactor")
+        else:
+            commit_type = self.KIND_TYPES.get(kind, "chore")
+        if kind == "deps":
+            return "chore: update dependencies"
+
+        names = [self._module_name(path) for path in relative_paths]
+        unique_names = sorted(set(names), key=names.index)
+        if len(unique_names) == 1:
+            subject = unique_names[0]
+        elif len(unique_names) <= 3:
+            subject = ", ".join(unique_names[:-1]) + " and " + unique_names[-1]
+        else:
+            subject = f"{len(unique_names)} files"
+        verb_text = {"fix": "adjust", "simplify": "simplify", "extend": "extend"}.get(verb, verb)
+
+        message = f"{commit_type}{self._scope(relative_paths)}: {verb_text} {subject}"
+        if len(message) > 72:
+            message = f"{commit_type}: {verb_text} {len(unique_names)} files"
+        return message
+
+
+def _bounded_map(executor, function, items, window):
+    # Like executor.map(), but submits lazily so at most `window` calls are in flight,
+    # and yields the results in input order.
+    pending = collections.deque()
+    for item in items:
+        pending.append(executor.submit(function, item))
+        if len(pending) >= window:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
+
+
+def _pack_prompt_batches(prompt_inputs, batch_size, token_budget):
+    # Groups consecutive prepared commits into batches of at most batch_size API
+    # requests and token_budget tokens of diff. Commits that already have a
+    # message ride along without counting, and a diff larger than the budget is
+    # sent on its own.
+    batch = []
+    batch_requests = 0
+    batch_tokens = 0
+    for prompt_input in prompt_inputs:
+        if _needs_request(prompt_input):
+            size = estimate_tokens(prompt_input["diff_output"])
+            if batch_requests and (batch_requests >= batch_size or batch_tokens + size > token_budget):
+                yield batch
+                batch, batch_requests, batch_tokens = [], 0, 0
+            batch_requests += 1
+            batch_tokens += size
+        batch.append(prompt_input)
+    if batch:
+        yield batch
+
+
+def prefetch_commit_messages(repo_root, commits, diff_base, concurrency=None, batch_size=None):
+    """
+    Generates AI commit messages on a pool of worker threads, running ahead of
+    the caller. commits is an iterable of (files, datetime) tuples. With a
+    batch_size above 1, the diffs of up to batch_size consecutive commits
+    (within DIFF_TOKEN_LIMIT tokens in total) share one API request.
+    concurrency and batch_size default to AI_CONCURRENCY and AI_BATCH_SIZE.
+    Yields (files, datetime, message) tuples in the original order;
+    message is None where AI generation failed. A commit with the same content
+    as an earlier one (the same blobs before and after) reuses its message.
+    """
+    concurrency = AI_CONCURRENCY if concurrency is None else concurrency
+    batch_size = AI_BATCH_SIZE if batch_size is None else batch_size
+    first_by_key = {} # cache key -> the first commit with that content, or its result once yielded
+    reused_count = 0
+
+    def prepare(commit):
+        files, datetime_obj = commit
+        with profile_phase("message"):
+            prompt_input = prepare_commit_prompt(repo_root, files, diff_base)
+        prompt_input["datetime"] = datetime_obj
+        return prompt_input
+
+    def share(prompt_inputs):
+        # Runs in input order, so the commit a duplicate waits for always comes first
+        for prompt_input in prompt_inputs:
+            key = prompt_input["cache_key"]
+            if _needs_request(prompt_input) and key is not None:
+                if key in first_by_key:
+                    prompt_input["same_as"] = first_by_key[key]
+                    prompt_input["diff_output"] = None # Nothing to send
+                else:
+                    first_by_key[key] = prompt_input
+            yield prompt_input
+
+    def generate(batch):
+        with profile_phase("message"):
+            messages = complete_commit_prompt_batch(batch)
+        return list(zip(batch, messages))
+
+    window = concurrency * 2
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        prompt_inputs = share(_bounded_map(executor, prepare, commits, window * batch_size))
+        batches = _pack_prompt_batches(prompt_inputs, batch_size, DIFF_TOKEN_LIMIT)
+        for results in _bounded_map(executor, generate, batches, window):
+            for prompt_input, message in results:
+                key = prompt_input["cache_key"]
+                if "same_as" in prompt_input:
+                    message = prompt_input["same_as"]["message"]
+                    reused_count += 1
+                elif first_by_key.get(key) is prompt_input:
+                    # Keep only the message, not the diff, for later duplicates
+                    first_by_key[key] = {"message": message}
+                yield prompt_input["files"], prompt_input["datetime"], message
+    if reused_count:
+        print(f"Reused AI messages for {reused_count} commits with the same content as an earlier commit.")
+
+
+def iter_commit_messages(repo_root, commits, message_engine, diff_base):
+    """
+    Pairs each (files, datetime) commit with a commit message written by
+    message_engine, one of MESSAGE_ENGINES. Where AI is not configured or
+    fails, the heuristic engine writes the message instead.
+    Yields (files, datetime, message) tuples in the original order.
+    """
+    if message_engine == "ai" and not ai_is_configured():
+        print("Error: API_ENDPOINT, API_KEY, or MODEL not set in .env file. Using heuristic commit messages.")
+        message_engine = "heuristic"
+
+    if message_engine == "default":
+        for files, datetime_obj in commits:
+            yield files, datetime_obj, default_commit_message(datetime_obj)
+        return
+
+    heuristic_engine = HeuristicMessageEngine(repo_root, diff_base)
+    if message_engine == "heuristic":
+        # One diffstat pass per chunk of commits instead of one per commit; the
+        # commits are read a chunk at a time, like the AI path streams them
+        for chunk in _commit_chunks(commits):
+            heuristic_engine.load([file_path for files, _ in chunk for file_path in files])
+            for files, datetime_obj in chunk:
+                yield files, datetime_obj, heuristic_engine.message(files)
+            heuristic_engine.clear()
+        return
+
+    for files, datetime_obj, commit_message in prefetch_commit_messages(repo_root, commits, diff_base):
+        if commit_message is None:
+            log_detail(f"AI message generation failed for {files}, falling back to a heuristic commit message.")
+            commit_message = heuristic_engine.message(files)
+        yield files, datetime_obj, commit_message
+
+
+def get_head_commit(repo_root):
+    """Returns the commit hash HEAD of repo_root points to, or None in a repository without commits."""
+    result = run_git(
+        ["git", "rev-parse", "-q", "--verify", "HEAD"],
+        capture_output=True,
+        text=True,
+        check=False,
+        cwd=repo_root,
+    )
+    return result.stdout.strip() if result.returncode == 0 else None
+
+
+def commit_files(repo_root, files, datetime_obj, author, author_email, message_engine="default", commit_message=None):
+    log_detail(f"Preparing to commit files: {files}")
+    exists = [os.path.lexists(file_path) for file_path in files]
+    for chunk in _chunks([file_path for file_path, present in zip(files, exists) if present]):
+        run_git(["git", "add", "--"] + chunk, check=True, cwd=repo_root)
+    # Deleted files, like the old path of a moved file, are removed from the index
+    for chunk in _chunks([file_path for file_path, present in zip(files, exists) if not present]):
+        run_git(["git", "rm", "--cached", "-q", "--ignore-unmatch", "--"] + chunk, check=True, cwd=repo_root)
 
     # Use the full datetime with precise time, not just date at midnight
     commit_date = datetime_obj.strftime("%Y-%m-%d %H:%M:%S")
 
-    if use_ai_for_message:
-        print("Generating commit message with AI...")
-        commit_message = generate_commit_message_with_ai(files)
+    if commit_message is not None:
+        pass # Message was generated ahead of time
+    elif message_engine == "ai":
+        log_detail("Generating commit message with AI...")
+        commit_message = generate_commit_message_with_ai(repo_root, files)
         if commit_message is None:
-            return None # Signal failure to trigger fallback in main()
+            # Fall back here so the files do not have to be staged a second time
+            log_detail("AI message generation failed, falling back to a heuristic commit message.")
+            commit_message = HeuristicMessageEngine(repo_root).message(files)
+    elif message_engine == "heuristic":
+        commit_message = HeuristicMessageEngine(repo_root).message(files)
     else:
-        commit_message = f"Adding files from {datetime_obj.date()}"
+        commit_message = default_commit_message(datetime_obj)
 
     if commit_message is None: # Should not happen if not AI, but as a safeguard
         print("Error: Commit message is None, cannot proceed with commit.")
         return None
 
-    print(f"Using commit message: '{commit_message}'")
-    print(f"Using commit timestamp: {commit_date}")
+    log_detail(f"Using commit message: '{commit_message}'")
+    log_detail(f"Using commit timestamp: {commit_date}")
 
     env = os.environ.copy()
     # Here'This is the most important bit: these environment variables are used
@@ -331,48 +2766,741 @@ def commit_files(files, datetime_obj, author, author_email, use_ai_for_message=F
     env["GIT_COMMITTER_EMAIL"] = author_email
 
     try:
-        result = subprocess.run(
+        result = run_git(
             ["git", "commit", "-m", commit_message],
             capture_output=True,
             text=True,
             check=True,
             env=env,
+            cwd=repo_root,
         )
-        commit_hash = result.stdout.split()[1]
-        print(f"Successfully committed: {commit_hash}, DateTime: {datetime_obj}, Message: '{commit_message}'")
+        # The summary line reads "[branch (root-commit) abc1234] message"
+        commit_hash = re.match(r"\[[^\]]*?([0-9a-f]{7,})\]", result.stdout).group(1)
+        get_status_index(repo_root).mark_committed(files)
+        log_detail(f"Successfully committed: {commit_hash}, DateTime: {datetime_obj}, Message: '{commit_message}'")
         return commit_hash
     except subprocess.CalledProcessError as e:
         print(f"Error during git commit: {e.stderr}")
         return None
-    except IndexError:
+    except AttributeError:
         print("Error: Could not parse commit hash from git output.")
         print(f"Git stdout: {result.stdout}")
         return None
 
 
+# Object name of the empty tree, used as the diff base in repositories without commits
+EMPTY_TREE_SHA = "4b825dc642cb6eb9a060e54bf8d69288fbee4904"
+
+
+# Paths git reads from stdin or a fast-import stream are C-style quoted if they
+# start with a double quote or contain a control character such as a line feed
+_GIT_PATH_NEEDS_QUOTING = re.compile(rb'^"|[\x00-\x1f\x7f]')
+
+
+def _quote_git_path(path):
+    """
+    Returns path as the bytes git expects on stdin and in fast-import commands.
+    Bytes that are not UTF-8 are passed through, as git paths are byte strings.
+    """
+    raw_path = os.fsencode(path)
+    if not _GIT_PATH_NEEDS_QUOTING.search(raw_path):
+        return raw_path
+    quoted = bytearray(b'"')
+    for byte in raw_path:
+        if byte in b'"\\':
+            quoted += b"\\" + bytes([byte])
+        elif byte < 0x20 or byte == 0x7f:
+            quoted += b"\\%03o" % byte
+        else:
+            quoted.append(byte)
+    quoted += b'"'
+    return bytes(quoted)
+
+
+def _fast_import_date(datetime_obj):
+    # fast-import's raw date format: <unix timestamp> <utc offset>
+    local_datetime = datetime_obj.astimezone()
+    return f"{int(local_datetime.timestamp())} {local_datetime.strftime('%z')}"
+
+
+class FastImportFileError(OSError):
+    """A file of a commit could not be added to the fast-import stream."""
+
+
+def trusts_executable_bit(repo_root):
+    """Returns False if core.fileMode is off in repo_root, as on most Windows clones."""
+    result = run_git(["git", "config", "--bool", "core.fileMode"], capture_output=True, text=True, check=False, cwd=repo_root)
+    return result.stdout.strip() != "false"
+
+
+def _fast_import_mode(file_path, trust_executable_bit, status_index):
+    # Like `git add`: only the owner's execute bit counts, and without core.fileMode
+    # a file keeps the mode it has in the index, new files being non-executable
+    if not trust_executable_bit:
+        return "100755" if status_index.index_mode(file_path) == "100755" else "100644"
+    try:
+        st_mode = os.stat(file_path).st_mode
+    except OSError as e:
+        raise FastImportFileError(e.errno, e.strerror, file_path)
+    return "100755" if st_mode & stat.S_IXUSR else "100644"
+
+
+def _fast_import_link_blob(file_path, mark):
+    # Symbolic links are stored as a blob of their target, which needs no filters
+    try:
+        target = os.fsencode(os.readlink(file_path))
+    except OSError as e:
+        raise FastImportFileError(e.errno, e.strerror, file_path)
+    return b"blob\nmark :%d\ndata %d\n%s\n" % (mark, len(target), target)
+
+
+def commit_with_fast_import(repo_root, commits, author, author_email, message_engine="default", progress=None):
+    """
+    Creates all commits in a single `git fast-import` run instead of running
+    `git add` and `git commit` for each one. commits is a list of
+    (files, datetime) tuples, in the order they should be committed.
+    The files are written to the object database through `git hash-object -w`,
+    which applies the same filters as `git add`, so the stream only refers to
+    their blobs. The branch ref and the index are only updated once, at the end.
+    A commit with a file that cannot be read is left out of the stream, and
+    the rest are committed without it.
+    Returns a list of (files, datetime, commit_hash) tuples for the commits
+    read, in their order, commit_hash being None for commits that were left
+    out. If fast-import itself failed, none of them has a hash.
+    """
+    if not commits:
+        return []
+
+    try:
+        branch_ref = run_git(
+            ["git", "symbolic-ref", "-q", "HEAD"],
+            capture_output=True,
+            text=True,
+            check=True,
+            cwd=repo_root,
+        ).stdout.strip()
+    except subprocess.CalledProcessError:
+        print("Error: HEAD is detached. The fast-import backend needs a checked out branch.")
+        return []
+
+    parent_hash = get_head_commit(repo_root)
+    # Nothing is committed until fast-import finishes, so each file's change is
+    # its difference against the commit we started from.
+    diff_base = parent_hash or EMPTY_TREE_SHA
+
+    marks_fd, marks_path = tempfile.mkstemp(prefix="filestamp-marks-")
+    os.close(marks_fd)
+    print(f"Streaming commits to git fast-import on {branch_ref}")
+    process = popen_git(
+        ["git", "fast-import", "--quiet", "--done", f"--export-marks={marks_path}"],
+        stdin=subprocess.PIPE,
+        cwd=repo_root,
+    )
+    blob_writer = BlobHasher(repo_root, write=True)
+    status_index = get_status_index(repo_root)
+    trust_executable_bit = trusts_executable_bit(repo_root)
+
+    mark = 0
+    commit_marks = [] # (files, datetime, commit mark), None as the mark of commits left out
+    written_commits = 0
+    index_entries = [] # (mode, blob name or mark, relative path), mode None for deletions
+    try:
+        stream = process.stdin
+        for files, datetime_obj, commit_message in iter_commit_messages(repo_root, commits, message_engine, diff_base):
+            regular_paths = [file_path for file_path in files if os.path.lexists(file_path) and not os.path.islink(file_path)]
+            blobs = dict(zip(regular_paths, blob_writer.hash_paths([repo_relative_path(file_path, repo_root) for file_path in regular_paths])))
+            # The commands of a commit are collected first, so a file that fails leaves nothing behind
+            link_blobs = []
+            file_entries = []
+            try:
+                for file_path in files:
+                    relative_path = repo_relative_path(file_path, repo_root)
+                    if not os.path.lexists(file_path):
+                        # A deleted file, like the old path of a moved file
+                        file_entries.append((None, None, relative_path))
+                    elif file_path not in blobs:
+                        mark += 1
+                        link_blobs.append(_fast_import_link_blob(file_path, mark))
+                        file_entries.append(("120000", mark, relative_path))
+                    elif blobs[file_path] is None:
+                        raise FastImportFileError(errno.EIO, "git hash-object could not read it", file_path)
+                    else:
+                        file_entries.append((_fast_import_mode(file_path, trust_executable_bit, status_index), blobs[file_path], relative_path))
+            except FastImportFileError as e:
+                print(f"Error: Could not read {e.filename}, leaving its commit out: {e.strerror}")
+                commit_marks.append((files, datetime_obj, None))
+                if progress is not None:
+                    progress.update(0, len(files))
+                continue
+
+            mark += 1
+            commit_marks.append((files, datetime_obj, mark))
+            written_commits += 1
+            identity = f"{author} <{author_email}> {_fast_import_date(datetime_obj)}"
+            # Messages naming files that are not UTF-8 would not encode otherwise
+            message_bytes = (commit_message + "\n").encode("utf-8", "replace")
+            stream.writelines(link_blobs)
+            stream.write(f"commit {branch_ref}\nmark :{mark}\nauthor {identity}\ncommitter {identity}\n".encode())
+            stream.write(f"data {len(message_bytes)}\n".encode() + message_bytes)
+            if parent_hash and written_commits == 1:
+                stream.write(f"from {parent_hash}\n".encode())
+            for mode, blob, relative_path in file_entries:
+                if mode is None:
+                    stream.write(b"D " + _quote_git_path(relative_path) + b"\n")
+                else:
+                    blob_ref = f":{blob}" if isinstance(blob, int) else blob
+                    stream.write(f"M {mode} {blob_ref} ".encode() + _quote_git_path(relative_path) + b"\n")
+                index_entries.append((mode, blob, relative_path))
+            stream.write(b"\n")
+            log_detail(f"Queued commit for {files}, DateTime: {datetime_obj}, Message: '{commit_message}'")
+            if progress is not None:
+                progress.update(len(files))
+
+        stream.write(b"done\n")
+        stream.close()
+        if process.wait() != 0:
+            print(f"Error: git fast-import failed with exit code {process.returncode}.")
+            return [(files, datetime_obj, None) for files, datetime_obj, _ in commit_marks]
+
+        marks = {}
+        with open(marks_path) as f:
+            for line in f:
+                mark_name, object_hash = line.split()
+                marks[int(mark_name[1:])] = object_hash
+    except (OSError, ValueError) as e:
+        print(f"Error while streaming commits to git fast-import: {e}")
+        process.kill()
+        process.wait()
+        return [(files, datetime_obj, None) for files, datetime_obj, _ in commit_marks]
+    finally:
+        blob_writer.close()
+        finish_git(process)
+        os.remove(marks_path)
+
+    committed = [
+        (files, datetime_obj, marks[commit_mark] if commit_mark is not None else None)
+        for files, datetime_obj, commit_mark in commit_marks
+    ]
+    if not written_commits:
+        return committed
+
+    # Point the index at the committed blobs in one go, then refresh its stat data.
+    # Deleted files are removed with a mode 0 entry.
+    null_object = "0" * len(next(iter(marks.values())))
+    index_info = b"".join(
+        (f"{mode} {marks[blob] if isinstance(blob, int) else blob}\t" if mode is not None else f"0 {null_object}\t").encode()
+        + os.fsencode(path) + b"\0"
+        for mode, blob, path in index_entries
+    )
+    try:
+        run_git(["git", "update-index", "-z", "--index-info"], input=index_info, check=True, cwd=repo_root)
+        run_git(["git", "update-index", "-q", "--refresh"], check=False, cwd=repo_root)
+    except subprocess.CalledProcessError as e:
+        print(f"Warning: Commits were created but the index could not be updated: {e}")
+
+    for files, _, commit_hash in committed:
+        if commit_hash is not None:
+            get_status_index(repo_root).mark_committed(files)
+    print(f"Successfully committed {written_commits} commits with git fast-import.")
+    return committed
+
+
+def iter_directory_files(directory, ignore_checker, on_directory=None, report_skipped=True):
+    """
+    Recursively walks directory with os.scandir and lazily yields a
+    (file_path, stat_data) tuple for every file found. `.git` directories,
+    nested repositories (such as submodules) and directories ignored by
+    .gitignore are pruned without being entered; the subdirectories of each
+    directory are checked against .gitignore in one batch.
+    Files themselves are not checked here, so the caller can filter them first.
+    The files are stat'ed by the shared StatCollector while the walk goes on.
+    on_directory(path), if given, is called for each directory before it is read.
+    With report_skipped False, pruned directories are skipped silently.
+    """
+    file_entries = _iter_directory_entries(directory, ignore_checker, on_directory, report_skipped)
+    for entry, stat_info in get_stat_collector().stat_all(file_entries):
+        if isinstance(stat_info, OSError):
+            print(f"Error getting timestamps for {entry.path}: {stat_info}")
+            continue
+        yield entry.path, stat_info
+
+
+def _iter_directory_entries(directory, ignore_checker, on_directory, report_skipped):
+    # The walk of iter_directory_files(), yielding the os.DirEntry of each file
+    pending_directories = [directory]
+    while pending_directories:
+        current_directory = pending_directories.pop()
+        if on_directory is not None:
+            on_directory(current_directory)
+        try:
+            with os.scandir(current_directory) as scanner:
+                entries = sorted(scanner, key=lambda entry: entry.name)
+        except OSError as e:
+            print(f"Warning: Could not read directory {current_directory}: {e}")
+            continue
+
+        subdirectories = []
+        for entry in entries:
+            # A .git file links a submodule or worktree to its repository
+            if entry.name == ".git":
+                continue
+            try:
+                is_directory = entry.is_dir()
+            except OSError:
+                is_directory = False
+            if is_directory:
+                # Like os.walk, do not follow symbolic links to directories
+                if entry.is_symlink():
+                    continue
+                # Files of a nested repository belong to that repository, not this one
+                if os.path.lexists(os.path.join(entry.path, ".git")):
+                    if report_skipped:
+                        log_detail(f"Directory {entry.path} is a separate git repository, skipping.")
+                    continue
+                subdirectories.append(entry.path)
+                continue
+            yield entry
+
+        # Files under an ignored directory can still be tracked if they were force-added;
+        # like `git status`, such directories are not entered.
+        ignored_flags = ignore_checker.check_paths(subdirectories)
+        for subdirectory, ignored in zip(reversed(subdirectories), reversed(ignored_flags)):
+            if ignored:
+                if report_skipped:
+                    log_detail(f"Directory {subdirectory} is ignored by .gitignore, skipping.")
+            else:
+                pending_directories.append(subdirectory)
+
+
+class IncrementalState:
+    """
+    State kept in .git/ between directory runs: the latest commit timestamp of
+    the last run and a path -> (size, mtime_ns, inode) cache of the files that
+    were committed or found up to date. Files whose stat data still matches
+    are skipped on the next run before any git command looks at them.
+    The cache is stored in SQLite, so large trees do not hold an entry per file
+    in memory. Changes are only kept once save() ties them to a HEAD commit,
+    and the cache is only trusted while HEAD is still that commit.
+    """
+
+    FILE_NAME = "filestamp-state.sqlite"
+    VERSION = 2
+
+    def __init__(self, path, repo_root):
+        self.path = path
+        self.repo_root = repo_root
+        self.head = None
+        self.high_water = None
+        self._connection = sqlite3.connect(path)
+        if self._connection.execute("PRAGMA user_version").fetchone()[0] != self.VERSION:
+            self._connection.executescript(
+                "DROP TABLE IF EXISTS files; DROP TABLE IF EXISTS meta;"
+                "CREATE TABLE files (path BLOB PRIMARY KEY, size INTEGER, mtime_ns INTEGER, inode INTEGER) WITHOUT ROWID;"
+                "CREATE TABLE meta (key TEXT PRIMARY KEY, value);"
+                f"PRAGMA user_version = {self.VERSION};"
+            )
+
+    @classmethod
+    def load(cls, repo_root, git_dir, head, full=False):
+        """
+        Opens the state of repo_root saved in git_dir. With full, or if HEAD is
+        no longer the commit the last run left, the stat cache is emptied.
+        """
+        path = os.path.join(git_dir, cls.FILE_NAME)
+        try:
+            state = cls(path, repo_root)
+        except sqlite3.DatabaseError as e:
+            print(f"Warning: Ignoring unreadable state file {path}: {e}")
+            with contextlib.suppress(OSError):
+                os.remove(path)
+            state = cls(path, repo_root)
+
+        saved = dict(state._connection.execute("SELECT key, value FROM meta"))
+        if full:
+            state._connection.execute("DELETE FROM files")
+            return state
+        state.high_water = saved.get("high_water")
+        if "head" in saved and saved["head"] != head:
+            # Commits were made or reset outside this tool; the stat cache cannot be trusted
+            print("HEAD moved since the last run, checking all files again.")
+            state._connection.execute("DELETE FROM files")
+        else:
+            state.head = head
+        return state
+
+    def _key(self, file_path):
+        # Bytes, as file names need not be valid UTF-8
+        return os.fsencode(repo_relative_path(file_path, self.repo_root))
+
+    @staticmethod
+    def _signature(stat_info):
+        # SQLite integers are signed 64-bit, inode numbers need not be
+        inode = stat_info.st_ino & 0xFFFFFFFFFFFFFFFF
+        if inode >= 1 << 63:
+            inode -= 1 << 64
+        return (stat_info.st_size, stat_info.st_mtime_ns, inode)
+
+    def is_unchanged(self, file_path, stat_info):
+        """Returns True if the file looks exactly as it did when it was last recorded."""
+        row = self._connection.execute(
+            "SELECT size, mtime_ns, inode FROM files WHERE path = ?", (self._key(file_path),)
+        ).fetchone()
+        return row == self._signature(stat_info)
+
+    def record(self, file_path, stat_info):
+        """Remembers the stat data of a file that was committed or found up to date."""
+        self._connection.execute(
+            "INSERT OR REPLACE INTO files (path, size, mtime_ns, inode) VALUES (?, ?, ?, ?)",
+            (self._key(file_path),) + self._signature(stat_info),
+        )
+
+    def forget_missing(self, directory, seen_paths):
+        """Drops entries under directory that were not seen by the walk (deleted files)."""
+        prefix = self._key(directory)
+        prefix = b"" if prefix == b"." else prefix + b"/"
+        # The walked paths go to a temporary table, so they are not all held in memory
+        self._connection.execute("CREATE TEMP TABLE IF NOT EXISTS seen (path BLOB PRIMARY KEY) WITHOUT ROWID")
+        self._connection.executemany(
+            "INSERT OR IGNORE INTO seen (path) VALUES (?)", ((self._key(file_path),) for file_path in seen_paths)
+        )
+        self._connection.execute(
+            "DELETE FROM files WHERE substr(path, 1, ?) = ? AND path NOT IN (SELECT path FROM seen)",
+            (len(prefix), prefix),
+        )
+        self._connection.execute("DELETE FROM seen")
+
+    def update_high_water(self, commit_datetime):
+        timestamp = commit_datetime.timestamp()
+        if self.high_water is None or timestamp > self.high_water:
+            self.high_water = timestamp
+
+    def save(self, head):
+        """Commits the changes made since the last save, tied to the given HEAD commit."""
+        try:
+            self._connection.executemany(
+                "INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)",
+                [("head", head), ("high_water", self.high_water)],
+            )
+            self._connection.commit()
+        except sqlite3.Error as e:
+            self._connection.rollback()
+            print(f"Warning: Could not save state file {self.path}: {e}")
+            return
+        self.head = head
+
+    def close(self):
+        """Closes the state file; changes not saved are discarded."""
+        if self._connection is None:
+            return
+        self._connection.close()
+        self._connection = None
+
+
+def iter_file_groups(files_with_timestamps, window_seconds, by_directory=False):
+    """
+    Clusters (file, datetime) tuples, sorted by time, into commits. A group collects
+    the files whose timestamps fall within window_seconds of the group's first file;
+    with by_directory, only files in the same directory are grouped together.
+    Each group is committed at the timestamp of its latest file.
+    Yields (files, datetime) tuples sorted by datetime, each as soon as no later
+    file can come before it, so only the groups of one window are held in memory.
+    """
+    open_groups = {}
+    started_groups = collections.deque() # Not yet finished, in the order they started
+    finished_groups = [] # Heap of (latest, sequence, group)
+    sequence = 0
+    for file_path, commit_datetime in files_with_timestamps:
+        # A group cannot take files beyond its window, so it is finished once the input passes it
+        while started_groups and (commit_datetime - started_groups[0]["start"]).total_seconds() > window_seconds:
+            group = started_groups.popleft()
+            heapq.heappush(finished_groups, (group["latest"], group["sequence"], group))
+
+        key = os.path.dirname(file_path) if by_directory else None
+        group = open_groups.get(key)
+        if group is None or (commit_datetime - group["start"]).total_seconds() > window_seconds:
+            group = {"files": [], "start": commit_datetime, "latest": commit_datetime, "sequence": sequence}
+            sequence += 1
+            open_groups[key] = group
+            started_groups.append(group)
+        group["files"].append(file_path)
+        group["latest"] = commit_datetime
+
+        # Groups of different directories can overlap in time, so they are released in
+        # order of their commit time: a finished group goes once no unfinished group
+        # can end before it (each ends at or after its start, the earliest being first).
+        while finished_groups and finished_groups[0][0] <= started_groups[0]["start"]:
+            group = heapq.heappop(finished_groups)[2]
+            yield group["files"], group["latest"]
+
+    for group in started_groups:
+        heapq.heappush(finished_groups, (group["latest"], group["sequence"], group))
+    while finished_groups:
+        group = heapq.heappop(finished_groups)[2]
+        yield group["files"], group["latest"]
+
+
+def group_files_by_time(files_with_timestamps, window_seconds, by_directory=False):
+    """
+    Clusters (file, datetime) tuples, sorted by time, into commits like iter_file_groups().
+    Returns a list of (files, datetime) tuples sorted by datetime.
+    """
+    return list(iter_file_groups(files_with_timestamps, window_seconds, by_directory))
+
+
+# The stat data a ScanTable keeps of a file. The creation time is stored in both
+# st_ctime and st_birthtime, so get_creation_timestamp() finds it on every platform.
+ScannedStat = collections.namedtuple("ScannedStat", ["st_size", "st_mtime", "st_mtime_ns", "st_ctime", "st_birthtime", "st_ino"])
+
+
+class ScanTable:
+    """
+    The files found by a directory walk, stored by column: each directory path
+    is kept once and its files refer to it by number, and the stat data a run
+    needs is kept in arrays rather than in one os.stat_result per file.
+    Rows must be appended in walk order, with all files of a directory together
+    and sorted by name, so that paths can be found again by bisection.
+    Maps file paths to ScannedStat tuples.
+    """
+
+    def __init__(self):
+        self._directories = []
+        self._directory_numbers = {}
+        self._directory_rows = [] # directory number -> [first row, end row]
+        self._directory_of_row = array.array("I")
+        self._names = []
+        self._sizes = array.array("q")
+        self._mtimes = array.array("d")
+        self._mtimes_ns = array.array("q")
+        self._creation_times = array.array("d")
+        self._inodes = array.array("Q")
+
+    def __len__(self):
+        return len(self._names)
+
+    def append(self, file_path, stat_info):
+        """Adds a file with its stat result and returns its row number."""
+        directory, name = os.path.split(file_path)
+        row = len(self._names)
+        number = self._directory_numbers.get(directory)
+        if number is None:
+            number = len(self._directories)
+            self._directory_numbers[directory] = number
+            self._directories.append(directory)
+            self._directory_rows.append([row, row])
+        elif self._directory_rows[number][1] != row:
+            raise ValueError(f"the files of {directory} must be appended together")
+        self._directory_rows[number][1] = row + 1
+
+        self._directory_of_row.append(number)
+        self._names.append(name)
+        self._sizes.append(stat_info.st_size)
+        self._mtimes.append(stat_info.st_mtime)
+        self._mtimes_ns.append(stat_info.st_mtime_ns)
+        self._creation_times.append(get_creation_timestamp(stat_info))
+        self._inodes.append(stat_info.st_ino)
+        return row
+
+    def path(self, row):
+        return os.path.join(self._directories[self._directory_of_row[row]], self._names[row])
+
+    def stat(self, row):
+        creation_time = self._creation_times[row]
+        return ScannedStat(self._sizes[row], self._mtimes[row], self._mtimes_ns[row], creation_time, creation_time, self._inodes[row])
+
+    def find(self, file_path):
+        """Returns the row number of file_path, or None if it is not in the table."""
+        directory, name = os.path.split(file_path)
+        number = self._directory_numbers.get(directory)
+        if number is None:
+            return None
+        first, end = self._directory_rows[number]
+        row = bisect.bisect_left(self._names, name, first, end)
+        if row < end and self._names[row] == name:
+            return row
+        return None
+
+    def __contains__(self, file_path):
+        return self.find(file_path) is not None
+
+    def __getitem__(self, file_path):
+        row = self.find(file_path)
+        if row is None:
+            raise KeyError(file_path)
+        return self.stat(row)
+
+    def iter_paths(self):
+        for row in range(len(self._names)):
+            yield self.path(row)
+
+
+# Above this many rows, RowSorter writes sorted runs to temporary files
+SORT_RUN_ROWS = 1 << 20
+
+
+class RowSorter:
+    """
+    Sorts (timestamp, row) pairs by timestamp, and by row where timestamps are
+    equal, as an external sort. Pairs are collected in two array columns; every
+    run_rows of them are argsorted and written to a temporary file as a sorted
+    run. Iterating merges the runs and yields the pairs as a stream, and can be
+    repeated. Rows must be added in increasing order. min_timestamp is the
+    earliest timestamp added, or None while the sorter is empty.
+    """
+
+    RECORD = struct.Struct("<dI")
+
+    def __init__(self, run_rows=None):
+        self.run_rows = SORT_RUN_ROWS if run_rows is None else run_rows
+        self._timestamps = array.array("d")
+        self._rows = array.array("I")
+        self._order = None
+        self._runs = []
+        self._count = 0
+        self.min_timestamp = None
+
+    def __len__(self):
+        return self._count
+
+    def add(self, timestamp, row):
+        self._timestamps.append(timestamp)
+        self._rows.append(row)
+        self._order = None
+        self._count += 1
+        if self.min_timestamp is None or timestamp < self.min_timestamp:
+            self.min_timestamp = timestamp
+        if len(self._rows) >= self.run_rows:
+            self._spill()
+
+    def _sorted_order(self):
+        # Argsort of the timestamp column; sorted() is stable, so equal timestamps keep row order
+        if self._order is None:
+            self._order = sorted(range(len(self._rows)), key=self._timestamps.__getitem__)
+        return self._order
+
+    def _spill(self):
+        run = tempfile.TemporaryFile(prefix="filestamp-sort-")
+        pack = self.RECORD.pack
+        run.writelines(pack(self._timestamps[index], self._rows[index]) for index in self._sorted_order())
+        run.flush()
+        self._runs.append(run)
+        self._timestamps = array.array("d")
+        self._rows = array.array("I")
+        self._order = None
+
+    def _read_run(self, run):
+        # Seek before every read, so several iterations can be in progress at once
+        offset = 0
+        chunk_size = self.RECORD.size * 4096
+        while True:
+            run.seek(offset)
+            chunk = run.read(chunk_size)
+            if not chunk:
+                return
+            offset += len(chunk)
+            yield from self.RECORD.iter_unpack(chunk)
+
+    def __iter__(self):
+        timestamps, rows = self._timestamps, self._rows
+        in_memory = ((timestamps[index], rows[index]) for index in self._sorted_order())
+        if not self._runs:
+            return in_memory
+        return heapq.merge(*[self._read_run(run) for run in self._runs], in_memory)
+
+    def close(self):
+        """Deletes the temporary files of the spilled runs."""
+        for run in self._runs:
+            run.close()
+        self._runs = []
+
+
+class PendingCommits:
+    """
+    The commits found by a directory pass, read as a stream from the ScanTable
+    and the RowSorter holding the sorted rows. Iterating yields (files, datetime)
+    tuples sorted by datetime, grouped like group_files_by_time() if group_window
+    is set, and can be repeated. renames maps the new paths of moved files to
+    their deleted old paths, which are committed along with them.
+    """
+
+    def __init__(self, table, sorter, group_window=None, group_by_dir=False, renames=None):
+        self.table = table
+        self.sorter = sorter
+        self.group_window = group_window
+        self.group_by_dir = group_by_dir
+        self.renames = renames or {}
+
+    def _iter_files(self):
+        for timestamp, row in self.sorter:
+            yield self.table.path(row), datetime.fromtimestamp(timestamp)
+
+    def _with_old_paths(self, files):
+        with_old_paths = []
+        for file_path in files:
+            if file_path in self.renames:
+                with_old_paths.append(self.renames[file_path])
+            with_old_paths.append(file_path)
+        return with_old_paths
+
+    def __iter__(self):
+        if self.group_window is None:
+            commits = (([file_path], commit_datetime) for file_path, commit_datetime in self._iter_files())
+        else:
+            commits = iter_file_groups(self._iter_files(), self.group_window, by_directory=self.group_by_dir)
+        if not self.renames:
+            return commits
+        return ((self._with_old_paths(files), commit_datetime) for files, commit_datetime in commits)
+
+    def __bool__(self):
+        return len(self.sorter) > 0
+
+    @property
+    def file_count(self):
+        """The number of files over all commits, counting the old paths of moved files."""
+        return len(self.sorter) + len(self.renames)
+
+
+def count_commit_files(commits):
+    """Returns the number of files in commits, without a pass over a PendingCommits stream."""
+    if isinstance(commits, PendingCommits):
+        return commits.file_count
+    return sum(len(files) for files, _ in commits)
+
+
+def resolve_target_path(path):
+    """
+    Returns the absolute path of a target given on the command line with the
+    symbolic links of its directories resolved, so that it lies under the
+    repository root git reports. A target that is itself a symbolic link to
+    a file is kept as it is, since git commits the link rather than its target.
+    """
+    abs_path = os.path.abspath(path)
+    if os.path.isdir(abs_path):
+        return os.path.realpath(abs_path)
+    directory, name = os.path.split(abs_path)
+    return os.path.join(os.path.realpath(directory), name)
+
+
 def get_git_repo_root(target_path):
     """
     Finds the root of the git repository containing the target_path.
     Returns the absolute path to the git repository root, or None if not found.
     """
     # We need to run git commands from the directory containing the target path
-    # to ensure git can find the repository.
-    initial_cwd = os.getcwd()
+    # to ensure git can find the repository. The process's own working directory
+    # is left alone, so this is safe to call while other repositories are worked on.
     if os.path.isfile(target_path):
         search_dir = os.path.dirname(target_path)
     else:
         search_dir = target_path
     
     try:
-        os.chdir(search_dir)
-        # print(f"Temporarily changed directory to: {search_dir} for git rev-parse") # Optional: for debugging
-
         # Get the path to the .git directory
-        result = subprocess.run(
+        result = run_git(
             ["git", "rev-parse", "--git-dir"],
             capture_output=True,
             text=True,
-            check=True
+            check=True,
+            cwd=search_dir,
         )
         git_dir_path = result.stdout.strip()
 
@@ -380,11 +3508,12 @@ def get_git_repo_root(target_path):
         # If it's something else (e.g., "../.git", ".git/modules/submodule"),
         # we need to find the actual working tree root.
         # `git rev-parse --show-toplevel` gives the root of the working tree directly.
-        toplevel_result = subprocess.run(
+        toplevel_result = run_git(
             ["git", "rev-parse", "--show-toplevel"],
             capture_output=True,
             text=True,
-            check=True
+            check=True,
+            cwd=search_dir,
         )
         repo_root = toplevel_result.stdout.strip()
         
@@ -401,20 +3530,34 @@ def get_git_repo_root(target_path):
     except FileNotFoundError:
         print(f"Error: git command not found. Is Git installed and in your PATH?")
         return None
-    finally:
-        # Change back to the original directory, important for script behavior
-        os.chdir(initial_cwd)
 
-def main():
-    parser = argparse.ArgumentParser(
-        description="Populate Git repo with historical commits, using AI for messages by default with fallback."
-    )
-    parser.add_argument("path", nargs='?', default=os.getcwd(), help="Path to a file or directory to commit. Defaults to the current directory if not provided.")
-    parser.add_argument("--author", help="Author of the commits (defaults to GIT_AUTHOR_NAME from .env)")
-    parser.add_argument("--email", help="Email of author (defaults to GIT_AUTHOR_EMAIL from .env)")
-    parser.add_argument("--no-ai", action="store_true", help="Disable AI and use default commit messages.")
-    args = parser.parse_args()
+def add_profile_arguments(parser):
+    parser.add_argument("--profile", nargs="?", const="", metavar="FILE", help=f"Time every phase, git command and API request, and write a JSON report to FILE (defaults to .git/{PROFILE_FILE_NAME}).")
+    parser.add_argument("--cprofile", metavar="FILE", help="With --profile, also write cProfile stats of the run to FILE.")
+
+
+def start_profiling(args, repo_root=None):
+    """Enables profiling if --profile was given, reporting to the .git directory of repo_root by default."""
+    if args.profile is None:
+        return
+    report_path = os.path.abspath(args.profile) if args.profile else None
+    cprofile_path = os.path.abspath(args.cprofile) if args.cprofile else None
+    enable_profiling(report_path, cprofile_path, repo_root)
+
+
+def add_message_engine_argument(parser):
+    parser.add_argument("--message-engine", choices=MESSAGE_ENGINES, help="How commit messages are written: 'ai' asks the API, 'heuristic' derives them locally from paths and diffstats, 'default' uses the date. Defaults to 'ai', or 'default' with --no-ai.")
+
+
+def resolve_message_engine(args):
+    """Returns the message engine selected by --message-engine, or by --no-ai for compatibility."""
+    if args.message_engine:
+        return args.message_engine
+    return "default" if args.no_ai else "ai" # Use AI by default, unless --no-ai is specified
+
 
+def resolve_author(args):
+    """Returns the (name, email) to commit as, from the command line or .env. Exits if either is missing."""
     # Use environment variables for author/email if not provided via CLI
     author_name = args.author if args.author else GIT_AUTHOR_NAME
     author_email = args.email if args.email else GIT_AUTHOR_EMAIL
@@ -422,178 +3565,1118 @@ def main():
     if not author_name or not author_email:
         print("Error: Author name and email must be provided either via --author/--email arguments or set in .env file (GIT_AUTHOR_NAME, GIT_AUTHOR_EMAIL).")
         sys.exit(1)
+    return author_name, author_email
 
-    # Determine the actual directory for git operations and if the target is a single file
-    # If args.path is a string (even if it's the default from os.getcwd()), os.path.abspath will work.
-    # If os.getcwd() returns a path with spaces or special characters, it's still a single string.
-    abs_target_path = os.path.abspath(args.path)
-    is_single_file = os.path.isfile(abs_target_path)
-    is_directory = os.path.isdir(abs_target_path)
-
-    # If path was not provided, it defaults to current directory, which is a directory.
-    # We should add a check to ensure the default path (current dir) is valid.
-    if not args.path: # Path was not provided, using default
-        print(f"No path provided, defaulting to current directory: {abs_target_path}")
-        if not is_directory: # Should always be a directory if defaulting to cwd, but good to check
-            print(f"Error: Default path '{abs_target_path}' is not a valid directory.")
-            sys.exit(1)
-    else: # Path was provided
-        if not is_single_file and not is_directory:
-            print(f"Error: Path '{args.path}' (resolved to '{abs_target_path}') is not a valid file or directory.")
-            sys.exit(1)
 
+def require_git_repository(abs_target_path):
+    """
+    Returns the root of the git repository containing abs_target_path.
+    Exits if there is no usable repository.
+    """
     # Determine the git repository root using the new function
     git_repo_dir = get_git_repo_root(abs_target_path)
     if not git_repo_dir:
         print("Error: Could not determine the git repository root. Please ensure you are inside a git repository or provide a valid path to one.")
         sys.exit(1)
+    print(f"Using git repository root: {git_repo_dir}")
+
+    if not os.path.exists(os.path.join(git_repo_dir, ".git")): # This check is now more robust
+        print(
+            f"Error: No .git directory found in the resolved repository path '{git_repo_dir}'. Please initialize a Git repository first."
+        )
+        sys.exit(1)
+    return git_repo_dir
+
+
+def load_incremental_state(repo_root, full=False):
+    """Loads the incremental state of repo_root; with full, starts from an empty one."""
+    state = IncrementalState.load(repo_root, get_git_common_dir(repo_root), get_head_commit(repo_root), full)
+    if state.high_water is not None:
+        print(f"Last run committed changes up to {datetime.fromtimestamp(state.high_water)}.")
+    return state
+
+
+def plan_directory_commits(repo_root, directory, state, group_window=None, group_by_dir=False, detect_renames=True):
+    """
+    The discovery phase of directory mode. Walks directory, drops ignored files,
+    files unchanged since the last run and files without changes, then timestamps,
+    sorts and optionally groups the rest. Up-to-date files are recorded in state.
+    With detect_renames, new files are hashed to find the ones moved from a deleted
+    file under directory, and each is committed together with the deletion.
+    Returns a (pending_commits, file_stats) tuple: a PendingCommits stream of
+    (files, datetime) tuples sorted by datetime, and the ScanTable of every file
+    walked, which maps file paths to their stat data.
+    """
+    # Recursively find all files in the directory; the table keeps them compactly
+    table = ScanTable()
+    candidate_rows = array.array("I")
+    unchanged_count = 0
+    with profile_phase("walk"):
+        for file_path, stat_info in iter_directory_files(directory, get_ignore_checker(repo_root)):
+            row = table.append(file_path, stat_info)
+            # Files untouched since the last run need no git commands at all
+            if state.is_unchanged(file_path, stat_info):
+                unchanged_count += 1
+                continue
+            candidate_rows.append(row)
+
+    state.forget_missing(directory, table.iter_paths())
+    if unchanged_count:
+        print(f"Skipped {unchanged_count} files unchanged since the last run (use --full to check them again).")
+
+    # Skip ignored and up-to-date files before any messages are generated, and
+    # sort the rest by timestamp (oldest first) without building a list of them
+    sorter = RowSorter()
+    found_count = 0
+    new_paths = []
+    ignore_checker = get_ignore_checker(repo_root)
+    # git status only looks at directory, unless it is the whole repository
+    status_index = get_status_index(repo_root, [directory])
+    for start in range(0, len(candidate_rows), GIT_PATHS_PER_COMMAND):
+        rows = candidate_rows[start:start + GIT_PATHS_PER_COMMAND]
+        file_paths = [table.path(row) for row in rows]
+        # Check the files against .gitignore in bulk through a single git process
+        ignored_flags = ignore_checker.check_paths(file_paths)
+        for row, file_path, ignored in zip(rows, file_paths, ignored_flags):
+            if ignored:
+                log_detail(f"File {file_path} is ignored by .gitignore, skipping.")
+                continue
+            found_count += 1
+            stat_info = table.stat(row)
+            if not status_index.has_changes(file_path):
+                log_detail(f"File {file_path} is up to date (no changes detected). Skipping commit.")
+                state.record(file_path, stat_info)
+                continue
+
+            if detect_renames and status_index.is_new(file_path) and stat_info.st_size >= MOVE_MIN_BYTES:
+                new_paths.append(file_path)
+            # Get the appropriate timestamp based on file status
+            commit_datetime = get_appropriate_timestamp(repo_root, file_path, stat_info)
+            sorter.add(commit_datetime.timestamp(), row)
+
+    renames = {}
+    if new_paths:
+        content_index = get_content_index(repo_root)
+        with profile_phase("hash"):
+            renames = content_index.detect(new_paths, directory)
+        if renames or content_index.copies:
+            print(f"Found {len(renames)} moved files and {len(content_index.copies)} copies of files in HEAD.")
+
+    pending_commits = PendingCommits(table, sorter, group_window, group_by_dir, renames)
+    if not found_count:
+        print("No files found to commit in the specified directory and its subdirectories.")
+        return pending_commits, table
+
+    print(f"Found {found_count} files, {len(sorter)} with changes. Sorting by timestamp and committing in order.")
+
+    if state.high_water is not None and sorter.min_timestamp is not None and sorter.min_timestamp < state.high_water:
+        print("Warning: Some files are older than the commits of the last run; history will not be in chronological order.")
+
+    if group_window is not None:
+        scope = " from the same directory" if group_by_dir else ""
+        print(f"Grouping files{scope} whose timestamps are within {group_window:g} seconds of each other.")
+    return pending_commits, table
+
+
+def execute_commits(repo_root, pending_commits, author, author_email, message_engine="default", use_fast_import=False, on_committed=None):
+    """
+    The commit phase of directory mode. Creates the (files, datetime) commits in
+    order, with git fast-import or with git add/commit per commit, and calls
+    on_committed(files, datetime, commit_hash) after each successful commit.
+    Returns a (successful_files, failed_files) tuple of counts.
+    """
+    if message_engine == "ai":
+        print(f"Generating commit messages with AI ({AI_CONCURRENCY} in parallel)...")
+    elif message_engine == "heuristic":
+        print("Generating heuristic commit messages.")
+    else:
+        print("AI disabled, using default commit messages.")
+
+    successful_commits = 0
+    failed_commits = 0
+    progress = ProgressReporter(count_commit_files(pending_commits)) if not _verbose else None
+    if use_fast_import:
+        committed = commit_with_fast_import(repo_root, pending_commits, author, author_email, message_engine=message_engine, progress=progress)
+        # The commits read by fast-import come back with their hashes, so the stream is not read again
+        for files, commit_datetime, commit_hash in committed:
+            if commit_hash is None:
+                emit_event("commit_failed", repo=repo_root, files=relative_paths(files, repo_root), datetime=commit_datetime.isoformat())
+                continue
+            emit_event("commit", repo=repo_root, files=relative_paths(files, repo_root), datetime=commit_datetime.isoformat(), commit=commit_hash)
+            successful_commits += len(files)
+            if on_committed is not None:
+                on_committed(files, commit_datetime, commit_hash)
+        # Commits not read before fast-import failed count as failed too
+        failed_commits = count_commit_files(pending_commits) - successful_commits
+        if progress is not None:
+            progress.finish()
+        return successful_commits, failed_commits
+
+    # Messages are generated ahead of the commits, so each file is diffed against HEAD
+    # rather than the index; a file's HEAD version only changes with its own commit.
+    diff_base = get_head_commit(repo_root) or EMPTY_TREE_SHA
+    for files, commit_datetime, commit_message in iter_commit_messages(repo_root, pending_commits, message_engine, diff_base):
+        if len(files) == 1:
+            log_detail(f"\n--- Committing file: {files[0]} (Date: {commit_datetime.date()}) ---")
+        else:
+            log_detail(f"\n--- Committing {len(files)} files (Date: {commit_datetime.date()}) ---")
+        commit_hash = commit_files(repo_root, files, commit_datetime, author, author_email, commit_message=commit_message)
+
+        if commit_hash:
+            log_detail(f"Commit successful: {commit_hash}")
+            emit_event("commit", repo=repo_root, files=relative_paths(files, repo_root), datetime=commit_datetime.isoformat(), commit=commit_hash, message=commit_message)
+            successful_commits += len(files)
+            if on_committed is not None:
+                on_committed(files, commit_datetime, commit_hash)
+        else:
+            print(f"Commit failed: {files}")
+            emit_event("commit_failed", repo=repo_root, files=relative_paths(files, repo_root), datetime=commit_datetime.isoformat(), message=commit_message)
+            failed_commits += len(files)
+        if progress is not None:
+            progress.update(len(files) if commit_hash else 0, 0 if commit_hash else len(files))
+    if progress is not None:
+        progress.finish()
+    return successful_commits, failed_commits
+
+
+def print_commit_summary(repo_root, successful_commits, failed_commits):
+    print("\n--- Directory Commit Summary ---")
+    print(f"Successfully committed {successful_commits} files.")
+    if failed_commits > 0:
+        print(f"Failed to commit {failed_commits} files.")
+    print_message_cache_summary(repo_root)
+    print_api_summary()
+
+
+PLAN_FILE_NAME = "filestamp-plan.ndjson"
+PLAN_VERSION = 1
+
+
+def default_plan_path(repo_root):
+    """Returns the default location of the commit plan file of repo_root."""
+    return os.path.join(get_git_common_dir(repo_root), PLAN_FILE_NAME)
+
+
+def write_commit_plan(plan_path, repo_root, pending_commits):
+    """
+    Writes pending_commits to plan_path as newline-delimited JSON: a header line,
+    then one line per commit with its group number, timestamp, paths (relative to
+    the repository root) and their git status codes. Returns a (commit_count,
+    file_count) tuple, counted while writing.
+    """
+    status_index = get_status_index(repo_root)
+    temp_path = plan_path + ".tmp"
+    commit_count = 0
+    file_count = 0
+    with open(temp_path, "w") as f:
+        header = {"type": "header", "version": PLAN_VERSION, "repo": repo_root, "head": get_head_commit(repo_root)}
+        f.write(json.dumps(header) + "\n")
+        for group, (files, commit_datetime) in enumerate(pending_commits):
+            entry = {
+                "type": "commit",
+                "group": group,
+                "timestamp": commit_datetime.timestamp(),
+                "paths": relative_paths(files, repo_root),
+                "status": [status_index.status(file_path) for file_path in files],
+            }
+            f.write(json.dumps(entry, separators=(",", ":")) + "\n")
+            commit_count += 1
+            file_count += len(files)
+    os.replace(temp_path, plan_path)
+    return commit_count, file_count
+
+
+def read_commit_plan(plan_path):
+    """
+    Reads a plan written by write_commit_plan(), including the progress checkpoints
+    appended to it by apply. Returns a (header, commits, done) tuple, where commits
+    is the list of commit entries and done maps group numbers to commit hashes.
+    """
+    header = None
+    commits = []
+    done = {}
+    with open(plan_path) as f:
+        for line_number, line in enumerate(f, 1):
+            if not line.strip():
+                continue
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                # A crash can leave a partly written checkpoint as the last line
+                print(f"Warning: Ignoring unreadable line {line_number} of {plan_path}.")
+                continue
+            if entry.get("type") == "header":
+                header = entry
+            elif entry.get("type") == "commit":
+                commits.append(entry)
+            elif entry.get("type") == "done":
+                done[entry["group"]] = entry["commit"]
+    if header is None or header.get("version") != PLAN_VERSION:
+        raise ValueError(f"{plan_path} is not a commit plan written by this version of the tool")
+    return header, commits, done
+
+
+def plan_command(argv):
+    """Handles `main.py plan`: runs the discovery phase and writes the commit plan to a file."""
+    parser = argparse.ArgumentParser(
+        prog="main.py plan",
+        description="Scan a directory and write the sorted commit plan to a file, without committing anything."
+    )
+    parser.add_argument("path", nargs='?', default=os.getcwd(), help="Directory to scan. Defaults to the current directory if not provided.")
+    parser.add_argument("-o", "--output", help=f"File to write the plan to (defaults to .git/{PLAN_FILE_NAME}).")
+    parser.add_argument("--group-window", type=float, metavar="SECONDS", help="Commit files whose timestamps fall within SECONDS of each other together.")
+    parser.add_argument("--group-by-dir", action="store_true", help="With --group-window, only group files from the same directory.")
+    parser.add_argument("--full", action="store_true", help="Check every file instead of skipping files unchanged since the last run.")
+    parser.add_argument("--no-renames", action="store_true", help="Do not hash new files to commit moved files together with their deleted old paths.")
+    add_profile_arguments(parser)
+    args = parser.parse_args(argv)
+
+    abs_target_path = resolve_target_path(args.path)
+    if not os.path.isdir(abs_target_path):
+        print(f"Error: Path '{args.path}' (resolved to '{abs_target_path}') is not a valid directory.")
+        sys.exit(1)
+    git_repo_dir = require_git_repository(abs_target_path)
+    start_profiling(args, git_repo_dir)
+    plan_path = os.path.abspath(args.output) if args.output else default_plan_path(git_repo_dir)
+
+    state = load_incremental_state(git_repo_dir, args.full)
+    with profile_phase("classify"):
+        pending_commits, _ = plan_directory_commits(git_repo_dir, abs_target_path, state, args.group_window, args.group_by_dir, not args.no_renames)
+    commit_count, file_count = write_commit_plan(plan_path, git_repo_dir, pending_commits)
+    # Nothing is committed yet, so the files found up to date are not saved either
+    state.close()
+    print(f"\nWrote a plan of {commit_count} commits ({file_count} files) to {plan_path}")
+    print("Run `main.py apply` to create the commits.")
+
+
+def apply_command(argv):
+    """Handles `main.py apply`: creates the commits of a plan file, resuming after the last one done."""
+    parser = argparse.ArgumentParser(
+        prog="main.py apply",
+        description="Create the commits of a plan written by `main.py plan`. Progress is checkpointed in the plan file, so an interrupted run resumes where it stopped."
+    )
+    parser.add_argument("plan_file", nargs='?', help=f"Plan file to apply (defaults to .git/{PLAN_FILE_NAME} of the current repository).")
+    parser.add_argument("--author", help="Author of the commits (defaults to GIT_AUTHOR_NAME from .env)")
+    parser.add_argument("--email", help="Email of author (defaults to GIT_AUTHOR_EMAIL from .env)")
+    parser.add_argument("--no-ai", action="store_true", help="Disable AI and use default commit messages.")
+    parser.add_argument("--no-cache", action="store_true", help="Do not read or write the persistent AI commit message cache.")
+    add_message_engine_argument(parser)
+    parser.add_argument("--fast-import", action="store_true", help="Create all commits with a single git fast-import run instead of git add/commit per commit.")
+    add_output_arguments(parser)
+    add_profile_arguments(parser)
+    args = parser.parse_args(argv)
+    start_output(args)
+
+    author_name, author_email = resolve_author(args)
+    if args.plan_file:
+        plan_path = os.path.abspath(args.plan_file)
+    else:
+        plan_path = default_plan_path(require_git_repository(os.getcwd()))
 
-    # Change to the determined git repository directory
     try:
-        os.chdir(git_repo_dir)
-        print(f"Changed directory to git repository root: {git_repo_dir}")
-    except FileNotFoundError:
-        print(f"Error: Could not change to directory '{git_repo_dir}'. It might not exist.")
+        header, plan_entries, done = read_commit_plan(plan_path)
+    except (OSError, ValueError) as e:
+        print(f"Error: Could not read plan file: {e}")
         sys.exit(1)
+    git_repo_dir = require_git_repository(header["repo"])
+    start_profiling(args, git_repo_dir)
 
+    message_engine = resolve_message_engine(args)
+    if message_engine == "ai" and not args.no_cache:
+        enable_message_cache(git_repo_dir)
 
-    if not os.path.exists(".git"): # This check is now more robust
-        print(
-            f"Error: No .git directory found in the resolved repository path '{git_repo_dir}'. Please initialize a Git repository first."
+    if done:
+        print(f"Resuming: {len(done)} of {len(plan_entries)} planned commits were already applied.")
+
+    # Files may have been committed after the last checkpoint was written, so check them again
+    pending_commits = []
+    pending_groups = []
+    status_index = get_status_index(git_repo_dir)
+    for entry in plan_entries:
+        if entry["group"] in done:
+            continue
+        files = [os.path.join(git_repo_dir, path) for path in entry["paths"]]
+        files = [file_path for file_path in files if status_index.has_changes(file_path)]
+        if not files:
+            print(f"Planned commit {entry['group']} has no changes left, skipping.")
+            continue
+        pending_commits.append((files, datetime.fromtimestamp(entry["timestamp"])))
+        pending_groups.append(entry["group"])
+
+    state = load_incremental_state(git_repo_dir)
+    group_of_commit = {tuple(files): group for (files, _), group in zip(pending_commits, pending_groups)}
+    with open(plan_path, "a+") as checkpoint_file:
+        # Start on a fresh line if an interrupted run left a partly written checkpoint
+        if checkpoint_file.tell() > 0:
+            checkpoint_file.seek(checkpoint_file.tell() - 1)
+            if checkpoint_file.read(1) != "\n":
+                checkpoint_file.write("\n")
+
+        def on_committed(files, commit_datetime, commit_hash):
+            checkpoint = {"type": "done", "group": group_of_commit[tuple(files)], "commit": commit_hash}
+            checkpoint_file.write(json.dumps(checkpoint) + "\n")
+            checkpoint_file.flush()
+            os.fsync(checkpoint_file.fileno())
+            state.update_high_water(commit_datetime)
+            for file_path in files:
+                try:
+                    state.record(file_path, os.stat(file_path))
+                except OSError:
+                    pass
+
+        with profile_phase("commit"):
+            successful_commits, failed_commits = execute_commits(
+                git_repo_dir, pending_commits, author_name, author_email,
+                message_engine=message_engine, use_fast_import=args.fast_import, on_committed=on_committed,
+            )
+    state.save(get_head_commit(git_repo_dir))
+    state.close()
+    print_commit_summary(git_repo_dir, successful_commits, failed_commits)
+    emit_run_summary([{"repo": git_repo_dir, "successful": successful_commits, "failed": failed_commits, "error": None}], get_run_counters())
+
+
+class PollingWatcher:
+    """
+    Finds changed files by comparing (size, mtime) snapshots of the tree every
+    interval seconds. The fallback where inotify is not available: each poll
+    walks the tree, but no git command runs for files that did not change.
+    """
+
+    def __init__(self, directory, ignore_checker, interval=5.0):
+        self.directory = directory
+        self.ignore_checker = ignore_checker
+        self.interval = interval
+        self._snapshot = self._scan()
+        self._next_poll = time.monotonic() + interval
+
+    def _scan(self):
+        snapshot = {}
+        for file_path, stat_info in iter_directory_files(self.directory, self.ignore_checker, report_skipped=False):
+            snapshot[file_path] = (stat_info.st_size, stat_info.st_mtime_ns)
+        return snapshot
+
+    def wait(self, timeout=None):
+        """
+        Waits up to timeout seconds (forever if None) for the next poll.
+        Returns the set of files that were created or modified since the last one.
+        """
+        delay = max(0.0, self._next_poll - time.monotonic())
+        if timeout is not None and timeout < delay:
+            time.sleep(timeout)
+            return set()
+        time.sleep(delay)
+        snapshot = self._scan()
+        self._next_poll = time.monotonic() + self.interval
+        changed = {file_path for file_path, signature in snapshot.items() if self._snapshot.get(file_path) != signature}
+        self._snapshot = snapshot
+        return changed
+
+    def close(self):
+        pass
+
+
+class InotifyWatcher:
+    """
+    Reports changed files through Linux inotify, with a watch on every directory
+    the walk enters. Waiting costs nothing while the tree is idle, and events
+    name the changed files, so the tree is only walked again when the kernel's
+    event queue overflows. Raises OSError if inotify cannot be used.
+    """
+
+    IN_MODIFY = 0x00000002
+    IN_ATTRIB = 0x00000004
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_TO = 0x00000080
+    IN_CREATE = 0x00000100
+    IN_DELETE_SELF = 0x00000400
+    IN_MOVE_SELF = 0x00000800
+    IN_Q_OVERFLOW = 0x00004000
+    IN_IGNORED = 0x00008000
+    IN_ISDIR = 0x40000000
+    IN_NONBLOCK = os.O_NONBLOCK
+    IN_CLOEXEC = 0o2000000
+
+    WATCH_MASK = IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE | IN_DELETE_SELF | IN_MOVE_SELF
+
+    # struct inotify_event: wd, mask, cookie and len, followed by len bytes of NUL-padded name
+    EVENT_HEADER = struct.Struct("iIII")
+
+    def __init__(self, directory, ignore_checker):
+        self.directory = directory
+        self.ignore_checker = ignore_checker
+        self._directories = {} # watch descriptor -> directory path
+        self._started = False
+        self._libc = ctypes.CDLL(None, use_errno=True)
+        if not hasattr(self._libc, "inotify_init1"):
+            raise OSError(errno.ENOSYS, "inotify is not supported by this C library")
+        self._fd = self._libc.inotify_init1(self.IN_NONBLOCK | self.IN_CLOEXEC)
+        if self._fd < 0:
+            error = ctypes.get_errno()
+            raise OSError(error, os.strerror(error))
+        try:
+            self._watch_tree(directory)
+        except OSError:
+            self.close()
+            raise
+        self._started = True
+
+    def __len__(self):
+        return len(self._directories)
+
+    def _watch_directory(self, directory):
+        wd = self._libc.inotify_add_watch(self._fd, os.fsencode(directory), self.WATCH_MASK)
+        if wd >= 0:
+            self._directories[wd] = directory
+            return
+        error = ctypes.get_errno()
+        if error in (errno.ENOENT, errno.ENOTDIR):
+            return # Removed again before it could be watched
+        if error == errno.ENOSPC and not self._started:
+            raise OSError(error, "the inotify watch limit is reached (see /proc/sys/fs/inotify/max_user_watches)")
+        print(f"Warning: Could not watch directory {directory}: {os.strerror(error)}")
+
+    def _watch_tree(self, directory):
+        """Watches directory and all directories below it. Returns the set of files in them."""
+        return {
+            file_path
+            for file_path, _ in iter_directory_files(directory, self.ignore_checker, on_directory=self._watch_directory, report_skipped=False)
+        }
+
+    def _is_watchable_directory(self, path):
+        # The same directories the walk would enter
+        if os.path.islink(path) or os.path.lexists(os.path.join(path, ".git")):
+            return False
+        return not self.ignore_checker.check_paths([path])[0]
+
+    def wait(self, timeout=None):
+        """
+        Waits up to timeout seconds (forever if None) for events.
+        Returns the set of files that were created or modified.
+        """
+        readable, _, _ = select.select([self._fd], [], [], timeout)
+        changed = set()
+        if not readable:
+            return changed
+        while True:
+            try:
+                data = os.read(self._fd, 65536)
+            except BlockingIOError:
+                break
+            self._read_events(data, changed)
+        return changed
+
+    def _read_events(self, data, changed):
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, name_length = self.EVENT_HEADER.unpack_from(data, offset)
+            offset += self.EVENT_HEADER.size
+            name = os.fsdecode(data[offset:offset + name_length].rstrip(b"\0"))
+            offset += name_length
+
+            if mask & self.IN_Q_OVERFLOW:
+                print("Warning: Too many file events at once, checking the whole directory again.")
+                changed.update(self._watch_tree(self.directory))
+                continue
+            if mask & self.IN_IGNORED:
+                self._directories.pop(wd, None)
+                continue
+            directory = self._directories.get(wd)
+            if directory is None:
+                continue
+            if mask & self.IN_MOVE_SELF:
+                # The watch would follow the directory to a path we no longer know
+                self._libc.inotify_rm_watch(self._fd, wd)
+                continue
+            if not name or name == ".git":
+                continue
+
+            path = os.path.join(directory, name)
+            if name == ".gitignore" and not mask & self.IN_ISDIR:
+                # Directories that were ignored may not be any more; git check-ignore
+                # reads each .gitignore only once, so restart it before walking again
+                self.ignore_checker.close()
+                changed.update(self._watch_tree(self.directory))
+            if mask & self.IN_ISDIR:
+                # Files can be created in a new directory before its watch is added, so scan it
+                if mask & (self.IN_CREATE | self.IN_MOVED_TO) and self._is_watchable_directory(path):
+                    changed.update(self._watch_tree(path))
+                continue
+            changed.add(path)
+
+    def close(self):
+        """Closes the inotify descriptor and with it all watches."""
+        if self._fd is not None and self._fd >= 0:
+            os.close(self._fd)
+        self._fd = None
+        self._directories = {}
+
+
+# Changes are committed at the latest after this many debounce periods,
+# even while events keep arriving (e.g. for a file that is written continuously)
+WATCH_MAX_DEBOUNCE_PERIODS = 10
+
+
+def create_watcher(repo_root, directory, poll_interval, force_polling=False):
+    """
+    Returns an InotifyWatcher for directory where inotify is available, and a
+    PollingWatcher otherwise.
+    """
+    if not force_polling and PLATFORM_SYSTEM == "Linux":
+        try:
+            watcher = InotifyWatcher(directory, get_ignore_checker(repo_root))
+            print(f"Watching {len(watcher)} directories for changes with inotify.")
+            return watcher
+        except OSError as e:
+            print(f"Warning: Could not use inotify ({e}), polling for changes instead.")
+    print(f"Polling for changes every {poll_interval} seconds.")
+    return PollingWatcher(directory, get_ignore_checker(repo_root), poll_interval)
+
+
+def commit_changed_files(repo_root, changed_paths, state, args, author_name, author_email):
+    """
+    Commits one debounced batch of changed files in watch mode. Only the changed
+    paths are checked, by the ignore checker and status index kept from earlier
+    batches. Returns a (successful_files, failed_files) tuple of counts.
+    """
+    file_stats = {}
+    for file_path, stat_info in get_stat_collector().stat_all(sorted(changed_paths)):
+        if isinstance(stat_info, OSError):
+            continue # Deleted again before the batch was committed
+        if stat.S_ISREG(stat_info.st_mode) and not state.is_unchanged(file_path, stat_info):
+            file_stats[file_path] = stat_info
+    if not file_stats:
+        return 0, 0
+
+    if any(os.path.basename(file_path) == ".gitignore" for file_path in file_stats):
+        # git check-ignore reads each .gitignore only once, so restart it to see the change
+        get_ignore_checker(repo_root).close()
+    candidate_files = list(file_stats)
+    ignored_flags = get_ignore_checker(repo_root).check_paths(candidate_files)
+    candidate_files = [file_path for file_path, ignored in zip(candidate_files, ignored_flags) if not ignored]
+
+    status_index = get_status_index(repo_root)
+    status_index.refresh(candidate_files)
+    pending_files = []
+    for file_path in candidate_files:
+        if not status_index.has_changes(file_path):
+            state.record(file_path, file_stats[file_path])
+            continue
+        pending_files.append((file_path, get_appropriate_timestamp(repo_root, file_path, file_stats[file_path])))
+    if not pending_files:
+        return 0, 0
+
+    pending_files.sort(key=lambda x: x[1])
+    log_detail(f"\nFound {len(pending_files)} changed files.")
+    if args.group_window is not None:
+        pending_commits = group_files_by_time(pending_files, args.group_window, by_directory=args.group_by_dir)
+    else:
+        pending_commits = [([file_path], commit_datetime) for file_path, commit_datetime in pending_files]
+
+    def record_commit(files, commit_datetime, commit_hash):
+        state.update_high_water(commit_datetime)
+        for file_path in files:
+            state.record(file_path, file_stats[file_path])
+
+    with profile_phase("commit"):
+        result = execute_commits(
+            repo_root, pending_commits, author_name, author_email,
+            message_engine=resolve_message_engine(args), use_fast_import=args.fast_import, on_committed=record_commit,
         )
+    state.save(get_head_commit(repo_root))
+    return result
+
+
+def watch_command(argv):
+    """Handles `main.py watch`: commits a directory once, then keeps committing files as they change."""
+    parser = argparse.ArgumentParser(
+        prog="main.py watch",
+        description="Commit a directory, then keep watching it and commit files at their timestamps as they change. Stop with Ctrl-C."
+    )
+    parser.add_argument("path", nargs='?', default=os.getcwd(), help="Directory to watch. Defaults to the current directory if not provided.")
+    parser.add_argument("--author", help="Author of the commits (defaults to GIT_AUTHOR_NAME from .env)")
+    parser.add_argument("--email", help="Email of author (defaults to GIT_AUTHOR_EMAIL from .env)")
+    parser.add_argument("--no-ai", action="store_true", help="Disable AI and use default commit messages.")
+    parser.add_argument("--no-cache", action="store_true", help="Do not read or write the persistent AI commit message cache.")
+    add_message_engine_argument(parser)
+    parser.add_argument("--group-window", type=float, metavar="SECONDS", help="Commit files whose timestamps fall within SECONDS of each other together.")
+    parser.add_argument("--group-by-dir", action="store_true", help="With --group-window, only group files from the same directory.")
+    parser.add_argument("--full", action="store_true", help="Check every file on the initial pass instead of skipping files unchanged since the last run.")
+    parser.add_argument("--no-renames", action="store_true", help="Do not hash new files to commit moved files together with their deleted old paths.")
+    parser.add_argument("--fast-import", action="store_true", help="Create the commits of each batch with a single git fast-import run instead of git add/commit per commit.")
+    parser.add_argument("--debounce", type=float, default=2.0, metavar="SECONDS", help="Commit once no file has changed for SECONDS (default: 2).")
+    parser.add_argument("--poll-interval", type=float, default=5.0, metavar="SECONDS", help="How often the directory is scanned when inotify is not available (default: 5).")
+    parser.add_argument("--force-polling", action="store_true", help="Scan the directory periodically even where inotify is available.")
+    add_output_arguments(parser)
+    add_profile_arguments(parser)
+    args = parser.parse_args(argv)
+    start_output(args)
+
+    author_name, author_email = resolve_author(args)
+    abs_target_path = resolve_target_path(args.path)
+    if not os.path.isdir(abs_target_path):
+        print(f"Error: Path '{args.path}' (resolved to '{abs_target_path}') is not a valid directory.")
         sys.exit(1)
+    git_repo_dir = require_git_repository(abs_target_path)
+    start_profiling(args, git_repo_dir)
+
+    # Watch before the initial pass, so changes made during it are not missed
+    watcher = create_watcher(git_repo_dir, abs_target_path, args.poll_interval, args.force_polling)
+    process_repository(git_repo_dir, [abs_target_path], args, author_name, author_email)
+
+    state = load_incremental_state(git_repo_dir)
+    successful_commits = 0
+    failed_commits = 0
+    pending_paths = set()
+    first_change = None
+    print(f"\nWatching {abs_target_path} for changes. Press Ctrl-C to stop.")
+    try:
+        while True:
+            if pending_paths:
+                max_wait = first_change + args.debounce * WATCH_MAX_DEBOUNCE_PERIODS - time.monotonic()
+                changed_paths = watcher.wait(max(0.0, min(args.debounce, max_wait)))
+                if changed_paths and max_wait > 0:
+                    pending_paths.update(changed_paths)
+                    continue
+                pending_paths.update(changed_paths)
+                batch, pending_paths = pending_paths, set()
+                successful, failed = commit_changed_files(git_repo_dir, batch, state, args, author_name, author_email)
+                successful_commits += successful
+                failed_commits += failed
+            else:
+                pending_paths = watcher.wait()
+                first_change = time.monotonic()
+    except KeyboardInterrupt:
+        print("\nStopping watch mode.")
+        if pending_paths:
+            successful, failed = commit_changed_files(git_repo_dir, pending_paths, state, args, author_name, author_email)
+            successful_commits += successful
+            failed_commits += failed
+    finally:
+        watcher.close()
+        state.close()
+    print("\n--- Watch Summary ---")
+    print(f"Committed {successful_commits} changed files while watching.")
+    if failed_commits > 0:
+        print(f"Failed to commit {failed_commits} files.")
+    emit_run_summary([{"repo": git_repo_dir, "successful": successful_commits, "failed": failed_commits, "error": None}], get_run_counters())
+
+
+# Subcommands; any other first argument is treated as the path of the classic mode
+SUBCOMMANDS = {
+    "plan": plan_command,
+    "apply": apply_command,
+    "watch": watch_command,
+}
+
 
-    use_ai = not args.no_ai # Use AI by default, unless --no-ai is specified
+def commit_target(repo_root, abs_target_path, args, author_name, author_email, on_committed=None):
+    """
+    Commits a single file or a directory, calling
+    on_committed(files, datetime, commit_hash) after each successful commit.
+    Returns a (successful_files, failed_files) tuple of counts.
+    """
+    message_engine = resolve_message_engine(args)
 
-    if is_single_file:
+    if os.path.isfile(abs_target_path):
         # Commit a single file
         file_to_commit = abs_target_path # abs_target_path is already absolute
         
         # Check if file is ignored by .gitignore
-        if is_file_ignored(file_to_commit):
+        if is_file_ignored(repo_root, file_to_commit):
             print(f"File {file_to_commit} is ignored by .gitignore, skipping.")
-            return
+            return 0, 0
         
         # Check if the file is up-to-date before attempting to commit
         print(f"Checking status for single file: {file_to_commit}")
-        try:
-            status_result = subprocess.run(
-                ["git", "status", "--porcelain", file_to_commit],
-                capture_output=True,
-                text=True,
-                check=True
-            )
-            if not status_result.stdout.strip():
-                print(f"File {file_to_commit} is up to date (no changes detected). Skipping commit.")
-                return
-        except subprocess.CalledProcessError as e:
-            print(f"Warning: Could not get git status for {file_to_commit}: {e.stderr}. Assuming it needs commit.")
-        except FileNotFoundError:
-            print("Error: git command not found. Is Git installed and in your PATH?")
-            return
+        if not get_status_index(repo_root, [file_to_commit]).has_changes(file_to_commit):
+            print(f"File {file_to_commit} is up to date (no changes detected). Skipping commit.")
+            return 0, 0
 
         # Get the appropriate timestamp based on file status
-        commit_datetime = get_appropriate_timestamp(file_to_commit)
+        commit_datetime = get_appropriate_timestamp(repo_root, file_to_commit)
         commit_date = commit_datetime.date()
         print(f"Committing single file: {file_to_commit} with date {commit_date}")
         
-        commit_hash = None
-        if use_ai:
+        if message_engine == "ai":
             print("Attempting to generate commit message with AI...")
-            commit_hash = commit_files([file_to_commit], commit_datetime, author_name, author_email, use_ai_for_message=True)
-            if not commit_hash:
-                # Fallback to non-AI message
-                commit_hash = commit_files([file_to_commit], commit_datetime, author_name, author_email, use_ai_for_message=False)
+        elif message_engine == "heuristic":
+            print("Generating a heuristic commit message.")
         else:
             print("AI disabled, using default commit message.")
-            commit_hash = commit_files([file_to_commit], commit_datetime, author_name, author_email, use_ai_for_message=False)
+        with profile_phase("commit"):
+            if args.fast_import:
+                committed = commit_with_fast_import(repo_root, [([file_to_commit], commit_datetime)], author_name, author_email, message_engine=message_engine)
+                commit_hash = committed[0][2] if committed else None
+            else:
+                commit_hash = commit_files(repo_root, [file_to_commit], commit_datetime, author_name, author_email, message_engine=message_engine)
 
+        print_message_cache_summary(repo_root)
+        print_api_summary()
         if commit_hash:
             print(f"Single file commit successful: {commit_hash}")
-        else:
-            print("Single file commit failed after all attempts.")
-    else: # It's a directory
-        # Recursively find all files in the directory and collect their timestamps
-        # abs_target_path is the absolute path to the directory
-        files_with_timestamps = []
-        for root, _, files in os.walk(abs_target_path):
-            # Skip the .git directory and its contents
-            if ".git" in root:
-                continue
-            for file in files:
-                file_path = os.path.join(root, file)
-                
-                # Check if file is ignored by .gitignore
-                if is_file_ignored(file_path):
-                    print(f"File {file_path} is ignored by .gitignore, skipping.")
+            emit_event("commit", repo=repo_root, files=relative_paths([file_to_commit], repo_root), datetime=commit_datetime.isoformat(), commit=commit_hash)
+            if on_committed is not None:
+                on_committed([file_to_commit], commit_datetime, commit_hash)
+            return 1, 0
+        print("Single file commit failed after all attempts.")
+        emit_event("commit_failed", repo=repo_root, files=relative_paths([file_to_commit], repo_root), datetime=commit_datetime.isoformat())
+        return 0, 1
+
+    # It's a directory
+    state = load_incremental_state(repo_root, args.full)
+    head_at_start = get_head_commit(repo_root)
+    with profile_phase("classify"):
+        pending_commits, file_stats = plan_directory_commits(repo_root, abs_target_path, state, args.group_window, args.group_by_dir, not args.no_renames)
+    if not pending_commits:
+        state.save(head_at_start)
+        state.close()
+        return 0, 0
+
+    def record_commit(files, commit_datetime, commit_hash):
+        state.update_high_water(commit_datetime)
+        for file_path in files:
+            if file_path in file_stats: # Not the deleted old path of a moved file
+                state.record(file_path, file_stats[file_path])
+        if on_committed is not None:
+            on_committed(files, commit_datetime, commit_hash)
+
+    with profile_phase("commit"):
+        successful_commits, failed_commits = execute_commits(
+            repo_root, pending_commits, author_name, author_email,
+            message_engine=message_engine, use_fast_import=args.fast_import, on_committed=record_commit,
+        )
+    state.save(get_head_commit(repo_root))
+    state.close()
+    print_commit_summary(repo_root, successful_commits, failed_commits)
+    return successful_commits, failed_commits
+
+
+def process_repository(repo_root, target_paths, args, author_name, author_email, on_committed=None):
+    """
+    Commits each of target_paths, all inside repo_root, one after another.
+    Returns a summary dict with the keys 'repo', 'successful', 'failed' and 'error'.
+    """
+    require_git_repository(repo_root)
+
+    message_engine = resolve_message_engine(args)
+    if message_engine == "ai" and not args.no_cache:
+        enable_message_cache(repo_root)
+
+    summary = {"repo": repo_root, "successful": 0, "failed": 0, "error": None}
+    for abs_target_path in target_paths:
+        successful_commits, failed_commits = commit_target(repo_root, abs_target_path, args, author_name, author_email, on_committed)
+        summary["successful"] += successful_commits
+        summary["failed"] += failed_commits
+    return summary
+
+
+def release_shared_helpers(repo_root):
+    """
+    Closes the git processes, caches and indexes shared within repo_root. atexit
+    handlers do not run in pool workers, so workers call this themselves once
+    their repository is done.
+    """
+    with _shared_helpers_lock:
+        ignore_checker = _ignore_checkers.pop(repo_root, None)
+        blob_hasher = _blob_hashers.pop(repo_root, None)
+        message_cache = _message_caches.pop(repo_root, None)
+        _status_indexes.pop(repo_root, None)
+        _content_indexes.pop(repo_root, None)
+    if ignore_checker is not None:
+        ignore_checker.close()
+    if blob_hasher is not None:
+        blob_hasher.close()
+    if message_cache is not None:
+        message_cache.close()
+
+
+CommitResult = collections.namedtuple("CommitResult", ["files", "datetime", "commit"])
+
+# The settings and sys.stdout are process-wide, so committers take turns
+_committer_lock = threading.RLock()
+
+
+class FilestampCommitter:
+    """
+    Library interface to the tool: commits files of one repository at their
+    filesystem timestamps and returns the results instead of exiting.
+
+        committer = FilestampCommitter("/path/to/repo", author="Jane", email="jane@example.com",
+                                       message_engine="heuristic")
+        result = committer.commit()
+        for commit in result["commits"]:
+            print(commit.commit, commit.files)
+
+    The configuration is read from the environment and .env at the start of
+    every run; keyword arguments take precedence. Settings and sys.stdout
+    (which quiet redirects) are process-wide, so runs of committers in
+    different threads take turns instead of running side by side. Use one
+    process per repository, as --jobs does, to run them in parallel.
+    """
+
+    def __init__(self, repo_path, author=None, email=None, message_engine="ai", use_cache=True,
+                 group_window=None, group_by_dir=False, full=False, fast_import=False,
+                 env_file=None, quiet=False, detect_renames=True):
+        if message_engine not in MESSAGE_ENGINES:
+            raise ValueError(f"message_engine must be one of {', '.join(MESSAGE_ENGINES)}")
+        self.env_file = env_file
+        self.quiet = quiet
+        with _committer_lock:
+            load_config(env_file)
+            self.author = author or GIT_AUTHOR_NAME
+            self.email = email or GIT_AUTHOR_EMAIL
+            if not self.author or not self.email:
+                raise ValueError("An author name and email are required, as arguments or GIT_AUTHOR_NAME/GIT_AUTHOR_EMAIL")
+            abs_repo_path = resolve_target_path(repo_path)
+            with self._output():
+                self.repo_root = get_git_repo_root(abs_repo_path) if os.path.exists(abs_repo_path) else None
+        if not self.repo_root:
+            raise ValueError(f"{repo_path} is not inside a git repository")
+        # The same options the command line parser produces
+        self._options = argparse.Namespace(
+            message_engine=message_engine, no_ai=message_engine != "ai", no_cache=not use_cache,
+            group_window=group_window, group_by_dir=group_by_dir, full=full, fast_import=fast_import,
+            no_renames=not detect_renames,
+        )
+
+    def _output(self):
+        # Progress messages are printed as usual, or discarded when quiet
+        if self.quiet:
+            return contextlib.redirect_stdout(io.StringIO())
+        return contextlib.ExitStack()
+
+    def _resolve_targets(self, paths):
+        if not paths:
+            return [self.repo_root]
+        targets = []
+        for path in paths:
+            abs_path = resolve_target_path(os.path.join(self.repo_root, path))
+            if not os.path.exists(abs_path):
+                raise ValueError(f"{path} does not exist")
+            targets.append(abs_path)
+        return targets
+
+    @contextlib.contextmanager
+    def _in_repository(self):
+        with _committer_lock:
+            # Another committer may have loaded different settings since
+            load_config(self.env_file)
+            reset_completion_client()
+            try:
+                with self._output():
+                    yield
+            finally:
+                release_shared_helpers(self.repo_root)
+
+    def plan(self, *paths):
+        """
+        Returns the commits a run would create for paths (relative to the
+        repository root; by default the whole repository) as a list of
+        (files, datetime) tuples, without committing or saving anything.
+        """
+        pending = []
+        with self._in_repository():
+            for abs_target_path in self._resolve_targets(paths):
+                if os.path.isfile(abs_target_path):
+                    if not is_file_ignored(self.repo_root, abs_target_path) and get_status_index(self.repo_root, [abs_target_path]).has_changes(abs_target_path):
+                        pending.append(([abs_target_path], get_appropriate_timestamp(self.repo_root, abs_target_path)))
                     continue
-                
-                # Get the appropriate timestamp based on file status
-                commit_datetime = get_appropriate_timestamp(file_path)
-                files_with_timestamps.append((file_path, commit_datetime))
-        
-        if not files_with_timestamps:
-            print("No files found to commit in the specified directory and its subdirectories.")
-            return
+                state = load_incremental_state(self.repo_root, self._options.full)
+                commits, _ = plan_directory_commits(
+                    self.repo_root, abs_target_path, state, self._options.group_window, self._options.group_by_dir, not self._options.no_renames
+                )
+                state.close()
+                pending.extend(commits)
+        return pending
 
-        # Sort files by timestamp (oldest first)
-        files_with_timestamps.sort(key=lambda x: x[1])
-        
-        print(f"Found {len(files_with_timestamps)} files. Sorting by timestamp and committing in order.")
+    def commit(self, *paths):
+        """
+        Commits paths (relative to the repository root; by default the whole
+        repository) like the command line tool does.
+        Returns a dict with the keys 'repo', 'successful' and 'failed' (file
+        counts), 'error' (None on success) and 'commits', a list of CommitResult.
+        """
+        commits = []
 
-        successful_commits = 0
-        failed_commits = 0
-        for file_to_commit, commit_datetime in files_with_timestamps:
-            commit_date = commit_datetime.date()
-            print(f"\n--- Processing file: {file_to_commit} (Date: {commit_date}) ---")
+        def on_committed(files, commit_datetime, commit_hash):
+            commits.append(CommitResult(list(files), commit_datetime, commit_hash))
 
-            # Check if the file is up-to-date before attempting to commit
-            print(f"Checking status for file: {file_to_commit}")
+        with self._in_repository():
             try:
-                status_result = subprocess.run(
-                    ["git", "status", "--porcelain", file_to_commit],
-                    capture_output=True,
-                    text=True,
-                    check=True
+                summary = process_repository(
+                    self.repo_root, self._resolve_targets(paths), self._options,
+                    self.author, self.email, on_committed=on_committed,
                 )
-                if not status_result.stdout.strip():
-                    print(f"File {file_to_commit} is up to date (no changes detected). Skipping commit.")
-                    continue # Skip to the next file in the loop
-            except subprocess.CalledProcessError as e:
-                print(f"Warning: Could not get git status for {file_to_commit}: {e.stderr}. Assuming it needs commit.")
-            except FileNotFoundError:
-                print("Error: git command not found. Is Git installed and in your PATH?")
-                # If git is not found, we can't proceed with any commits.
-                # Depending on desired behavior, could break or just fail this one.
-                # For now, let's just fail this one and continue to next if possible,
-                # though if git is not found, subsequent calls will also fail.
-                failed_commits +=1
-                continue
+            except SystemExit as e:
+                summary = {"repo": self.repo_root, "successful": 0, "failed": 0, "error": f"exited with status {e.code}"}
+        summary["commits"] = commits
+        return summary
 
-            print(f"Committing file: {file_to_commit} with date {commit_date}")
-            
-            commit_hash = None
-            if use_ai:
-                print("Attempting to generate commit message with AI...")
-                commit_hash = commit_files([file_to_commit], commit_datetime, author_name, author_email, use_ai_for_message=True)
-                if not commit_hash:
-                    # Fallback to non-AI message
-                    commit_hash = commit_files([file_to_commit], commit_datetime, author_name, author_email, use_ai_for_message=False)
-            else:
-                print("AI disabled, using default commit message.")
-                commit_hash = commit_files([file_to_commit], commit_datetime, author_name, author_email, use_ai_for_message=False)
 
-            if commit_hash:
-                print(f"Individual file commit successful: {commit_hash}")
-                successful_commits += 1
-            else:
-                print(f"Individual file commit failed: {file_to_commit}")
-                failed_commits += 1
-        
-        print("\n--- Directory Commit Summary ---")
-        print(f"Successfully committed {successful_commits} files.")
-        if failed_commits > 0:
-            print(f"Failed to commit {failed_commits} files.")
+def _repository_worker(task):
+    # Runs process_repository() in a pool worker. The worker's output is captured
+    # and handed back with the summary, so repositories do not interleave their logs.
+    global _profiler
+    repo_root, target_paths, args, author_name, author_email = task
+    # Workers started with the spawn method import this module afresh
+    load_config()
+    output = io.StringIO()
+    events = io.StringIO()
+    # The events are handed back too, and written by the parent alone
+    start_output(args, event_stream=events)
+    with contextlib.redirect_stdout(output):
+        if args.profile is not None:
+            # Each repository gets its own report in its .git directory
+            _profiler = Profiler(repo_root=repo_root)
+        try:
+            summary = process_repository(repo_root, target_paths, args, author_name, author_email)
+        except SystemExit as e:
+            summary = {"repo": repo_root, "successful": 0, "failed": 0, "error": f"exited with status {e.code}"}
+        except Exception as e:
+            summary = {"repo": repo_root, "successful": 0, "failed": 0, "error": f"{type(e).__name__}: {e}"}
+        finally:
+            summary_counters = get_run_counters()
+            release_shared_helpers(repo_root)
+            if _stat_collector is not None:
+                _stat_collector.close()
+            if _profiler is not None:
+                _profiler.write_report()
+    summary["counters"] = summary_counters
+    summary["output"] = output.getvalue()
+    if _event_log is not None:
+        _event_log.flush()
+    summary["events"] = events.getvalue()
+    return summary
+
+
+def list_submodules(repo_root):
+    """Returns the absolute paths of the checked-out submodules of repo_root, including nested ones."""
+    try:
+        result = run_git(
+            ["git", "submodule", "foreach", "--quiet", "--recursive", "pwd"],
+            capture_output=True,
+            text=True,
+            check=True,
+            cwd=repo_root,
+        )
+    except subprocess.CalledProcessError as e:
+        print(f"Warning: Could not list the submodules of {repo_root}: {e.stderr.strip()}")
+        return []
+    return [line for line in result.stdout.splitlines() if line]
+
+
+def group_targets_by_repository(target_paths, include_submodules=False):
+    """
+    Resolves the repository of each target. With include_submodules, the
+    submodules found under each target are added as targets of their own.
+    Returns an ordered dict mapping each repository root to its targets.
+    Exits if a target is not inside a git repository.
+    """
+    repositories = collections.OrderedDict()
+    for abs_target_path in target_paths:
+        repo_root = get_git_repo_root(abs_target_path)
+        if not repo_root:
+            print(f"Error: Could not determine the git repository root of '{abs_target_path}'. Please ensure it is inside a git repository.")
+            sys.exit(1)
+        repositories.setdefault(repo_root, []).append(abs_target_path)
+
+        if include_submodules and os.path.isdir(abs_target_path):
+            target_prefix = os.path.join(os.path.realpath(abs_target_path), "")
+            for submodule_root in list_submodules(repo_root):
+                if os.path.join(os.path.realpath(submodule_root), "").startswith(target_prefix):
+                    repositories.setdefault(submodule_root, [submodule_root])
+    return repositories
+
+
+def print_repositories_summary(summaries):
+    print(f"\n--- Summary across {len(summaries)} repositories ---")
+    for summary in summaries:
+        if summary["error"]:
+            print(f"{summary['repo']}: error: {summary['error']}")
+        elif summary["failed"]:
+            print(f"{summary['repo']}: {summary['successful']} files committed, {summary['failed']} failed")
+        else:
+            print(f"{summary['repo']}: {summary['successful']} files committed")
+    successful_commits = sum(summary["successful"] for summary in summaries)
+    failed_commits = sum(summary["failed"] for summary in summaries)
+    errors = sum(1 for summary in summaries if summary["error"])
+    print(f"Successfully committed {successful_commits} files.")
+    if failed_commits > 0:
+        print(f"Failed to commit {failed_commits} files.")
+    if errors:
+        print(f"{errors} repositories could not be processed.")
+
+
+def main():
+    load_config()
+    if len(sys.argv) > 1 and sys.argv[1] in SUBCOMMANDS:
+        SUBCOMMANDS[sys.argv[1]](sys.argv[2:])
+        return
+
+    parser = argparse.ArgumentParser(
+        description="Populate Git repo with historical commits, using AI for messages by default with fallback.",
+        epilog="Subcommands: `main.py plan [path]` writes the commit plan of a directory to a file, `main.py apply [plan_file]` creates its commits, resuming after interruptions, and `main.py watch [path]` keeps committing files as they change.",
+    )
+    parser.add_argument("path", nargs='*', help="Paths to files or directories to commit, in one or more repositories. Defaults to the current directory if not provided.")
+    parser.add_argument("--author", help="Author of the commits (defaults to GIT_AUTHOR_NAME from .env)")
+    parser.add_argument("--email", help="Email of author (defaults to GIT_AUTHOR_EMAIL from .env)")
+    parser.add_argument("--no-ai", action="store_true", help="Disable AI and use default commit messages.")
+    parser.add_argument("--no-cache", action="store_true", help="Do not read or write the persistent AI commit message cache.")
+    add_message_engine_argument(parser)
+    parser.add_argument("--group-window", type=float, metavar="SECONDS", help="In directory mode, commit files whose timestamps fall within SECONDS of each other together.")
+    parser.add_argument("--group-by-dir", action="store_true", help="With --group-window, only group files from the same directory.")
+    parser.add_argument("--full", action="store_true", help="In directory mode, check every file again instead of skipping files unchanged since the last run.")
+    parser.add_argument("--no-renames", action="store_true", help="Do not hash new files to commit moved files together with their deleted old paths.")
+    parser.add_argument("--fast-import", action="store_true", help="Create all commits with a single git fast-import run instead of git add/commit per file.")
+    parser.add_argument("--submodules", action="store_true", help="Also commit the files of every submodule under the given directories, each in its own repository.")
+    parser.add_argument("--jobs", type=int, metavar="N", help="Number of repositories processed in parallel (defaults to the number of CPUs).")
+    add_output_arguments(parser)
+    add_profile_arguments(parser)
+    args = parser.parse_args()
+    start_output(args)
+
+    author_name, author_email = resolve_author(args)
+
+    # Determine the actual directories for git operations
+    target_paths = [resolve_target_path(path) for path in args.path] or [os.getcwd()]
+    for path, abs_target_path in zip(args.path, target_paths):
+        if not os.path.isfile(abs_target_path) and not os.path.isdir(abs_target_path):
+            print(f"Error: Path '{path}' (resolved to '{abs_target_path}') is not a valid file or directory.")
+            sys.exit(1)
+
+    repositories = group_targets_by_repository(target_paths, args.submodules)
+
+    if len(repositories) == 1:
+        repo_root, repo_targets = next(iter(repositories.items()))
+        start_profiling(args, repo_root)
+        summary = process_repository(repo_root, repo_targets, args, author_name, author_email)
+        emit_run_summary([summary], get_run_counters())
+        return
+
+    # Each repository is handled by a fresh worker process, so the output of one
+    # repository never interleaves with another's.
+    jobs = max(1, min(args.jobs or os.cpu_count() or 1, len(repositories)))
+    print(f"Processing {len(repositories)} repositories, {jobs} at a time.")
+    tasks = [(repo_root, repo_targets, args, author_name, author_email) for repo_root, repo_targets in repositories.items()]
+    summaries = []
+    if _event_log is not None:
+        _event_log.flush() # Forked workers must not inherit buffered events
+    with multiprocessing.Pool(processes=jobs, maxtasksperchild=1) as pool:
+        for summary in pool.imap_unordered(_repository_worker, tasks):
+            print(f"\n=== {summary['repo']} ===")
+            print(summary.pop("output"), end="")
+            events = summary.pop("events")
+            if _event_log is not None:
+                _event_log.write(events)
+            summaries.append(summary)
+
+    # Report in the order the repositories were given
+    order = list(repositories)
+    summaries.sort(key=lambda summary: order.index(summary["repo"]))
+    print_repositories_summary(summaries)
+    emit_run_summary(summaries)
+    if any(summary["error"] for summary in summaries):
+        sys.exit(1)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,36 @@
+import os
+import subprocess
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import main  # noqa: E402
+
+
+def git(repo, *args):
+    """Runs a git command in repo and returns its stdout."""
+    return subprocess.run(
+        ["git", "-c", "user.name=Test", "-c", "user.email=test@example.com"] + list(args),
+        cwd=repo, check=True, capture_output=True, text=True,
+    ).stdout
+
+
+def write(repo, relative_path, content):
+    """Writes content to relative_path under repo, creating its directories, and returns its path."""
+    path = os.path.join(repo, *relative_path.split("/"))
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "w") as f:
+        f.write(content)
+    return path
+
+
+@pytest.fixture
+def repo(tmp_path):
+    """An empty git repository; the helpers shared within it are released afterwards."""
+    repo_root = os.path.realpath(str(tmp_path / "repo"))
+    os.makedirs(repo_root)
+    git(repo_root, "init", "-q")
+    yield repo_root
+    main.release_shared_helpers(repo_root)
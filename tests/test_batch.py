@@ -0,0 +1,74 @@
+import pytest
+
+import main
+
+
+@pytest.mark.parametrize("reply, expected", [
+    ('["feat: add a", "fix: b"]', ["feat: add a", "fix: b"]),
+    ('Here you go:\n```json\n["feat: add a", "fix: b"]\n```', ["feat: add a", "fix: b"]),
+    ('["\\"feat: add a\\"", 3]', ["feat: add a", None]),
+    ('["", "fix: b"]', [None, "fix: b"]),
+    ('["only one"]', None),
+    ('["feat: a", "fix: b", "docs: c"]', None),
+    ('{"messages": ["feat: a", "fix: b"]}', ["feat: a", "fix: b"]),
+    ("feat: a\nfix: b", None),
+    ('["feat: a", "fix: b"', None),
+])
+def test_parse_batch_reply(reply, expected):
+    assert main.parse_batch_reply(reply, 2) == expected
+
+
+def prompt_input(name, message=None, diff_output="diff"):
+    return {"repo_root": "/nowhere", "files": [name], "cache_key": None, "message": message,
+            "diff_output": diff_output, "truncated_notice": ""}
+
+
+@pytest.fixture
+def prompts(monkeypatch):
+    """Makes request_completion() answer with the items of the returned list and records the prompts."""
+    replies = []
+    sent = []
+
+    def request_completion(prompt, max_tokens=None, single_line=False):
+        sent.append(prompt)
+        return replies.pop(0)
+
+    monkeypatch.setattr(main, "request_completion", request_completion)
+    return replies, sent
+
+
+def test_batch_uses_one_request(prompts):
+    replies, sent = prompts
+    replies.append('["feat: add a", "fix: repair c"]')
+    batch = [prompt_input("a"), prompt_input("b", message="cached"), prompt_input("c"), prompt_input("d", diff_output=None)]
+    assert main.complete_commit_prompt_batch(batch) == ["feat: add a", "cached", "fix: repair c", None]
+    assert len(sent) == 1
+    assert "### Commit 2" in sent[0] and "### Commit 3" not in sent[0]
+
+
+def test_batch_mismatch_falls_back_to_single_requests(prompts):
+    replies, sent = prompts
+    replies.extend(['["feat: add a"]', "feat: add a", "fix: repair b"])
+    assert main.complete_commit_prompt_batch([prompt_input("a"), prompt_input("b")]) == ["feat: add a", "fix: repair b"]
+    assert len(sent) == 3
+
+
+def test_batch_unusable_entry_gets_its_own_request(prompts):
+    replies, sent = prompts
+    replies.extend(['["feat: add a", null]', "fix: repair b"])
+    assert main.complete_commit_prompt_batch([prompt_input("a"), prompt_input("b")]) == ["feat: add a", "fix: repair b"]
+    assert len(sent) == 2
+
+
+def test_failed_batch_request_falls_back(prompts):
+    replies, sent = prompts
+    replies.extend([None, None, "fix: repair b"])
+    assert main.complete_commit_prompt_batch([prompt_input("a"), prompt_input("b")]) == [None, "fix: repair b"]
+    assert len(sent) == 3
+
+
+def test_single_commit_is_not_batched(prompts):
+    replies, sent = prompts
+    replies.append("feat: add a")
+    assert main.complete_commit_prompt_batch([prompt_input("a")]) == ["feat: add a"]
+    assert "### Commit" not in sent[0]
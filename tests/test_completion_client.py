@@ -0,0 +1,114 @@
+import threading
+from datetime import datetime, timedelta, timezone
+import email.utils
+
+import pytest
+
+import main
+
+
+class FakeResponse:
+    def __init__(self, status_code, headers=None):
+        self.status_code = status_code
+        self.headers = headers or {}
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise main.requests.exceptions.HTTPError(f"HTTP {self.status_code}", response=self)
+
+
+@pytest.fixture
+def replies(monkeypatch):
+    """Makes post_api_request() answer with the items of the returned list, raising exceptions among them."""
+    main.import_requests()
+    queue = []
+
+    def post_api_request(headers, data):
+        reply = queue.pop(0)
+        if isinstance(reply, BaseException):
+            raise reply
+        return reply
+
+    monkeypatch.setattr(main, "post_api_request", post_api_request)
+    monkeypatch.setattr(main.time, "sleep", lambda seconds: None)
+    return queue
+
+
+def post_in_thread(client):
+    # A leaked slot makes post() block forever, so give up after a while
+    result = {}
+
+    def run():
+        result["response"] = client.post({}, {}, 10)
+
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    thread.join(5)
+    assert not thread.is_alive(), "post() is blocked waiting for a request slot"
+    return result["response"]
+
+
+@pytest.mark.parametrize("error", [
+    lambda: main.requests.exceptions.InvalidURL("no host"),
+    lambda: main.requests.exceptions.ChunkedEncodingError("cut"),
+    lambda: RuntimeError("bug"),
+], ids=["invalid-url", "chunked-encoding", "other"])
+def test_failed_request_frees_its_slot(replies, error):
+    client = main.CompletionClient(max_concurrency=1, requests_per_minute=0, tokens_per_minute=0, max_retries=0)
+    replies.extend([error(), FakeResponse(200), FakeResponse(200)])
+    with pytest.raises(Exception):
+        client.post({}, {}, 10)
+    assert post_in_thread(client).status_code == 200
+    assert post_in_thread(client).status_code == 200
+    assert client._in_flight == 0
+
+
+def test_connection_errors_are_retried(replies):
+    client = main.CompletionClient(max_concurrency=2, requests_per_minute=0, tokens_per_minute=0, max_retries=2)
+    replies.extend([main.requests.exceptions.ConnectionError("refused"), FakeResponse(200)])
+    assert client.post({}, {}, 10).status_code == 200
+    assert (client.requests, client.retries, client._in_flight) == (2, 1, 0)
+
+
+def test_throttling_honours_retry_after_and_halves_concurrency(replies):
+    client = main.CompletionClient(max_concurrency=4, requests_per_minute=0, tokens_per_minute=0, max_retries=3)
+    replies.extend([FakeResponse(429, {"Retry-After": "0"}), FakeResponse(200)])
+    assert client.post({}, {}, 10).status_code == 200
+    assert client.throttled == 1
+    assert client.retries == 1
+    assert client.concurrency == 2
+
+
+def test_retries_give_up_with_the_last_error(replies):
+    client = main.CompletionClient(max_concurrency=1, requests_per_minute=0, tokens_per_minute=0, max_retries=1)
+    replies.extend([FakeResponse(503), FakeResponse(503)])
+    with pytest.raises(main.requests.exceptions.HTTPError):
+        client.post({}, {}, 10)
+    assert (client.server_errors, client.failures, client._in_flight) == (2, 1, 0)
+
+
+def test_retry_after_seconds_and_dates():
+    assert main.CompletionClient._retry_after_seconds(FakeResponse(429, {"Retry-After": "7"})) == 7.0
+    assert main.CompletionClient._retry_after_seconds(FakeResponse(429, {"Retry-After": "-3"})) == 0.0
+    retry_at = datetime.now(timezone.utc) + timedelta(seconds=120)
+    delay = main.CompletionClient._retry_after_seconds(FakeResponse(429, {"Retry-After": email.utils.format_datetime(retry_at)}))
+    assert 100 < delay <= 120
+    assert main.CompletionClient._retry_after_seconds(FakeResponse(429, {"Retry-After": "soon"})) is None
+    assert main.CompletionClient._retry_after_seconds(FakeResponse(429)) is None
+    assert main.CompletionClient._retry_after_seconds(None) is None
+
+
+def test_token_bucket_waits_for_refills(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(main.time, "monotonic", lambda: now[0])
+    bucket = main.TokenBucket(60) # One token per second
+    assert bucket.reserve(60) == 0.0
+    assert bucket.reserve(1) == pytest.approx(1.0)
+    now[0] += 3
+    assert bucket.reserve(1) == 0.0
+    # More than the bucket holds waits for a full bucket instead of forever
+    assert bucket.reserve(500) == pytest.approx(59.0)
+
+
+def test_token_bucket_without_a_limit():
+    assert main.TokenBucket(0).reserve(10 ** 9) == 0.0
@@ -0,0 +1,138 @@
+import main
+from conftest import git, write
+
+
+DIFF = """\
+diff --git a/src/app.py b/src/app.py
+index 1111111..2222222 100644
+--- a/src/app.py
++++ b/src/app.py
+@@ -1,3 +1,4 @@
+ import os
+-x = 1
++x = 2
++y = 3
+@@ -10,2 +11,2 @@ def run():
+-    pass
++    return x
+diff --git a/old.txt b/old.txt
+deleted file mode 100644
+index 3333333..0000000
+--- a/old.txt
++++ /dev/null
+@@ -1 +0,0 @@
+-gone
+diff --git a/logo.png b/logo.png
+new file mode 100644
+index 0000000..4444444
+Binary files /dev/null and b/logo.png differ
+"""
+
+
+def test_parse_diff_files_hunks_and_diffstats():
+    app, old, logo = main.parse_diff(DIFF)
+    assert app["path"] == "src/app.py"
+    assert app["header"] == ["diff --git a/src/app.py b/src/app.py"]
+    assert [hunk[0] for hunk in app["hunks"]] == ["@@ -1,3 +1,4 @@", "@@ -10,2 +11,2 @@ def run():"]
+    assert app["diffstat"] == (3, 2)
+
+    assert old["path"] == "old.txt"
+    assert "deleted file mode 100644" in old["header"]
+    assert old["diffstat"] == (0, 1)
+
+    assert logo["path"] == "logo.png"
+    assert logo["hunks"] == []
+    assert logo["diffstat"] is None
+
+
+def test_parse_diff_drops_the_cut_line_of_incomplete_output():
+    cut = DIFF[:DIFF.index("+y = 3") + len("+y")]
+    (app,) = main.parse_diff(cut, complete=False)
+    assert app["hunks"] == [["@@ -1,3 +1,4 @@", " import os", "-x = 1", "+x = 2"]]
+    assert app["diffstat"] == (1, 1)
+
+
+def test_estimate_tokens():
+    assert main.estimate_tokens("") == 0
+    assert main.estimate_tokens("hello world") == 2
+    # Long words take several tokens, digits go in groups of three
+    assert main.estimate_tokens("internationalization") == 4
+    assert main.estimate_tokens("1234567") == 3
+    assert main.estimate_tokens("x = f(a, b)") == 8
+    # Code is denser in tokens than its length in characters suggests
+    code = "    return {key: value for key, value in items.items() if value is not None}\n"
+    assert len(code) // 4 < main.estimate_tokens(code) < len(code)
+
+
+def hunk(start, lines):
+    return [f"@@ -{start},{len(lines)} +{start},{len(lines)} @@"] + lines
+
+
+def diff_file(path, hunks):
+    return {"path": path, "header": [f"diff --git a/{path} b/{path}"], "hunks": hunks, "diffstat": (1, 1)}
+
+
+def test_compact_diff_keeps_everything_within_the_budget():
+    text, omitted = main.compact_diff(main.parse_diff(DIFF), 1000)
+    assert omitted == 0
+    assert "+y = 3" in text and "-gone" in text and "Binary files" in text
+
+
+def test_compact_diff_prefers_salient_hunks_of_every_file():
+    noise = [f"+# comment {i}" for i in range(3)]
+    definition = ["+def handler(event):", "+    return event", "-def old_handler():"]
+    files = [
+        diff_file("a.py", [hunk(1, noise), hunk(50, definition), hunk(90, noise)]),
+        diff_file("b.py", [hunk(1, ["-x = 1", "+x = 2"])]),
+    ]
+    budget = 120
+    text, omitted = main.compact_diff(files, budget)
+    assert main.estimate_tokens(text) <= budget
+    assert omitted == 2
+    # The definitions of a.py and the only hunk of b.py are kept, in the original order
+    assert "+def handler(event):" in text
+    assert "+x = 2" in text
+    assert "# comment" not in text
+    assert "(... 2 more hunks of this file not shown)" in text
+    assert text.index("a.py") < text.index("b.py")
+
+
+def test_compact_diff_shows_the_start_of_a_hunk_too_large():
+    lines = [f"+line number {i} of a long addition" for i in range(200)]
+    text, omitted = main.compact_diff([diff_file("big.py", [hunk(1, lines)])], 80)
+    assert omitted == 0
+    assert "+line number 0 of a long addition" in text
+    assert "+line number 199" not in text
+    assert text.rstrip("\n").endswith(" ...")
+    assert main.estimate_tokens(text) <= 80
+
+
+def test_diffstat_summary_is_cut_to_the_budget():
+    diffstat = {f"src/module{i}.py": (i, 1) for i in range(100)}
+    diffstat["logo.png"] = None
+    summary = main.format_diffstat_summary(diffstat, ["new.py"], 50)
+    assert summary.startswith("Changed files (lines added and removed):\nsrc/module0.py | +0 -1\n")
+    assert "more files)" in summary
+    assert main.estimate_tokens(summary) <= 50 + 10
+    full = main.format_diffstat_summary(diffstat, ["new.py"], 10 ** 6)
+    assert "logo.png | binary" in full and "new.py | new file" in full
+
+
+def test_change_summary_fits_the_token_limit(repo, monkeypatch):
+    paths = []
+    for i in range(20):
+        paths.append(write(repo, f"src/module{i}.py", "".join(f"value_{n} = {n}\n" for n in range(60))))
+    git(repo, "add", "-A")
+    git(repo, "commit", "-qm", "base")
+    for file_path in paths:
+        with open(file_path, "a") as f:
+            f.write("".join(f"def added_{n}():\n    return {n}\n" for n in range(30)))
+    git(repo, "add", "-A")
+    monkeypatch.setattr(main, "DIFF_TOKEN_LIMIT", 400)
+    diff_output, notice = main.get_change_summary(repo, paths)
+    assert main.estimate_tokens(diff_output) <= 400
+    # The file summary gets a quarter of the limit, the diff the rest
+    assert diff_output.startswith("Changed files (lines added and removed):\nsrc/module0.py | +60 -0\n")
+    assert "more files)" in diff_output
+    assert "+def added_0():" in diff_output
+    assert "only its most significant changes are shown" in notice
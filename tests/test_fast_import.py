@@ -0,0 +1,123 @@
+import os
+import stat
+import subprocess
+from datetime import datetime
+
+import main
+from conftest import git, write
+
+
+FIRST = datetime(2024, 2, 1, 9, 30, 0)
+SECOND = datetime(2024, 2, 2, 17, 45, 0)
+
+
+def git_bytes(repo, *args):
+    return subprocess.run(["git"] + list(args), cwd=repo, check=True, capture_output=True).stdout
+
+
+def ls_tree(repo):
+    """Returns {path: (mode, blob)} for HEAD, with paths as bytes."""
+    output = git_bytes(repo, "ls-tree", "-r", "-z", "HEAD")
+    entries = {}
+    for record in output.split(b"\0")[:-1]:
+        info, path = record.split(b"\t", 1)
+        mode, _, blob = info.decode().split(" ")
+        entries[path] = (mode, blob)
+    return entries
+
+
+def fast_import(repo, commits):
+    return main.commit_with_fast_import(repo, commits, "Test", "test@example.com")
+
+
+def test_fast_import_round_trip(repo):
+    write(repo, "gone.txt", "old content\n")
+    git(repo, "add", "-A")
+    git(repo, "commit", "-qm", "base")
+    os.remove(os.path.join(repo, "gone.txt"))
+
+    plain = write(repo, "src/plain.py", "print('plain')\n")
+    script = write(repo, "bin/run.sh", "#!/bin/sh\necho run\n")
+    os.chmod(script, 0o744)
+    # git only looks at the owner's execute bit
+    group_only = write(repo, "bin/group.sh", "echo group\n")
+    os.chmod(group_only, 0o654)
+    link = os.path.join(repo, "src", "link.py")
+    os.symlink("plain.py", link)
+    latin1 = os.fsdecode(os.path.join(os.fsencode(repo), b"caf\xe9.txt"))
+    with open(latin1, "w") as f:
+        f.write("latin-1 name\n")
+    odd = write(repo, "new\nline.txt", "odd name\n")
+
+    committed = fast_import(repo, [
+        ([plain, script, group_only], FIRST),
+        ([os.path.join(repo, "gone.txt"), link, latin1, odd], SECOND),
+    ])
+    assert [(files, commit_datetime) for files, commit_datetime, _ in committed] == [
+        ([plain, script, group_only], FIRST),
+        ([os.path.join(repo, "gone.txt"), link, latin1, odd], SECOND),
+    ]
+    assert all(commit_hash for _, _, commit_hash in committed)
+    assert git(repo, "rev-parse", "HEAD").strip() == committed[-1][2]
+    assert git(repo, "log", "--format=%at %an", "-2").split("\n")[:2] == [
+        f"{int(SECOND.timestamp())} Test",
+        f"{int(FIRST.timestamp())} Test",
+    ]
+
+    tree = ls_tree(repo)
+    assert b"gone.txt" not in tree
+    assert tree[b"src/plain.py"][0] == "100644"
+    assert tree[b"bin/run.sh"][0] == "100755"
+    assert tree[b"bin/group.sh"][0] == "100644"
+    assert tree[b"src/link.py"][0] == "120000"
+    assert git_bytes(repo, "cat-file", "blob", tree[b"src/link.py"][1]) == b"plain.py"
+    assert git_bytes(repo, "cat-file", "blob", tree[b"caf\xe9.txt"][1]) == b"latin-1 name\n"
+    assert git_bytes(repo, "cat-file", "blob", tree[b"new\nline.txt"][1]) == b"odd name\n"
+    # The index was updated to match, so nothing is left to commit
+    assert git(repo, "status", "--porcelain") == ""
+
+
+def test_fast_import_applies_filters_like_git_add(repo):
+    write(repo, ".gitattributes", "*.txt text eol=lf\n*.up filter=upper\n")
+    git(repo, "config", "filter.upper.clean", "tr a-z A-Z")
+    git(repo, "add", ".gitattributes")
+    git(repo, "commit", "-qm", "attributes")
+    crlf = os.path.join(repo, "notes.txt")
+    with open(crlf, "wb") as f:
+        f.write(b"one\r\ntwo\r\n")
+    upper = write(repo, "shout.up", "quiet words\n")
+
+    committed = fast_import(repo, [([crlf, upper], FIRST)])
+    assert committed[0][2] is not None
+    assert git_bytes(repo, "show", "HEAD:notes.txt") == b"one\ntwo\n"
+    assert git_bytes(repo, "show", "HEAD:shout.up") == b"QUIET WORDS\n"
+    tree = ls_tree(repo)
+    assert tree[b"notes.txt"][1] == git(repo, "hash-object", "notes.txt").strip()
+
+
+def test_fast_import_keeps_index_modes_without_core_filemode(repo):
+    git(repo, "config", "core.fileMode", "false")
+    tracked = write(repo, "tool.sh", "echo one\n")
+    git(repo, "add", "-A")
+    git(repo, "commit", "-qm", "base")
+    write(repo, "tool.sh", "echo two\n")
+    os.chmod(tracked, os.stat(tracked).st_mode | stat.S_IXUSR)
+    new = write(repo, "new.sh", "echo new\n")
+    os.chmod(new, 0o755)
+
+    fast_import(repo, [([tracked, new], FIRST)])
+    tree = ls_tree(repo)
+    assert tree[b"tool.sh"][0] == "100644"
+    assert tree[b"new.sh"][0] == "100644"
+
+
+def test_fast_import_leaves_out_only_the_commit_that_fails(repo):
+    good = write(repo, "good.txt", "good\n")
+    unreadable = os.path.join(repo, "unreadable")
+    os.mkdir(unreadable) # Reading a directory fails even for root
+    later = write(repo, "later.txt", "later\n")
+
+    committed = fast_import(repo, [([good], FIRST), ([unreadable], FIRST), ([later], SECOND)])
+    assert [commit_hash is not None for _, _, commit_hash in committed] == [True, False, True]
+    assert set(ls_tree(repo)) == {b"good.txt", b"later.txt"}
+    assert git(repo, "rev-list", "--count", "HEAD").strip() == "2"
@@ -0,0 +1,41 @@
+from datetime import datetime, timedelta
+
+import main
+
+
+START = datetime(2024, 1, 1, 12, 0, 0)
+
+
+def at(seconds):
+    return START + timedelta(seconds=seconds)
+
+
+FILES = [("a/1.py", at(0)), ("b/1.py", at(10)), ("a/2.py", at(50)), ("a/3.py", at(200))]
+
+
+def test_group_files_by_time():
+    assert main.group_files_by_time(FILES, 60) == [
+        (["a/1.py", "b/1.py", "a/2.py"], at(50)),
+        (["a/3.py"], at(200)),
+    ]
+
+
+def test_group_files_by_time_and_directory():
+    assert main.group_files_by_time(FILES, 60, by_directory=True) == [
+        (["b/1.py"], at(10)),
+        (["a/1.py", "a/2.py"], at(50)),
+        (["a/3.py"], at(200)),
+    ]
+
+
+def test_iter_file_groups_yields_before_the_input_ends():
+    consumed = []
+
+    def files():
+        for seconds in range(0, 1000, 100):
+            consumed.append(seconds)
+            yield f"f{seconds}.py", at(seconds)
+
+    groups = main.iter_file_groups(files(), 10)
+    assert next(groups) == (["f0.py"], at(0))
+    assert len(consumed) == 2
@@ -0,0 +1,88 @@
+import os
+
+import pytest
+
+import main
+from conftest import git, write
+
+
+@pytest.mark.parametrize("path, kind", [
+    (".github/workflows/test.yml", "ci"),
+    ("Jenkinsfile", "ci"),
+    ("tests/test_app.py", "test"),
+    ("src/app.spec.ts", "test"),
+    ("poetry.lock", "deps"),
+    ("requirements-dev.txt", "build"),
+    ("Dockerfile", "build"),
+    ("README.md", "docs"),
+    ("docs/guide.py", "docs"),
+    ("web/site.scss", "style"),
+    ("img/logo.png", "asset"),
+    ("config/settings.yaml", "config"),
+    (".editorconfig", "config"),
+    ("src/parser/lexer.py", "code"),
+])
+def test_classify_path(path, kind):
+    assert main.classify_path(path) == kind
+
+
+def lines(count, prefix="line"):
+    return "".join(f"{prefix} {n}\n" for n in range(count))
+
+
+@pytest.fixture
+def history(repo):
+    """A repository with a few committed files, to change and stage in each test."""
+    write(repo, "src/parser/lexer.py", lines(20))
+    write(repo, "src/parser/tokens.py", lines(20))
+    write(repo, "README.md", "# Project\n")
+    write(repo, "poetry.lock", "lock\n")
+    git(repo, "add", "-A")
+    git(repo, "commit", "-qm", "base")
+    return repo
+
+
+def staged_message(repo, *relative_paths):
+    git(repo, "add", "-A")
+    return main.HeuristicMessageEngine(repo).message([os.path.join(repo, *path.split("/")) for path in relative_paths])
+
+
+def test_new_code_is_a_feature(history):
+    write(history, "src/parser/ast.py", lines(5))
+    assert staged_message(history, "src/parser/ast.py") == "feat(parser): add ast"
+
+
+def test_change_verbs_follow_the_diffstat(history):
+    write(history, "src/parser/lexer.py", lines(20) + lines(10, "more"))
+    assert staged_message(history, "src/parser/lexer.py") == "feat(parser): extend lexer"
+    write(history, "src/parser/lexer.py", lines(3))
+    assert staged_message(history, "src/parser/lexer.py") == "refactor(parser): simplify lexer"
+    write(history, "src/parser/lexer.py", lines(20).replace("line 5\n", "line five\n"))
+    assert staged_message(history, "src/parser/lexer.py") == "fix(parser): adjust lexer"
+
+
+def test_several_files_and_kinds(history):
+    write(history, "src/parser/lexer.py", lines(20).replace("line 1\n", "line one\n"))
+    write(history, "src/parser/tokens.py", lines(20).replace("line 2\n", "line two\n"))
+    assert staged_message(history, "src/parser/lexer.py", "src/parser/tokens.py") == "fix(parser): adjust lexer and tokens"
+    write(history, "README.md", "# Project\n\nUsage.\n")
+    assert staged_message(history, "README.md") == "docs: update README.md"
+    # Code decides the type of a commit that mixes it with docs
+    assert staged_message(history, "README.md", "src/parser/lexer.py") == "refactor: update README.md and lexer"
+    write(history, "poetry.lock", "lock 2\n")
+    assert staged_message(history, "poetry.lock") == "chore: update dependencies"
+
+
+def test_long_messages_name_the_file_count(history):
+    names = [f"src/parser/a_rather_long_module_name_{n}.py" for n in range(3)]
+    for name in names:
+        write(history, name, "x = 1\n")
+    message = staged_message(history, *names)
+    assert message == "feat: add 3 files"
+
+
+def test_working_tree_against_a_base_commit(history):
+    # Without staging, as the fast-import path does
+    write(history, "src/parser/lexer.py", lines(20) + lines(10, "more"))
+    engine = main.HeuristicMessageEngine(history, main.get_head_commit(history))
+    assert engine.message([os.path.join(history, "src", "parser", "lexer.py")]) == "feat(parser): extend lexer"
@@ -0,0 +1,31 @@
+import os
+
+import main
+from conftest import write
+
+
+def test_ignore_checker_answers_in_order(repo):
+    write(repo, ".gitignore", "*.log\n!keep.log\nbuild/\n")
+    paths = [
+        write(repo, "debug.log", ""),
+        write(repo, "keep.log", ""),
+        write(repo, "src/main.py", ""),
+        write(repo, "build/out.o", ""),
+        write(repo, "name with space.log", ""),
+    ]
+    checker = main.GitIgnoreChecker(repo)
+    try:
+        assert checker.check_paths(paths) == [True, False, False, True, True]
+        assert checker.is_ignored(paths[0])
+    finally:
+        checker.close()
+
+
+def test_ignore_checker_survives_paths_outside_the_repository(repo, tmp_path):
+    write(repo, ".gitignore", "*.log\n")
+    checker = main.GitIgnoreChecker(repo)
+    try:
+        outside = str(tmp_path / "outside.log")
+        assert checker.check_paths([outside, os.path.join(repo, "a.log"), os.path.join(repo, "a.txt")]) == [False, True, False]
+    finally:
+        checker.close()
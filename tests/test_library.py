@@ -0,0 +1,61 @@
+import os
+import sys
+import threading
+
+import main
+from conftest import git, write
+
+
+def env_file(tmp_path, name, batch_size):
+    path = tmp_path / name
+    path.write_text(f"GIT_AUTHOR_NAME={name}\nGIT_AUTHOR_EMAIL={name}@example.com\nAI_BATCH_SIZE={batch_size}\n")
+    return str(path)
+
+
+def test_committers_keep_their_own_settings(repo, tmp_path, monkeypatch):
+    for name in ("GIT_AUTHOR_NAME", "GIT_AUTHOR_EMAIL", "AI_BATCH_SIZE"):
+        monkeypatch.delenv(name, raising=False)
+    first = main.FilestampCommitter(repo, message_engine="heuristic", env_file=env_file(tmp_path, "first", 3))
+    second = main.FilestampCommitter(repo, message_engine="heuristic", env_file=env_file(tmp_path, "second", 5))
+    assert (first.author, second.author) == ("first", "second")
+    # The .env values are not exported, so they cannot leak into the next committer
+    assert "AI_BATCH_SIZE" not in os.environ
+
+    first.plan()
+    assert main.AI_BATCH_SIZE == 3
+    second.plan()
+    assert main.AI_BATCH_SIZE == 5
+
+    # The environment still takes precedence over the file
+    monkeypatch.setenv("AI_BATCH_SIZE", "7")
+    first.plan()
+    assert main.AI_BATCH_SIZE == 7
+
+
+def test_quiet_runs_in_threads_restore_stdout(tmp_path):
+    repos = []
+    for name in ("one", "two"):
+        repo_root = os.path.realpath(str(tmp_path / name))
+        os.makedirs(repo_root)
+        git(repo_root, "init", "-q")
+        for i in range(5):
+            write(repo_root, f"file{i}.txt", f"{name} {i}\n")
+        repos.append(repo_root)
+    stdout = sys.stdout
+    results = {}
+
+    def run(repo_root):
+        committer = main.FilestampCommitter(repo_root, author="Test", email="test@example.com",
+                                            message_engine="heuristic", quiet=True)
+        results[repo_root] = committer.commit()
+
+    threads = [threading.Thread(target=run, args=(repo_root,)) for repo_root in repos]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert sys.stdout is stdout
+    for repo_root in repos:
+        assert results[repo_root]["error"] is None
+        assert results[repo_root]["successful"] == 5
+        assert git(repo_root, "status", "--porcelain") == ""
@@ -0,0 +1,75 @@
+import os
+import sqlite3
+
+import main
+from conftest import git, write
+
+
+def test_cache_hits_and_misses(tmp_path):
+    cache = main.CommitMessageCache(str(tmp_path / "cache.sqlite"))
+    try:
+        assert cache.get("key") is None
+        cache.put("key", "feat: add key")
+        assert cache.get("key") == "feat: add key"
+        cache.put("key", "fix: replace key")
+        assert cache.get("key") == "fix: replace key"
+        assert (cache.hits, cache.misses) == (2, 1)
+    finally:
+        cache.close()
+    # Entries survive across runs
+    cache = main.CommitMessageCache(str(tmp_path / "cache.sqlite"))
+    try:
+        assert cache.get("key") == "fix: replace key"
+    finally:
+        cache.close()
+
+
+def test_cache_eviction(tmp_path, monkeypatch):
+    path = str(tmp_path / "cache.sqlite")
+    now = [1000000.0]
+    monkeypatch.setattr(main.time, "time", lambda: now[0])
+    cache = main.CommitMessageCache(path, max_entries=2, max_age_days=1)
+    for key in ("stale", "old", "used", "new"):
+        cache.put(key, key)
+        now[0] += 3600
+    now[0] += 86400 - 3 * 3600 # "stale" is now older than a day
+    assert cache.get("old") == "old" # Recently used again
+    cache.close() # Evicts
+    with sqlite3.connect(path) as connection:
+        keys = {key for key, in connection.execute("SELECT key FROM messages")}
+    assert keys == {"old", "new"}
+
+
+def test_cache_key_follows_content_and_settings(repo, monkeypatch):
+    file_path = write(repo, "app.py", "one\n")
+    git(repo, "add", "-A")
+    git(repo, "commit", "-qm", "base")
+    write(repo, "app.py", "two\n")
+    key = main.get_message_cache_key(repo, [file_path])
+    assert main.get_message_cache_key(repo, [file_path]) == key
+
+    # Different content
+    write(repo, "app.py", "three\n")
+    changed_key = main.get_message_cache_key(repo, [file_path])
+    assert changed_key != key
+    # The same change in a fresh clone, before any commit of it, hits the cache
+    write(repo, "app.py", "two\n")
+    assert main.get_message_cache_key(repo, [file_path]) == key
+
+    # A deleted file has no new blob, but still a key
+    os.remove(file_path)
+    deleted_key = main.get_message_cache_key(repo, [file_path])
+    assert deleted_key not in (key, changed_key)
+    write(repo, "app.py", "two\n")
+
+    # Settings that change the message invalidate the cached one
+    for name, value in [("MODEL", "another-model"), ("DIFF_CHAR_LIMIT", 1), ("DIFF_TOKEN_LIMIT", 1), ("PROMPT_HASH", "0" * 16)]:
+        with monkeypatch.context() as m:
+            m.setattr(main, name, value)
+            assert main.get_message_cache_key(repo, [file_path]) != key
+    assert main.get_message_cache_key(repo, [file_path]) == key
+
+
+def test_cache_key_ignores_file_order():
+    pairs = [("a" * 40, "b" * 40), (None, "c" * 40)]
+    assert main.CommitMessageCache.make_key(pairs) == main.CommitMessageCache.make_key(pairs[::-1])
@@ -0,0 +1,60 @@
+import os
+
+import pytest
+
+import main
+from conftest import git, write
+
+
+MODULE = "def handler(request):\n    return request.user.name\n"
+UTILITY = "def clamp(value, low, high):\n    return max(low, min(value, high))\n"
+
+
+@pytest.fixture
+def moved_repo(repo):
+    write(repo, "src/m1.py", MODULE)
+    write(repo, "lib/util.py", UTILITY)
+    write(repo, "pkg/__init__.py", "")
+    git(repo, "add", "-A")
+    git(repo, "commit", "-qm", "base")
+    os.remove(os.path.join(repo, "src", "m1.py"))
+    write(repo, "dst/m1.py", MODULE)
+    write(repo, "copy/util.py", UTILITY)
+    write(repo, "other/__init__.py", "")
+    return repo
+
+
+def test_plan_finds_moves_and_copies(moved_repo):
+    repo = moved_repo
+    state = main.load_incremental_state(repo, full=True)
+    pending_commits, _ = main.plan_directory_commits(repo, repo, state)
+    committed = sorted(sorted(files) for files, _ in pending_commits)
+    assert committed == [
+        [os.path.join(repo, "copy", "util.py")],
+        [os.path.join(repo, "dst", "m1.py"), os.path.join(repo, "src", "m1.py")],
+        [os.path.join(repo, "other", "__init__.py")],
+    ]
+    assert pending_commits.file_count == 4
+
+    content_index = main.get_content_index(repo)
+    assert content_index.renames == {os.path.join(repo, "dst", "m1.py"): os.path.join(repo, "src", "m1.py")}
+    # The empty __init__.py shares its blob with pkg/__init__.py, but is no copy of it
+    assert content_index.copies == {os.path.join(repo, "copy", "util.py"): os.path.join(repo, "lib", "util.py")}
+
+
+def test_find_moves_pairs_deleted_files_with_their_content(moved_repo):
+    repo = moved_repo
+    old_path, new_path = os.path.join(repo, "src", "m1.py"), os.path.join(repo, "dst", "m1.py")
+    content_index = main.ContentIndex(repo)
+    assert content_index.find_moves([old_path, new_path]) == [(old_path, new_path, "rename")]
+    # A commit with other changes is not a pure move
+    assert content_index.find_moves([old_path, new_path, os.path.join(repo, "copy", "util.py")]) is None
+
+
+def test_find_moves_reports_detected_copies(moved_repo):
+    repo = moved_repo
+    copy_path = os.path.join(repo, "copy", "util.py")
+    content_index = main.ContentIndex(repo)
+    content_index.detect([copy_path], repo)
+    assert content_index.find_moves([copy_path]) == [(os.path.join(repo, "lib", "util.py"), copy_path, "copy")]
+    assert content_index.find_moves([os.path.join(repo, "other", "__init__.py")]) is None
@@ -0,0 +1,45 @@
+import json
+import os
+from datetime import datetime, timedelta
+
+import pytest
+
+import main
+from conftest import git, write
+
+
+def test_commit_plan_round_trip(repo, tmp_path):
+    write(repo, "tracked.txt", "one\n")
+    git(repo, "add", "-A")
+    git(repo, "commit", "-qm", "base")
+    head = git(repo, "rev-parse", "HEAD").strip()
+    write(repo, "tracked.txt", "two\n")
+    new_paths = [write(repo, "docs/a.md", "a\n"), write(repo, "docs/b.md", "b\n")]
+
+    first = datetime(2024, 3, 1, 10, 15, 0, 500000)
+    second = first + timedelta(minutes=5)
+    plan_path = str(tmp_path / "plan.ndjson")
+    counts = main.write_commit_plan(plan_path, repo, [([os.path.join(repo, "tracked.txt")], first), (new_paths, second)])
+    assert counts == (2, 3)
+
+    # apply appends checkpoints; a crash can leave the last one cut off
+    with open(plan_path, "a") as f:
+        f.write(json.dumps({"type": "done", "group": 0, "commit": "abc1234"}) + "\n")
+        f.write('{"type": "done", "gro')
+
+    header, commits, done = main.read_commit_plan(plan_path)
+    assert header["repo"] == repo
+    assert header["head"] == head
+    assert [entry["group"] for entry in commits] == [0, 1]
+    assert [entry["paths"] for entry in commits] == [["tracked.txt"], ["docs/a.md", "docs/b.md"]]
+    assert [entry["status"] for entry in commits] == [[".M"], ["??", "??"]]
+    assert [datetime.fromtimestamp(entry["timestamp"]) for entry in commits] == [first, second]
+    assert done == {0: "abc1234"}
+
+
+def test_read_commit_plan_rejects_other_versions(tmp_path):
+    plan_path = str(tmp_path / "plan.ndjson")
+    with open(plan_path, "w") as f:
+        f.write(json.dumps({"type": "header", "version": main.PLAN_VERSION + 1, "repo": "/r", "head": None}) + "\n")
+    with pytest.raises(ValueError):
+        main.read_commit_plan(plan_path)
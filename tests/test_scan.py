@@ -0,0 +1,145 @@
+import os
+from datetime import datetime
+
+import pytest
+
+import main
+from conftest import git, write
+
+
+def test_row_sorter_merges_spilled_runs():
+    timestamps = [5.0, 1.0, 3.0, 1.0, 9.0, 2.0, 3.0, 0.5, 7.0, 1.0]
+    sorter = main.RowSorter(run_rows=3)
+    try:
+        for row, timestamp in enumerate(timestamps):
+            sorter.add(timestamp, row)
+        assert len(sorter._runs) == 3
+        assert len(sorter) == len(timestamps)
+        assert sorter.min_timestamp == 0.5
+        expected = sorted((timestamp, row) for row, timestamp in enumerate(timestamps))
+        assert list(sorter) == expected
+        # Iterating again, even while another pass is in progress, gives the same order
+        first_pass = iter(sorter)
+        next(first_pass)
+        assert list(sorter) == expected
+        assert list(first_pass) == expected[1:]
+    finally:
+        sorter.close()
+
+
+def test_row_sorter_in_memory_only():
+    sorter = main.RowSorter(run_rows=100)
+    assert sorter.min_timestamp is None
+    for row, timestamp in enumerate([2.0, 1.0, 2.0]):
+        sorter.add(timestamp, row)
+    assert sorter._runs == []
+    assert list(sorter) == [(1.0, 1), (2.0, 0), (2.0, 2)]
+
+
+def file_stat(size, mtime, birth_time, inode):
+    return main.FileStat(0o100644, inode, size, mtime, int(mtime * 1e9), birth_time, birth_time)
+
+
+def test_scan_table_maps_paths_to_stat_data():
+    table = main.ScanTable()
+    rows = [
+        table.append("/r/a/x.py", file_stat(10, 100.0, 50.0, 1)),
+        table.append("/r/a/y.py", file_stat(20, 200.0, 60.0, 2)),
+        table.append("/r/b/z.py", file_stat(30, 300.0, 70.0, 3)),
+    ]
+    assert rows == [0, 1, 2]
+    assert list(table.iter_paths()) == ["/r/a/x.py", "/r/a/y.py", "/r/b/z.py"]
+    assert table.find("/r/a/y.py") == 1
+    assert table.find("/r/a/missing.py") is None
+    assert "/r/c/z.py" not in table
+    scanned = table["/r/b/z.py"]
+    assert (scanned.st_size, scanned.st_mtime, scanned.st_ino) == (30, 300.0, 3)
+    assert scanned.st_birthtime == 70.0
+
+
+def test_scan_table_needs_the_files_of_a_directory_together():
+    table = main.ScanTable()
+    table.append("/r/a/x.py", file_stat(1, 1.0, 1.0, 1))
+    table.append("/r/b/y.py", file_stat(1, 1.0, 1.0, 2))
+    with pytest.raises(ValueError):
+        table.append("/r/a/z.py", file_stat(1, 1.0, 1.0, 3))
+
+
+def test_pending_commits_stream_with_moves():
+    table = main.ScanTable()
+    sorter = main.RowSorter(run_rows=2)
+    for name, timestamp in [("a.py", 30.0), ("b.py", 10.0), ("c.py", 20.0)]:
+        sorter.add(timestamp, table.append("/r/" + name, file_stat(1, timestamp, timestamp, 1)))
+    pending_commits = main.PendingCommits(table, sorter, renames={"/r/c.py": "/r/old/c.py"})
+    try:
+        assert pending_commits
+        assert pending_commits.file_count == 4
+        assert [files for files, _ in pending_commits] == [["/r/b.py"], ["/r/old/c.py", "/r/c.py"], ["/r/a.py"]]
+        assert main.count_commit_files(pending_commits) == 4
+    finally:
+        sorter.close()
+    assert not main.PendingCommits(table, main.RowSorter())
+
+
+def test_incremental_state_is_kept_across_runs(repo):
+    git_dir = os.path.join(repo, ".git")
+    kept, gone, outside = (os.path.join(repo, "src", name) for name in ("kept.py", "gone.py", "../top.py"))
+    latin1 = os.fsdecode(os.path.join(os.fsencode(repo), b"src", b"caf\xe9.py"))
+    state = main.IncrementalState.load(repo, git_dir, "head1")
+    for inode, file_path in enumerate([kept, gone, outside, latin1]):
+        state.record(file_path, file_stat(10, 1.5, 1.5, inode + 2 ** 63)) # Inodes beyond signed 64 bits
+    state.update_high_water(datetime.fromtimestamp(100))
+    state.forget_missing(os.path.join(repo, "src"), iter([kept, latin1]))
+    state.save("head1")
+    state.record(kept, file_stat(99, 9.0, 9.0, 1)) # Not saved
+    state.close()
+
+    state = main.IncrementalState.load(repo, git_dir, "head1")
+    assert state.high_water == 100
+    assert state.is_unchanged(kept, file_stat(10, 1.5, 1.5, 2 ** 63))
+    assert not state.is_unchanged(kept, file_stat(11, 1.5, 1.5, 2 ** 63))
+    assert not state.is_unchanged(gone, file_stat(10, 1.5, 1.5, 2 ** 63 + 1))
+    assert state.is_unchanged(outside, file_stat(10, 1.5, 1.5, 2 ** 63 + 2))
+    assert state.is_unchanged(latin1, file_stat(10, 1.5, 1.5, 2 ** 63 + 3))
+    state.close()
+
+    state = main.IncrementalState.load(repo, git_dir, "head2")
+    assert state.high_water == 100
+    assert not state.is_unchanged(outside, file_stat(10, 1.5, 1.5, 2 ** 63 + 2))
+    state.close()
+    # HEAD moving did not save anything, so the files are still there for head1
+    state = main.IncrementalState.load(repo, git_dir, "head1", full=True)
+    assert state.high_water is None
+    assert not state.is_unchanged(outside, file_stat(10, 1.5, 1.5, 2 ** 63 + 2))
+    state.close()
+
+
+def test_incremental_state_replaces_an_unreadable_file(repo):
+    git_dir = os.path.join(repo, ".git")
+    with open(os.path.join(git_dir, main.IncrementalState.FILE_NAME), "w") as f:
+        f.write("not a database" * 100)
+    state = main.IncrementalState.load(repo, git_dir, None)
+    state.record(os.path.join(repo, "a.py"), file_stat(1, 1.0, 1.0, 1))
+    state.save(None)
+    state.close()
+
+
+def test_heuristic_messages_read_the_commits_a_chunk_at_a_time(repo, monkeypatch):
+    for i in range(6):
+        write(repo, f"file{i}.py", "x = 1\n")
+    git(repo, "add", "-A")
+    read = []
+
+    def commits():
+        for i in range(6):
+            read.append(i)
+            yield [os.path.join(repo, f"file{i}.py")], datetime.fromtimestamp(i)
+
+    monkeypatch.setattr(main._commit_chunks, "__defaults__", (2,))
+    messages = main.iter_commit_messages(repo, commits(), "heuristic", None)
+    files, _, message = next(messages)
+    assert files == [os.path.join(repo, "file0.py")]
+    assert message == "feat: add file0"
+    assert read == [0, 1]
+    assert len(list(messages)) == 5
+    assert read == list(range(6))
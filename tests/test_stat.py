@@ -0,0 +1,97 @@
+import ctypes
+import errno
+import os
+
+import pytest
+
+import main
+
+
+class FakeStatx:
+    """Stands in for libc's statx(), failing every call with error."""
+
+    def __init__(self, error):
+        self.error = error
+        self.calls = 0
+
+    def __call__(self, *args):
+        self.calls += 1
+        ctypes.set_errno(self.error)
+        return -1
+
+
+class FakeLibc:
+    def __init__(self, statx):
+        self.statx = statx
+
+
+def test_statx_matches_os_stat(tmp_path):
+    reader = main.StatxReader()
+    if not reader.available:
+        pytest.skip("statx() is not available here")
+    path = tmp_path / "file.txt"
+    path.write_text("content\n")
+    stat_info = reader.stat(str(path))
+    expected = os.stat(str(path))
+    assert (stat_info.st_mode, stat_info.st_ino, stat_info.st_size, stat_info.st_mtime_ns) == (
+        expected.st_mode, expected.st_ino, expected.st_size, expected.st_mtime_ns)
+    assert stat_info.st_birthtime <= stat_info.st_mtime + 1
+    with pytest.raises(FileNotFoundError):
+        reader.stat(str(tmp_path / "missing"))
+
+
+def test_no_statx_outside_linux(tmp_path, monkeypatch):
+    monkeypatch.setattr(main, "PLATFORM_SYSTEM", "Darwin")
+    reader = main.StatxReader()
+    assert not reader.available
+    assert reader.stat(str(tmp_path)) is None
+
+
+@pytest.mark.parametrize("error", [errno.ENOSYS, errno.EPERM])
+def test_rejected_probe_turns_statx_off(monkeypatch, error):
+    statx = FakeStatx(error)
+    monkeypatch.setattr(main, "PLATFORM_SYSTEM", "Linux")
+    monkeypatch.setattr(main.ctypes, "CDLL", lambda name, use_errno=False: FakeLibc(statx))
+    assert not main.StatxReader().available
+    assert statx.calls == 1
+
+
+def test_missing_statx_in_libc(monkeypatch):
+    monkeypatch.setattr(main, "PLATFORM_SYSTEM", "Linux")
+    monkeypatch.setattr(main.ctypes, "CDLL", lambda name, use_errno=False: object())
+    assert not main.StatxReader().available
+
+
+def test_collector_falls_back_to_os_stat_when_statx_is_rejected(tmp_path):
+    path = tmp_path / "file.txt"
+    path.write_text("content\n")
+    collector = main.StatCollector(workers=1)
+    statx = FakeStatx(errno.ENOSYS)
+    collector._statx._statx = statx
+    stat_info = collector.stat(str(path))
+    assert isinstance(stat_info, os.stat_result)
+    assert stat_info.st_size == 8
+    # statx() is not tried again
+    assert not collector._statx.available
+    collector.stat(str(path))
+    assert statx.calls == 1
+
+
+def test_stat_all_keeps_the_order_and_reports_errors(tmp_path):
+    paths = []
+    for i in range(200):
+        path = tmp_path / f"file{i}.txt"
+        if i % 50 != 7:
+            path.write_text("x" * i)
+        paths.append(str(path))
+    collector = main.StatCollector(workers=4)
+    try:
+        results = list(collector.stat_all(iter(paths)))
+    finally:
+        collector.close()
+    assert [path for path, _ in results] == paths
+    for i, (_, stat_info) in enumerate(results):
+        if i % 50 == 7:
+            assert isinstance(stat_info, FileNotFoundError)
+        else:
+            assert stat_info.st_size == i
@@ -0,0 +1,98 @@
+import os
+
+import main
+from conftest import git, write
+
+
+HEAD_BLOB = "e69de29bb2d1d6434b8b29ae775ad8c2e48c5391"
+INDEX_BLOB = "d00491fd7e5bb6fa28c517a0bb32b8b506539d4d"
+MISSING_BLOB = "0" * 40
+
+
+def status_record(*fields):
+    return " ".join(fields).encode() + b"\0"
+
+
+def test_parse_porcelain_v2_records():
+    output = b"".join([
+        b"# branch.oid (initial)\0",
+        status_record("1", ".M", "N...", "100644", "100644", "100644", HEAD_BLOB, HEAD_BLOB, "src/app.py"),
+        status_record("1", "A.", "N...", "000000", "100644", "100644", MISSING_BLOB, INDEX_BLOB, "with space.txt"),
+        status_record("2", "R.", "N...", "100644", "100644", "100644", HEAD_BLOB, HEAD_BLOB, "R100", "new name.py"),
+        b"? old name.py\0", # The original path, which must not be read as a record
+        status_record("u", "UU", "N...", "100644", "100644", "100644", "100644", HEAD_BLOB, INDEX_BLOB, HEAD_BLOB, "conflict.txt"),
+        b"? untracked dir/file.txt\0",
+        b"! ignored.log\0",
+    ])
+    assert main.GitStatusIndex._parse(output) == {
+        "src/app.py": (".M", HEAD_BLOB, "100644"),
+        "with space.txt": ("A.", MISSING_BLOB, "100644"),
+        "new name.py": ("R.", HEAD_BLOB, "100644"),
+        "conflict.txt": ("UU", None, None),
+        "untracked dir/file.txt": ("??", None, None),
+    }
+
+
+def test_parse_porcelain_v2_empty_output():
+    assert main.GitStatusIndex._parse(b"") == {}
+
+
+def test_status_index_snapshot(repo, tmp_path):
+    write(repo, "kept.txt", "kept\n")
+    write(repo, "changed.txt", "before\n")
+    deleted_path = write(repo, "gone.txt", "gone\n")
+    git(repo, "add", "-A")
+    git(repo, "commit", "-qm", "base")
+    head_blob = git(repo, "rev-parse", "HEAD:gone.txt").strip()
+    write(repo, "changed.txt", "after\n")
+    os.remove(deleted_path)
+    new_path = write(repo, "new.txt", "new\n")
+
+    # Paths reached through a symbolic link to the repository map to the same entries
+    link = str(tmp_path / "link")
+    os.symlink(repo, link)
+    status_index = main.GitStatusIndex(repo)
+    assert status_index.status(os.path.join(link, "changed.txt")) == ".M"
+    assert status_index.status(os.path.join(repo, "kept.txt")) is None
+    assert not status_index.has_changes(os.path.join(repo, "kept.txt"))
+    assert status_index.is_new(new_path)
+    assert status_index.head_blob(new_path) is None
+    assert status_index.deleted_files() == [(deleted_path, head_blob)]
+
+
+def test_status_index_limited_to_the_target(repo, monkeypatch):
+    write(repo, "docs/guide.md", "guide\n")
+    git(repo, "add", "-A")
+    git(repo, "commit", "-qm", "base")
+    in_target = write(repo, "src/app.py", "app\n")
+    glob_name = write(repo, "src/[ab].py", "glob\n")
+    write(repo, "src/a.py", "a\n")
+    outside = write(repo, "docs/guide.md", "changed\n")
+    commands = []
+    run_git = main.run_git
+
+    def counting_run_git(command, **kwargs):
+        commands.append(command)
+        return run_git(command, **kwargs)
+
+    monkeypatch.setattr(main, "run_git", counting_run_git)
+    status_index = main.GitStatusIndex(repo)
+    status_index.cover([os.path.join(repo, "src")])
+    assert commands[-1][-2:] == ["--", "src"]
+    assert set(status_index._entries) == {"src/app.py", "src/[ab].py", "src/a.py"}
+    assert status_index.is_new(in_target)
+    assert status_index.is_new(glob_name)
+    assert len(commands) == 1
+
+    # A lookup outside the snapshot reads just that path
+    assert status_index.status(outside) == ".M"
+    assert commands[-1][-2:] == ["--", "docs/guide.md"]
+    status_index.has_changes(outside)
+    status_index.cover([os.path.join(repo, "src", "app.py")])
+    assert len(commands) == 2
+
+    # The repository root takes a full snapshot
+    status_index = main.GitStatusIndex(repo)
+    status_index.cover([repo])
+    assert "--" not in commands[-1]
+    assert status_index.has_changes(outside)
@@ -0,0 +1,77 @@
+import json
+
+import main
+
+
+class StreamResponse:
+    """A streamed reply that records how many of its lines were read."""
+
+    def __init__(self, lines):
+        self.lines = lines
+        self.read = 0
+        self.closed = False
+        self.encoding = None
+        self.status_code = 200
+
+    def iter_lines(self, chunk_size=None, decode_unicode=False):
+        for line in self.lines:
+            self.read += 1
+            yield line
+
+    def raise_for_status(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+
+def events(*contents):
+    lines = []
+    for content in contents:
+        lines.append("data: " + json.dumps({"choices": [{"delta": {"content": content}}]}))
+        lines.append("")
+    return lines + ["data: [DONE]", ""]
+
+
+def test_reads_the_whole_stream():
+    lines = [": keep-alive", "event: message"] + events("feat: add ", "parser", "\n\nDetails.")
+    lines.insert(4, "data: not json")
+    lines.insert(5, 'data: {"choices": [{"delta": {"role": "assistant"}}]}')
+    response = StreamResponse(lines)
+    assert main.read_streamed_reply(response) == "feat: add parser\n\nDetails."
+    assert response.encoding == "utf-8"
+    assert response.closed
+
+
+def test_stops_after_the_first_line():
+    response = StreamResponse(events("```\n", '"feat: add', ' parser"\n', "More text", " never needed"))
+    assert main.read_streamed_reply(response, stop_after_first_line=True) == "feat: add parser"
+    assert response.read == 5 # Up to the third event, which ends the first line
+    assert response.closed
+
+
+def test_first_line_without_a_newline():
+    response = StreamResponse(events("fix: ", "handle empty input"))
+    assert main.read_streamed_reply(response, stop_after_first_line=True) == "fix: handle empty input"
+
+
+def test_stops_reading_at_done():
+    response = StreamResponse(events("docs: update README") + ["data: " + json.dumps({"choices": [{"delta": {"content": "late"}}]})])
+    assert main.read_streamed_reply(response) == "docs: update README"
+
+
+def test_request_completion_streams(monkeypatch):
+    sent = []
+
+    def post_api_request(headers, data):
+        sent.append(data)
+        return StreamResponse(events("feat: add parser\n", "Body that is cut off"))
+
+    main.import_requests()
+    monkeypatch.setattr(main, "post_api_request", post_api_request)
+    monkeypatch.setattr(main, "AI_STREAM", True)
+    for name, value in [("API_ENDPOINT", "http://localhost/v1/chat/completions"), ("API_KEY", "key"), ("MODEL", "model")]:
+        monkeypatch.setattr(main, name, value)
+    monkeypatch.setattr(main, "_completion_client", main.CompletionClient(max_concurrency=1, requests_per_minute=0, tokens_per_minute=0, max_retries=0))
+    assert main.request_completion("prompt", single_line=True) == "feat: add parser"
+    assert sent[0]["stream"] is True